@@ -0,0 +1,104 @@
+"""
+任务准入控制（api_server.py 与 worker_server.py 共用）
+
+- Worker 每完成一个任务，把处理耗时写入 service_time:{task_type}（只保留最近 SERVICE_TIME_WINDOW 个）
+- API 入队前读取队列长度与平均处理耗时，估算等待时间
+- 队列长度或预计等待时间超过上限时拒绝入队（429 + Retry-After），避免队列无限增长
+
+写入 / 读取函数只向 pipeline 追加命令，同步与异步 Redis 客户端的 pipeline 都可以使用。
+"""
+
+import math
+import os
+from typing import List, Optional
+
+SERVICE_TIME_PREFIX = "service_time:"
+SERVICE_TIME_WINDOW = int(os.getenv("SERVICE_TIME_WINDOW", 50))
+
+# 尚无样本时使用的默认处理耗时（秒）
+DEFAULT_SERVICE_TIME = {
+    "denoise": float(os.getenv("DEFAULT_DENOISE_SERVICE_TIME", 2.0)),
+    "virtual": float(os.getenv("DEFAULT_VIRTUAL_SERVICE_TIME", 3.0)),
+}
+
+# 每个 Worker 进程中各任务类型的并发数（worker_server 的工作池按此分配），以及 Worker 进程数
+WORKER_CONCURRENCY = {
+    "denoise": max(1, int(os.getenv("WORKER_CONCURRENCY_DENOISE", 1))),
+    "virtual": max(1, int(os.getenv("WORKER_CONCURRENCY_VIRTUAL", 1))),
+}
+WORKER_INSTANCES = max(1, int(os.getenv("WORKER_INSTANCES", 1)))
+
+# 准入上限：排队任务数、预计等待时间（秒）
+ADMISSION_MAX_QUEUE_DEPTH = int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH", 100))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", 600))
+
+
+def service_time_key(task_type: str) -> str:
+    """处理耗时样本键"""
+    return f"{SERVICE_TIME_PREFIX}{task_type}"
+
+
+def add_service_time_write(pipe, task_type: str, seconds: float) -> None:
+    """向 pipeline 追加记录一次处理耗时的命令"""
+    key = service_time_key(task_type)
+    pipe.lpush(key, round(seconds, 3))
+    pipe.ltrim(key, 0, SERVICE_TIME_WINDOW - 1)
+
+
+def add_backlog_read(pipe, queue_name: str, task_type: str) -> None:
+    """向 pipeline 追加读取队列长度与处理耗时样本的命令（ZCARD + LRANGE）"""
+    pipe.zcard(queue_name)
+    pipe.lrange(service_time_key(task_type), 0, -1)
+
+
+def average_service_time(task_type: str, samples: Optional[List[str]]) -> float:
+    """计算最近样本的平均处理耗时，无样本时使用默认值"""
+    values = []
+    for sample in samples or []:
+        try:
+            values.append(float(sample))
+        except (TypeError, ValueError):
+            continue
+    if not values:
+        return DEFAULT_SERVICE_TIME.get(task_type, 5.0)
+    return sum(values) / len(values)
+
+
+def estimate_backlog(task_type: str, queue_depth: int, samples: Optional[List[str]], incoming: int = 1) -> dict:
+    """
+    估算新任务的等待时间并判断是否允许入队
+
+    Args:
+        task_type: 任务类型
+        queue_depth: 当前排队任务数
+        samples: 最近的处理耗时样本
+        incoming: 本次提交的任务数（批量提交时为图片数，按最后一个任务估算等待时间）
+
+    Returns:
+        dict: queue_depth / avg_service_time / estimated_wait（预计完成所需秒数）/
+              admitted / retry_after（被拒绝时建议的重试秒数）
+    """
+    avg = average_service_time(task_type, samples)
+    # 排在前面的任务由所有 Worker 的并发槽位并行消化，之后再处理本任务
+    slots = WORKER_CONCURRENCY.get(task_type, 1) * WORKER_INSTANCES
+    incoming = max(1, incoming)
+    queue_wait = (queue_depth + incoming - 1) * avg / slots
+    estimated_wait = queue_wait + avg
+
+    over_depth = queue_depth + incoming - ADMISSION_MAX_QUEUE_DEPTH
+    over_wait = estimated_wait - ADMISSION_MAX_WAIT
+    admitted = over_depth <= 0 and over_wait <= 0
+
+    retry_after = 0
+    if not admitted:
+        # 等到积压降回上限以内所需的时间
+        drain = max(over_depth * avg / slots, over_wait)
+        retry_after = max(1, math.ceil(drain))
+
+    return {
+        "queue_depth": queue_depth,
+        "avg_service_time": round(avg, 2),
+        "estimated_wait": math.ceil(estimated_wait),
+        "admitted": admitted,
+        "retry_after": retry_after,
+    }
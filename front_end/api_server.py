@@ -1,21 +1,40 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Body, BackgroundTasks
-from fastapi.responses import JSONResponse, FileResponse, Response
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Body, BackgroundTasks, Request, Header
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse, PlainTextResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import os
 import uuid
-import io
 import json
+import hashlib
 from PIL import Image
 import uvicorn
 from pathlib import Path
-import redis
-from typing import Optional
-from datetime import datetime
+import redis.asyncio as aioredis
+from typing import Optional, Dict, Set, List
+from datetime import datetime, timedelta
 from pydantic import BaseModel
 import shutil
 import asyncio
+import time
+from functools import partial
 from starlette.responses import FileResponse as StarletteFileResponse
+from starlette.concurrency import run_in_threadpool
+from file_serving import CORS_HEADERS, serve_file, resolve_file, guess_media_type
+from image_cache import DerivativeCache, DERIVATIVE_FORMATS, snap_width
+from image_pool import ImagePool, ImagePoolBusy, normalize_upload, reencode_jpeg, remove_file
+from memory_store import TTLCache
+from artifacts import ArtifactGC, ARTIFACT_HOLD_PREFIX, artifact_path
+from storage import create_storage, storage_key, key_from_url
+from admission import add_backlog_read, estimate_backlog
+from reliable_queue import DEAD_LETTER_KEY, DELAYED_KEY, add_enqueue
+from scheduling import assign_schedule
+from metrics import (
+    REGISTRY, CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, REDIS_BUCKETS, SIZE_BUCKETS,
+)
+from task_records import (
+    TASK_STORAGE_PREFIX, TASK_PAYLOAD_PREFIX, TASK_TTL, INDEXED_STATUSES,
+    add_task_write, add_task_read, merge_task, status_index_key,
+)
 
 app = FastAPI(title="房产视觉增强系统 API", version="2.0.0")
 
@@ -35,6 +54,16 @@ OUTPUT_FOLDER = 'output'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+# 上传配置
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 50 * 1024 * 1024))  # 单张图片上限，默认 50MB
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))  # 分块读取大小，默认 1MB
+
+# 图片编解码工作池（上传规范化、缩略图、模拟处理的 JPEG 重编码共用）
+image_pool = ImagePool()
+derivative_cache = DerivativeCache(pool=image_pool)
+# 产物存储（local / s3，见 storage.py）
+storage = create_storage()
+
 # 注意：不再使用 app.mount()，而是使用显式的路由处理器（见下面的 /uploads/{filename} 和 /output/{filename}）
 # 这样可以确保 CORS 头正确应用
 
@@ -43,27 +72,162 @@ REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
 REDIS_QUEUE_PREFIX = "task_queue:"
-TASK_STORAGE_PREFIX = "task_storage:"
-
-# 用于存储任务信息的字典（如果 Redis 不可用，使用内存存储）
-task_storage = {}
-
-# 初始化 Redis 连接
-try:
-    redis_client = redis.Redis(
-        host=REDIS_HOST,
-        port=REDIS_PORT,
-        db=REDIS_DB,
-        decode_responses=True,
-        socket_connect_timeout=5
-    )
-    # 测试连接
-    redis_client.ping()
-    print(f"✓ Redis 连接成功: {REDIS_HOST}:{REDIS_PORT}")
-except Exception as e:
-    print(f"⚠ Redis 连接失败: {e}")
-    print("⚠ 将使用模拟模式（不发送到队列）")
-    redis_client = None
+TASK_EVENTS_PREFIX = "task_events:"  # 任务状态推送频道（Redis pub/sub）
+
+# 结果缓存配置：相同图片 + 相同参数的任务直接复用已有结果
+RESULT_INDEX_PREFIX = "result_index:"
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 24 * 3600))  # 被引用的产物在此期间不会被清理
+PIPELINE_VERSION = os.getenv("PIPELINE_VERSION", "1")  # 模型或处理流程变化时修改，使旧结果失效
+RESULT_FIELDS = ("processed_url", "processed_path", "furniture_list", "furniture_images", "selection_url")
+
+# 批量任务配置
+JOB_STORAGE_PREFIX = "job_storage:"
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 50))  # 单个批量任务最多图片数
+
+# SSE 配置
+SSE_KEEPALIVE_INTERVAL = 15  # 心跳间隔（秒）
+SSE_MAX_DURATION = int(os.getenv("SSE_MAX_DURATION", 600))  # 单个连接最长保持时间（秒）
+TERMINAL_STATUSES = ("completed", "failed")
+
+# 内存存储配置（Redis 不可用时使用，条目带 TTL 且数量有上限）
+MEMORY_STORE_MAX_TASKS = int(os.getenv("MEMORY_STORE_MAX_TASKS", 10000))
+MEMORY_SWEEP_INTERVAL = int(os.getenv("MEMORY_SWEEP_INTERVAL", 30))  # 后台清理间隔（秒）
+# 近端缓存：Redis 可用时缓存已结束（completed / failed）的热点任务，减少重复读取
+NEAR_CACHE_MAX_TASKS = int(os.getenv("NEAR_CACHE_MAX_TASKS", 2000))
+NEAR_CACHE_TTL = int(os.getenv("NEAR_CACHE_TTL", 30))
+
+# 产物清理：删除任务记录已过期的上传图片与处理结果（配置见 artifacts.py）
+ARTIFACT_GC_ENABLED = os.getenv("ARTIFACT_GC_ENABLED", "1") != "0"
+
+# 用于存储任务信息（如果 Redis 不可用，使用内存存储）
+task_storage = TTLCache(MEMORY_STORE_MAX_TASKS, TASK_TTL)
+# 结果索引（如果 Redis 不可用，使用内存存储）: 缓存键 -> 结果字段
+result_index = TTLCache(MEMORY_STORE_MAX_TASKS, RESULT_CACHE_TTL)
+# 被结果缓存引用的源任务（如果 Redis 不可用，使用内存存储）: task_id -> True
+artifact_holds = TTLCache(MEMORY_STORE_MAX_TASKS, RESULT_CACHE_TTL)
+# 批量任务信息（如果 Redis 不可用，使用内存存储）
+job_storage = TTLCache(MEMORY_STORE_MAX_TASKS, TASK_TTL)
+# Redis 前的近端缓存: task_id -> 已结束的任务数据
+task_near_cache = TTLCache(NEAR_CACHE_MAX_TASKS, NEAR_CACHE_TTL)
+
+# Redis 连接池大小（所有请求共享；SSE 连接共用一个进程级订阅连接）
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", 64))
+
+# 初始化异步 Redis 客户端（共享连接池，所有 Redis I/O 都不会阻塞事件循环）
+redis_pool = aioredis.BlockingConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=REDIS_DB,
+    decode_responses=True,
+    socket_connect_timeout=5,
+    max_connections=REDIS_POOL_SIZE,
+    timeout=5,  # 连接池耗尽时最多等待 5 秒
+)
+redis_client: Optional[aioredis.Redis] = aioredis.Redis(connection_pool=redis_pool)
+
+
+@app.on_event("startup")
+async def connect_redis():
+    """启动时测试 Redis 连接，不可用时降级为内存模式"""
+    global redis_client
+    try:
+        await redis_client.ping()
+        print(f"✓ Redis 连接成功: {REDIS_HOST}:{REDIS_PORT} (连接池大小 {REDIS_POOL_SIZE})")
+    except Exception as e:
+        print(f"⚠ Redis 连接失败: {e}")
+        print("⚠ 将使用模拟模式（不发送到队列）")
+        redis_client = None
+
+
+async def sweep_memory_stores():
+    """后台周期性清理内存存储中已过期的条目"""
+    while True:
+        await asyncio.sleep(MEMORY_SWEEP_INTERVAL)
+        for store in (task_storage, result_index, artifact_holds, job_storage, task_near_cache):
+            store.sweep()
+
+
+@app.on_event("startup")
+async def start_memory_sweeper():
+    """启动内存存储清理任务"""
+    job = asyncio.create_task(sweep_memory_stores())
+    background_jobs.add(job)
+    job.add_done_callback(background_jobs.discard)
+
+
+async def existing_task_ids(task_ids: List[str]) -> Set[str]:
+    """
+    查询哪些任务的产物仍需保留：任务记录仍存在，或被结果缓存引用（产物清理使用）
+    
+    Args:
+        task_ids: 任务ID列表
+    
+    Returns:
+        set: 产物需要保留的任务ID
+    """
+    if redis_client:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.exists(f"{TASK_STORAGE_PREFIX}{task_id}", f"{ARTIFACT_HOLD_PREFIX}{task_id}")
+            results = await timed_redis("gc_exists", pipe.execute())
+        return {task_id for task_id, exists in zip(task_ids, results) if exists}
+    return {task_id for task_id in task_ids if task_id in task_storage or task_id in artifact_holds}
+
+
+@app.on_event("startup")
+async def start_artifact_gc():
+    """启动产物清理任务（删除任务记录已过期的上传图片与处理结果）"""
+    if not ARTIFACT_GC_ENABLED:
+        return
+    gc = ArtifactGC([UPLOAD_FOLDER, OUTPUT_FOLDER], existing_task_ids)
+    job = asyncio.create_task(gc.run())
+    background_jobs.add(job)
+    job.add_done_callback(background_jobs.discard)
+
+
+@app.on_event("shutdown")
+async def close_redis():
+    """停止进程级任务事件订阅并关闭连接池"""
+    if task_event_relay is not None:
+        task_event_relay.cancel()
+        try:
+            await task_event_relay
+        except asyncio.CancelledError:
+            pass
+    await redis_pool.disconnect()
+
+
+@app.on_event("shutdown")
+async def close_image_pool():
+    """关闭图片工作池"""
+    image_pool.shutdown()
+
+
+# 监控指标（GET /metrics）
+TASK_TYPES = ('denoise', 'virtual')
+QUEUE_DEPTH = Gauge("task_queue_depth", "Redis 队列 task_queue:* 中等待处理的任务数")
+DELAYED_DEPTH = Gauge("task_delayed_depth", "等待重试的任务数")
+DEAD_LETTER_DEPTH = Gauge("task_dead_letter_depth", "死信队列中的任务数")
+UPLOAD_SIZE = Histogram("upload_size_bytes", "上传图片大小（字节）", buckets=SIZE_BUCKETS)
+UPLOAD_DURATION = Histogram("upload_duration_seconds", "上传图片接收、规范化与哈希的总耗时（秒）")
+REDIS_LATENCY = Histogram("redis_call_duration_seconds", "API 服务 Redis 调用耗时（秒）", buckets=REDIS_BUCKETS)
+TASKS_SUBMITTED = Counter("tasks_submitted_total", "提交处理的任务数（outcome: queued / cache_hit）")
+
+
+async def timed_redis(op: str, awaitable):
+    """等待 Redis 调用并记录耗时"""
+    with REDIS_LATENCY.time(op=op):
+        return await awaitable
+
+
+# 本进程 SSE 连接的事件队列: task_id -> 订阅队列集合
+# Redis 可用时由进程级订阅（relay_task_events）分发，否则由 publish_task_event 直接投递
+task_event_subscribers: Dict[str, Set[asyncio.Queue]] = {}
+TASK_EVENT_RELAY_RETRY = 1  # 进程级订阅断开后的重连间隔（秒）
+# 由 SSE 接口启动的后台模拟任务（保留引用，防止被垃圾回收）
+background_jobs: Set[asyncio.Task] = set()
+# 进程级任务事件订阅（relay_task_events）
+task_event_relay: Optional[asyncio.Task] = None
 
 
 @app.get("/")
@@ -81,7 +245,7 @@ async def health_check():
     redis_status = False
     if redis_client:
         try:
-            redis_client.ping()
+            await redis_client.ping()
             redis_status = True
         except:
             pass
@@ -94,60 +258,443 @@ async def health_check():
     }
 
 
-def store_task_info(task_id: str, task_data: dict) -> bool:
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 指标（队列长度在抓取时通过一次管道读取）"""
+    if redis_client:
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for task_type in TASK_TYPES:
+                    pipe.zcard(f"{REDIS_QUEUE_PREFIX}{task_type}")
+                pipe.zcard(DELAYED_KEY)
+                pipe.llen(DEAD_LETTER_KEY)
+                *depths, delayed, dead = await timed_redis("queue_depth", pipe.execute())
+            for task_type, depth in zip(TASK_TYPES, depths):
+                QUEUE_DEPTH.set(depth, queue=f"{REDIS_QUEUE_PREFIX}{task_type}")
+            DELAYED_DEPTH.set(delayed)
+            DEAD_LETTER_DEPTH.set(dead)
+        except Exception as e:
+            print(f"✗ 读取队列长度失败: {e}")
+    return PlainTextResponse(REGISTRY.render(), media_type=CONTENT_TYPE_LATEST)
+
+
+async def store_task_info(task_id: str, task_data: dict) -> bool:
     """
-    存储任务信息到 Redis 或内存
+    存储任务信息到 Redis 或内存（只更新传入的字段，未传入的字段保持不变）
     
     Args:
         task_id: 任务ID
-        task_data: 任务数据字典
+        task_data: 任务数据字典，或需要更新的字段
     
     Returns:
         bool: 是否成功存储
     """
     if redis_client:
         try:
-            key = f"{TASK_STORAGE_PREFIX}{task_id}"
-            task_json = json.dumps(task_data, ensure_ascii=False)
-            redis_client.setex(key, 3600, task_json)  # 存储1小时
+            task_near_cache.pop(task_id)
+            async with redis_client.pipeline(transaction=True) as pipe:
+                add_task_write(pipe, task_id, task_data)  # 存储1小时
+                await timed_redis("store_task", pipe.execute())
             return True
         except Exception as e:
             print(f"✗ 存储任务信息到 Redis 失败: {e}")
-            # 降级到内存存储
-            task_storage[task_id] = task_data
-            return True
-    else:
-        # 使用内存存储
-        task_storage[task_id] = task_data
-        return True
+    
+    # 使用内存存储（或降级到内存存储），与 Redis 一样只更新传入的字段并刷新 TTL
+    task_storage.update(task_id, task_data, TASK_TTL)
+    return True
 
 
-def get_task_info(task_id: str) -> Optional[dict]:
+async def get_task_info(task_id: str, with_payload: bool = True) -> Optional[dict]:
     """
     从 Redis 或内存获取任务信息
     
     Args:
         task_id: 任务ID
+        with_payload: 任务已完成时是否同时读取家具列表等大字段
     
     Returns:
         dict: 任务数据，如果不存在返回 None
     """
     if redis_client:
+        # 已结束的任务不会再变化，优先读近端缓存
+        cached = task_near_cache.get(task_id)
+        if cached is not None:
+            return dict(cached)
         try:
-            key = f"{TASK_STORAGE_PREFIX}{task_id}"
-            task_json = redis_client.get(key)
-            if task_json:
-                return json.loads(task_json)
+            raw_fields = await timed_redis("get_task", redis_client.hgetall(f"{TASK_STORAGE_PREFIX}{task_id}"))
+            task_data = merge_task(raw_fields, None)
+            if task_data:
+                # 大字段只在任务完成后才需要
+                if with_payload and task_data.get("status") == "completed":
+                    raw_payload = await timed_redis("get_payload", redis_client.get(f"{TASK_PAYLOAD_PREFIX}{task_id}"))
+                    task_data = merge_task(raw_fields, raw_payload)
+                if with_payload and task_data.get("status") in TERMINAL_STATUSES:
+                    task_near_cache.set(task_id, dict(task_data))
+                return task_data
         except Exception as e:
             print(f"✗ 从 Redis 获取任务信息失败: {e}")
     
     # 从内存获取
-    return task_storage.get(task_id)
+    task_data = task_storage.get(task_id)
+    return dict(task_data) if task_data is not None else None
+
+
+async def publish_task_event(task_id: str, event_type: str, data: dict) -> None:
+    """
+    推送任务事件给 /task/{task_id}/events 的订阅者
+    
+    Args:
+        task_id: 任务ID
+        event_type: 事件类型（status / progress）
+        data: 事件数据
+    """
+    message = {"event": event_type, "task_id": task_id, **data}
+    if redis_client:
+        try:
+            channel = f"{TASK_EVENTS_PREFIX}{task_id}"
+            await timed_redis("publish", redis_client.publish(channel, json.dumps(message, ensure_ascii=False)))
+            return
+        except Exception as e:
+            print(f"✗ 发布任务事件失败: {e}")
+    
+    # 内存模式：直接投递到本进程的订阅队列
+    deliver_task_event(task_id, message)
+
+
+def deliver_task_event(task_id: str, message: dict) -> None:
+    """把事件投递给本进程中订阅该任务的所有 SSE 连接（每个连接一份副本）"""
+    for queue in task_event_subscribers.get(task_id, ()):
+        queue.put_nowait(dict(message))
+
+
+async def relay_task_events():
+    """
+    进程级任务事件订阅：一个 Redis 连接按模式订阅 task_events:*，分发到本进程各 SSE 连接的队列
+    
+    SSE 连接不再各自占用连接池中的连接，同时打开的连接数不受 REDIS_POOL_SIZE 限制。
+    """
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.psubscribe(f"{TASK_EVENTS_PREFIX}*")
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=SSE_KEEPALIVE_INTERVAL)
+                if message is None:
+                    continue
+                task_id = message["channel"][len(TASK_EVENTS_PREFIX):]
+                if task_id not in task_event_subscribers:
+                    continue
+                try:
+                    deliver_task_event(task_id, json.loads(message["data"]))
+                except (TypeError, ValueError):
+                    continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"✗ 任务事件订阅中断，{TASK_EVENT_RELAY_RETRY} 秒后重连: {e}")
+            await asyncio.sleep(TASK_EVENT_RELAY_RETRY)
+        finally:
+            try:
+                await pubsub.reset()
+            except Exception:
+                pass
+
+
+def upload_too_large(limit: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"上传内容过大，最大支持 {limit // (1024 * 1024)}MB")
+
+
+class UploadSizeLimitMiddleware:
+    """
+    在解析 multipart 请求体之前限制上传大小
+    
+    FastAPI 在调用处理函数前就会把整个 multipart 请求体写入临时文件，处理函数中的检查
+    只能在超大文件落盘之后才生效。这里按 Content-Length 直接拒绝，没有 Content-Length
+    （分块传输）时在读取请求体的过程中计数，超出上限立即中止。
+    """
+    
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+    
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope.get("path")) if scope["type"] == "http" and scope["method"] == "POST" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        
+        headers = dict(scope.get("headers") or [])
+        try:
+            content_length = int(headers.get(b"content-length", b"0"))
+        except ValueError:
+            content_length = 0
+        if content_length > limit:
+            error = upload_too_large(limit)
+            # 本中间件在 CORSMiddleware 之外，需要自行带上 CORS 头，前端才能读取错误信息
+            response = JSONResponse({"detail": error.detail}, status_code=413,
+                                    headers={"Access-Control-Allow-Origin": "*", "Connection": "close"})
+            await response(scope, receive, send)
+            return
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise upload_too_large(limit)
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+
+# multipart 边界与表单字段的余量
+MULTIPART_OVERHEAD = 64 * 1024
+app.add_middleware(UploadSizeLimitMiddleware, limits={
+    "/upload-image": MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD,
+    "/batch": (MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD) * MAX_BATCH_SIZE,
+})
 
 
-def send_task_to_redis(task_type: str, task_data: dict) -> bool:
+def copy_upload_file(src, dest_path: str) -> int:
     """
-    将任务发送到 Redis 消息队列
+    将已接收的上传文件分块复制到目标路径（同步，在线程池中执行）
+    
+    Raises:
+        HTTPException: 文件超过 MAX_UPLOAD_SIZE 时返回 413
+    """
+    total = 0
+    src.seek(0)
+    with open(dest_path, "wb") as f:
+        while True:
+            chunk = src.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            total += len(chunk)
+            if total > MAX_UPLOAD_SIZE:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"图片过大，最大支持 {MAX_UPLOAD_SIZE // (1024 * 1024)}MB"
+                )
+            f.write(chunk)
+    return total
+
+
+async def save_upload_stream(upload: UploadFile, dest_path: str) -> int:
+    """
+    将上传文件分块写入磁盘，不在内存中保留完整内容（文件读写在线程池中执行，不阻塞事件循环）
+    
+    Args:
+        upload: 上传的文件对象
+        dest_path: 目标文件路径
+    
+    Returns:
+        int: 写入的字节数
+    
+    Raises:
+        HTTPException: 文件超过 MAX_UPLOAD_SIZE 时返回 413
+    """
+    try:
+        return await run_in_threadpool(copy_upload_file, upload.file, dest_path)
+    except BaseException:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+
+
+def read_image_size(path: str) -> tuple:
+    """
+    只读取图片文件头获取宽高（PIL 延迟解码，不加载像素数据）
+    
+    Args:
+        path: 图片路径
+    
+    Returns:
+        tuple: (width, height)
+    """
+    with Image.open(path) as img:
+        return img.size
+
+
+def compute_result_key(task_data: dict) -> Optional[str]:
+    """
+    计算结果缓存键: (图片哈希, 任务类型, 处理参数, 流程版本)
+    
+    Args:
+        task_data: 任务数据字典（需包含 image_hash）
+    
+    Returns:
+        str: 缓存键，缺少图片哈希时返回 None
+    """
+    image_hash = task_data.get("image_hash")
+    if not image_hash:
+        return None
+    task_type = task_data.get("task_type")
+    params = {}
+    if task_type == 'virtual':
+        params = {
+            "decoration_style": task_data.get("decoration_style"),
+            "max_price": task_data.get("max_price"),
+            "room_type": task_data.get("room_type"),
+        }
+    key_source = json.dumps(
+        [image_hash, task_type, params, PIPELINE_VERSION], sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+
+async def artifact_exists(url: Optional[str]) -> bool:
+    """检查 /output/ 或 /uploads/ 下的产物是否仍然存在"""
+    key = key_from_url(url)
+    if key is None:
+        return False
+    if storage.remote:
+        return await asyncio.to_thread(storage.exists, key)
+    return storage.exists(key)
+
+
+async def publish_artifact(folder: str, filename: str) -> None:
+    """把已写入本地的产物上传到对象存储（本地存储无需处理）"""
+    if storage.remote:
+        key = storage_key(folder, filename)
+        await asyncio.to_thread(storage.put_file, key, storage.local_path(key))
+
+
+async def fetch_artifact(folder: str, filename: str) -> None:
+    """对象存储模式下把产物下载到本地缓存（本地存储无需处理）"""
+    if not storage.remote or not filename or os.path.basename(filename) != filename:
+        return
+    try:
+        await asyncio.to_thread(storage.fetch, storage_key(folder, filename))
+    except Exception as e:
+        print(f"✗ 从对象存储下载产物失败: {e}")
+
+
+async def lookup_cached_result(result_key: str) -> Optional[dict]:
+    """
+    查找已缓存的处理结果；产物文件已被删除时同时清除索引
+    
+    Args:
+        result_key: 缓存键
+    
+    Returns:
+        dict: 结果字段，未命中返回 None
+    """
+    cached = None
+    if redis_client:
+        try:
+            cached_json = await timed_redis("result_lookup", redis_client.get(f"{RESULT_INDEX_PREFIX}{result_key}"))
+            cached = json.loads(cached_json) if cached_json else None
+        except Exception as e:
+            print(f"✗ 查询结果缓存失败: {e}")
+    else:
+        cached = result_index.get(result_key)
+    
+    if not cached:
+        return None
+    if not await artifact_exists(cached.get("processed_url")):
+        await invalidate_cached_result(result_key)
+        return None
+    return cached
+
+
+# 产物保留键的过期时间至少延长到 ARGV[1] 秒之后（不缩短已有的更长保留期）
+EXTEND_HOLD_SCRIPT = """
+if redis.call('TTL', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('SETEX', KEYS[1], ARGV[1], 1)
+end
+return 1
+"""
+
+
+async def extend_artifact_hold(source_task_id: str) -> None:
+    """
+    命中结果缓存时延长源任务产物的保留期，至少覆盖新任务记录的有效期（TASK_TTL）
+    
+    否则在保留期快结束时命中的任务，其引用的产物可能随即被 ArtifactGC 删除。
+    """
+    if not source_task_id:
+        return
+    if redis_client:
+        try:
+            await timed_redis("artifact_hold", redis_client.eval(
+                EXTEND_HOLD_SCRIPT, 1, f"{ARTIFACT_HOLD_PREFIX}{source_task_id}", TASK_TTL))
+        except Exception as e:
+            print(f"✗ 延长产物保留期失败: {e}")
+    else:
+        artifact_holds.extend(source_task_id, True, TASK_TTL)
+
+
+async def invalidate_cached_result(result_key: str) -> None:
+    """删除结果缓存索引"""
+    if redis_client:
+        try:
+            await timed_redis("result_invalidate", redis_client.delete(f"{RESULT_INDEX_PREFIX}{result_key}"))
+        except Exception as e:
+            print(f"✗ 删除结果缓存失败: {e}")
+    else:
+        result_index.pop(result_key, None)
+
+
+async def save_cached_result(task_data: dict) -> None:
+    """
+    任务完成后登记结果索引（Redis 模式下由 worker 负责，这里用于模拟处理）
+    
+    Args:
+        task_data: 已完成的任务数据
+    """
+    result_key = task_data.get("result_cache_key")
+    if not result_key or task_data.get("status") != "completed":
+        return
+    cached = {field: task_data.get(field) for field in RESULT_FIELDS}
+    cached["source_task_id"] = task_data.get("task_id")
+    if redis_client:
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.setex(f"{RESULT_INDEX_PREFIX}{result_key}", RESULT_CACHE_TTL,
+                           json.dumps(cached, ensure_ascii=False))
+                # 结果缓存有效期内保留源任务的产物
+                pipe.setex(f"{ARTIFACT_HOLD_PREFIX}{cached['source_task_id']}", RESULT_CACHE_TTL, 1)
+                await timed_redis("result_save", pipe.execute())
+        except Exception as e:
+            print(f"✗ 保存结果缓存失败: {e}")
+    else:
+        result_index.set(result_key, cached)
+        artifact_holds.set(cached["source_task_id"], True)
+
+
+async def store_task_and_publish(task_id: str, task_data: dict, event_data: dict) -> None:
+    """
+    保存任务信息并推送状态事件（Redis 模式下 HSET + PUBLISH 合并为一次往返）
+    
+    Args:
+        task_id: 任务ID
+        task_data: 任务数据字典，或需要更新的字段
+        event_data: 状态事件数据（如 {"status": "completed"}）
+    """
+    if redis_client:
+        try:
+            message = {"event": "status", "task_id": task_id, **event_data}
+            task_near_cache.pop(task_id)
+            async with redis_client.pipeline(transaction=True) as pipe:
+                add_task_write(pipe, task_id, task_data)
+                pipe.publish(f"{TASK_EVENTS_PREFIX}{task_id}",
+                             json.dumps(message, ensure_ascii=False))
+                await timed_redis("update_status", pipe.execute())
+            return
+        except Exception as e:
+            print(f"✗ 更新任务状态到 Redis 失败: {e}")
+    
+    await store_task_info(task_id, task_data)
+    await publish_task_event(task_id, "status", event_data)
+
+
+async def send_task_to_redis(task_type: str, task_data: dict) -> bool:
+    """
+    将任务发送到 Redis 消息队列，同时保存任务信息并推送 queued 事件
+    （HSET + 入队 + PUBLISH 在同一个事务管道中执行，只需一次往返）
     
     Args:
         task_type: 任务类型 ('denoise' 或 'virtual')
@@ -156,21 +703,153 @@ def send_task_to_redis(task_type: str, task_data: dict) -> bool:
     Returns:
         bool: 是否成功发送
     """
+    task_id = task_data.get("task_id")
     if not redis_client:
-        print(f"[模拟模式] 任务已创建: {task_type} - {task_data.get('task_id')}")
+        print(f"[模拟模式] 任务已创建: {task_type} - {task_id}")
         return False
     
     try:
+        task_near_cache.pop(task_id)
         queue_name = f"{REDIS_QUEUE_PREFIX}{task_type}"
         task_json = json.dumps(task_data, ensure_ascii=False)
-        redis_client.lpush(queue_name, task_json)
-        print(f"✓ 任务已发送到队列 {queue_name}: {task_data.get('task_id')}")
+        message = {"event": "status", "task_id": task_id, "status": task_data.get("status")}
+        async with redis_client.pipeline(transaction=True) as pipe:
+            add_task_write(pipe, task_id, task_data)
+            add_enqueue(pipe, task_type, task_data, task_json)
+            pipe.publish(f"{TASK_EVENTS_PREFIX}{task_id}", json.dumps(message, ensure_ascii=False))
+            await timed_redis("enqueue", pipe.execute())
+        print(f"✓ 任务已发送到队列 {queue_name}: {task_id}")
         return True
     except Exception as e:
         print(f"✗ 发送任务到 Redis 失败: {e}")
         return False
 
 
+async def check_admission(task_type: str, incoming: int = 1) -> dict:
+    """
+    根据当前队列长度与最近的平均处理耗时估算等待时间，判断是否允许入队
+    
+    Args:
+        task_type: 任务类型
+        incoming: 本次提交的任务数（批量提交时为图片数）
+    
+    Returns:
+        dict: 见 admission.estimate_backlog；Redis 不可用时按空队列估算
+    """
+    queue_depth, samples = 0, None
+    if redis_client:
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                add_backlog_read(pipe, f"{REDIS_QUEUE_PREFIX}{task_type}", task_type)
+                queue_depth, samples = await timed_redis("backlog", pipe.execute())
+        except Exception as e:
+            # 读取失败时不阻止入队
+            print(f"⚠ 读取队列积压失败: {e}")
+    return estimate_backlog(task_type, queue_depth, samples, incoming)
+
+
+def admission_rejected(task_type: str, backlog: dict, count: int = 1) -> HTTPException:
+    """
+    积压超过上限时的 429 响应（带 Retry-After）
+    
+    Args:
+        task_type: 任务类型
+        backlog: check_admission 的结果
+        count: 被拒绝的任务数
+    
+    Returns:
+        HTTPException: 429 异常
+    """
+    TASKS_SUBMITTED.inc(count, task_type=task_type, outcome="rejected")
+    return HTTPException(
+        status_code=429,
+        detail={
+            "message": "当前排队任务过多，请稍后重试",
+            "queue_depth": backlog["queue_depth"],
+            "retry_after": backlog["retry_after"],
+        },
+        headers={"Retry-After": str(backlog["retry_after"])},
+    )
+
+
+async def create_uploaded_task(image: UploadFile, task_type: str) -> dict:
+    """
+    保存上传的图片并构建任务数据（不存储、不入队）
+    
+    Args:
+        image: 上传的图片
+        task_type: 任务类型
+    
+    Returns:
+        dict: 状态为 uploaded 的任务数据
+    """
+    # 验证文件类型
+    if not image.content_type or not image.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="请上传图片文件")
+    
+    # 生成唯一任务 ID
+    task_id = str(uuid.uuid4())
+    original_filename = f"{task_id}_original.png"
+    original_path = artifact_path(UPLOAD_FOLDER, original_filename)
+    
+    # 分块保存原始上传文件到临时路径
+    upload_started = time.perf_counter()
+    raw_path = artifact_path(UPLOAD_FOLDER, f"{task_id}_raw.tmp")
+    upload_size = await save_upload_stream(image, raw_path)
+    
+    # 只读取文件头获取图片信息
+    try:
+        image_width, image_height = read_image_size(raw_path)
+    except Exception:
+        remove_file(raw_path)
+        raise HTTPException(status_code=400, detail="无法识别的图片格式")
+    
+    # 解码、PNG 重编码与像素哈希放到图片工作池中执行，避免阻塞事件循环
+    # 原始文件在规范化真正结束后才删除（超时后工作池中的任务仍可能在读取）
+    try:
+        image_hash = await image_pool.run("normalize_upload", normalize_upload, raw_path, original_path,
+                                          after=partial(remove_file, raw_path))
+    except ImagePoolBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="图片处理超时，请稍后重试", headers={"Retry-After": "5"})
+    await publish_artifact(UPLOAD_FOLDER, original_filename)
+    UPLOAD_SIZE.observe(upload_size)
+    UPLOAD_DURATION.observe(time.perf_counter() - upload_started)
+    
+    # 构建任务数据（不发送到队列，只存储）
+    task_data = {
+        "task_id": task_id,
+        "task_type": task_type,
+        "original_filename": original_filename,
+        "original_path": original_path,
+        "original_key": storage_key(UPLOAD_FOLDER, original_filename),
+        "original_url": f"/uploads/{original_filename}",
+        "image_width": image_width,
+        "image_height": image_height,
+        "image_hash": image_hash,
+        "created_at": datetime.now().isoformat(),
+        "status": "uploaded"  # 状态为已上传，未处理
+    }
+    
+    # 根据任务类型添加特定参数
+    if task_type == 'denoise':
+        task_data["description"] = "AI高清放大与去杂处理"
+    elif task_type == 'virtual':
+        task_data["description"] = "虚拟布置处理"
+    
+    return task_data
+
+
+def validate_task_type(task_type: str) -> None:
+    """验证任务类型"""
+    if task_type not in ['denoise', 'virtual']:
+        raise HTTPException(
+            status_code=400,
+            detail=f"无效的任务类型: {task_type}。支持的类型: denoise, virtual"
+        )
+
+
 @app.post("/upload-image")
 async def upload_image(
     image: UploadFile = File(...),
@@ -184,65 +863,26 @@ async def upload_image(
     - virtual: 虚拟布置
     
     流程:
-    1. 接收图片并保存
+    1. 分块接收图片并保存到磁盘（超过 MAX_UPLOAD_SIZE 返回 413）
     2. 生成任务ID并存储任务信息
     3. 立即返回图片 URL 和任务ID供前端展示
     """
     try:
         # 验证任务类型
-        if task_type not in ['denoise', 'virtual']:
-            raise HTTPException(
-                status_code=400,
-                detail=f"无效的任务类型: {task_type}。支持的类型: denoise, virtual"
-            )
-        
-        # 验证文件类型
-        if not image.content_type or not image.content_type.startswith('image/'):
-            raise HTTPException(status_code=400, detail="请上传图片文件")
-        
-        # 生成唯一任务 ID
-        task_id = str(uuid.uuid4())
-        original_filename = f"{task_id}_original.png"
-        original_path = os.path.join(UPLOAD_FOLDER, original_filename)
-        
-        # 保存原始图片
-        image_data = await image.read()
-        img = Image.open(io.BytesIO(image_data))
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        img.save(original_path, 'PNG')
+        validate_task_type(task_type)
         
-        # 获取图片信息
-        image_width, image_height = img.size
-        
-        # 构建任务数据（不发送到队列，只存储）
-        task_data = {
-            "task_id": task_id,
-            "task_type": task_type,
-            "original_filename": original_filename,
-            "original_path": original_path,
-            "original_url": f"/uploads/{original_filename}",
-            "image_width": image_width,
-            "image_height": image_height,
-            "created_at": datetime.now().isoformat(),
-            "status": "uploaded"  # 状态为已上传，未处理
-        }
-        
-        # 根据任务类型添加特定参数
-        if task_type == 'denoise':
-            task_data["description"] = "AI高清放大与去杂处理"
-        elif task_type == 'virtual':
-            task_data["description"] = "虚拟布置处理"
+        task_data = await create_uploaded_task(image, task_type)
+        task_id = task_data["task_id"]
         
         # 存储任务信息（不发送到队列）
-        store_task_info(task_id, task_data)
+        await store_task_info(task_id, task_data)
         
         # 立即返回结果，让前端可以展示上传的图片
         return JSONResponse({
             "success": True,
             "task_id": task_id,
             "task_type": task_type,
-            "original_url": f"/uploads/{original_filename}",
+            "original_url": task_data["original_url"],
             "message": "图片上传成功",
             "status": "uploaded"
         })
@@ -261,10 +901,78 @@ class ProcessTaskRequest(BaseModel):
     room_type: Optional[str] = None
 
 
+def prepare_task_for_queue(task_data: dict, decoration_style: Optional[str] = None,
+                           max_price: Optional[int] = None, room_type: Optional[str] = None) -> dict:
+    """
+    将任务标记为 queued，写入处理参数与结果缓存键
+    
+    Args:
+        task_data: 任务数据字典
+        decoration_style: 装修风格（仅virtual任务）
+        max_price: 最高预算（仅virtual任务）
+        room_type: 房间类型（仅virtual任务）
+    
+    Returns:
+        dict: 更新后的任务数据
+    """
+    task_type = task_data.get("task_type")
+    
+    # 更新任务状态
+    task_data["status"] = "queued"
+    task_data["queued_at"] = datetime.now().isoformat()
+    
+    # 根据任务类型添加特定参数
+    if task_type == 'denoise':
+        task_data["description"] = "AI高清放大与去杂处理"
+    elif task_type == 'virtual':
+        task_data["description"] = "虚拟布置处理"
+        # 添加虚拟布置的特定参数（确保所有参数都被传递，即使为None）
+        task_data["decoration_style"] = decoration_style
+        task_data["max_price"] = max_price
+        task_data["room_type"] = room_type
+        
+        # 打印参数信息用于调试
+        print(f"虚拟布置任务参数: decoration_style={decoration_style}, "
+              f"max_price={max_price}, room_type={room_type}")
+    
+    task_data["result_cache_key"] = compute_result_key(task_data)
+    return task_data
+
+
+async def apply_cached_result(task_data: dict) -> bool:
+    """
+    查找结果缓存，命中时把任务直接标记为 completed（不保存，由调用方保存）
+    
+    Args:
+        task_data: 已调用 prepare_task_for_queue 的任务数据
+    
+    Returns:
+        bool: 是否命中
+    """
+    result_key = task_data.get("result_cache_key")
+    cached = await lookup_cached_result(result_key) if result_key else None
+    if not cached:
+        return False
+    await extend_artifact_hold(cached.get("source_task_id"))
+    task_data.update({field: cached.get(field) for field in RESULT_FIELDS})
+    task_data["status"] = "completed"
+    task_data["completed_at"] = datetime.now().isoformat()
+    task_data["cache_hit"] = True
+    task_data["cached_from"] = cached.get("source_task_id")
+    print(f"✓ 命中结果缓存: {task_data.get('task_id')} (复用任务 {task_data['cached_from']})")
+    return True
+
+
 @app.post("/process-task")
-async def process_task(request: ProcessTaskRequest = Body(...)):
+async def process_task(request: ProcessTaskRequest = Body(...),
+                       x_tenant_id: Optional[str] = Header(None),
+                       x_tenant_tier: Optional[str] = Header(None)):
     """
-    触发任务处理（将任务发送到 Redis 消息队列）
+    触发任务处理（将任务发送到 Redis 消息队列，按交互式优先级排队）
+    
+    请求头（由网关设置，可选）:
+    - X-Tenant-ID: 租户标识，同一租户的任务之间公平排队
+    - X-Tenant-Tier: 付费等级（'paid' / 'free'）
     
     请求体:
     - task_id: 任务ID（必需）
@@ -278,20 +986,18 @@ async def process_task(request: ProcessTaskRequest = Body(...)):
     2. 添加任务特定参数到任务数据
     3. 将任务发送到 Redis 消息队列
     4. 更新任务状态
+    
+    如果相同图片（像素哈希）+ 相同参数 + 相同流程版本已有结果，直接返回 completed，不进入队列
     """
     try:
         task_id = request.task_id
         task_type = request.task_type
         
         # 验证任务类型
-        if task_type not in ['denoise', 'virtual']:
-            raise HTTPException(
-                status_code=400,
-                detail=f"无效的任务类型: {task_type}。支持的类型: denoise, virtual"
-            )
+        validate_task_type(task_type)
         
         # 获取任务信息
-        task_data = get_task_info(task_id)
+        task_data = await get_task_info(task_id)
         if not task_data:
             raise HTTPException(status_code=404, detail="任务不存在")
         
@@ -299,32 +1005,38 @@ async def process_task(request: ProcessTaskRequest = Body(...)):
         if task_data.get('task_type') != task_type:
             raise HTTPException(status_code=400, detail="任务类型不匹配")
         
-        # 更新任务状态
-        task_data["status"] = "queued"
-        task_data["queued_at"] = datetime.now().isoformat()
+        prepare_task_for_queue(task_data, request.decoration_style,
+                               request.max_price, request.room_type)
+        assign_schedule(task_data, "interactive", x_tenant_id, x_tenant_tier)
         
-        # 根据任务类型添加特定参数
-        if task_type == 'denoise':
-            task_data["description"] = "AI高清放大与去杂处理"
-        elif task_type == 'virtual':
-            task_data["description"] = "虚拟布置处理"
-            # 添加虚拟布置的特定参数（确保所有参数都被传递，即使为None）
-            task_data["decoration_style"] = request.decoration_style
-            task_data["max_price"] = request.max_price
-            task_data["room_type"] = request.room_type
+        # 查找结果缓存：相同图片 + 相同参数已处理过则直接返回已有产物，不进入队列
+        if await apply_cached_result(task_data):
+            await store_task_and_publish(task_id, task_data, {"status": "completed"})
+            TASKS_SUBMITTED.inc(task_type=task_type, outcome="cache_hit")
             
-            # 打印参数信息用于调试
-            print(f"虚拟布置任务参数: decoration_style={request.decoration_style}, "
-                  f"max_price={request.max_price}, room_type={request.room_type}")
+            response_data = build_task_result(task_data)
+            response_data.update({
+                "task_type": task_type,
+                "message": f"{task_data['description']}已完成（复用已有结果）",
+                "cache_hit": True,
+                "redis_sent": False,
+            })
+            return JSONResponse(response_data)
+        
+        # 准入控制：积压超过上限时拒绝入队（429），避免排队时间无限增长
+        backlog = await check_admission(task_type)
+        if not backlog["admitted"]:
+            raise admission_rejected(task_type, backlog)
         
         # 打印完整的任务数据用于调试
         print(f"发送到Redis队列的任务数据: {json.dumps(task_data, ensure_ascii=False, indent=2)}")
         
-        # 发送任务到 Redis 消息队列
-        send_success = send_task_to_redis(task_type, task_data)
-        
-        # 更新存储的任务信息
-        store_task_info(task_id, task_data)
+        # 发送任务到 Redis 消息队列（同时更新存储的任务信息）
+        send_success = await send_task_to_redis(task_type, task_data)
+        TASKS_SUBMITTED.inc(task_type=task_type, outcome="queued")
+        if not send_success:
+            # 队列不可用时仍需更新存储的任务信息
+            await store_task_and_publish(task_id, task_data, {"status": "queued"})
         
         return JSONResponse({
             "success": True,
@@ -333,6 +1045,10 @@ async def process_task(request: ProcessTaskRequest = Body(...)):
             "message": f"{task_data['description']}任务已加入队列",
             "status": "queued",
             "redis_sent": send_success,
+            "cache_hit": False,
+            "queue_depth": backlog["queue_depth"],
+            "estimated_wait": backlog["estimated_wait"],
+            "estimated_completion_at": (datetime.now() + timedelta(seconds=backlog["estimated_wait"])).isoformat(),
             "task_params": task_data if task_type == 'virtual' else None  # 返回任务参数用于确认
         })
         
@@ -342,6 +1058,323 @@ async def process_task(request: ProcessTaskRequest = Body(...)):
         raise HTTPException(status_code=500, detail=f"处理失败: {str(e)}")
 
 
+async def send_batch_to_redis(job_data: dict, tasks: List[dict]) -> bool:
+    """
+    在一个 Redis 管道中保存批量任务及其全部子任务，并把 queued 子任务发送到队列
+    
+    Args:
+        job_data: 批量任务数据
+        tasks: 子任务数据列表（queued 的入队，completed 的为命中结果缓存）
+    
+    Returns:
+        bool: 是否成功发送
+    """
+    if not redis_client:
+        print(f"[模拟模式] 批量任务已创建: {job_data['job_id']} ({len(tasks)} 个任务)")
+        return False
+    
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.setex(f"{JOB_STORAGE_PREFIX}{job_data['job_id']}", TASK_TTL,
+                       json.dumps(job_data, ensure_ascii=False))
+            for task_data in tasks:
+                task_id = task_data["task_id"]
+                task_json = json.dumps(task_data, ensure_ascii=False)
+                message = {"event": "status", "task_id": task_id, "status": task_data["status"]}
+                add_task_write(pipe, task_id, task_data)
+                if task_data["status"] == "queued":
+                    add_enqueue(pipe, task_data["task_type"], task_data, task_json)
+                pipe.publish(f"{TASK_EVENTS_PREFIX}{task_id}", json.dumps(message, ensure_ascii=False))
+            await timed_redis("enqueue_batch", pipe.execute())
+        print(f"✓ 批量任务已发送到队列: {job_data['job_id']} ({len(tasks)} 个任务)")
+        return True
+    except Exception as e:
+        print(f"✗ 发送批量任务到 Redis 失败: {e}")
+        return False
+
+
+async def get_job_info(job_id: str) -> Optional[dict]:
+    """从 Redis 或内存获取批量任务信息"""
+    if redis_client:
+        try:
+            job_json = await timed_redis("get_job", redis_client.get(f"{JOB_STORAGE_PREFIX}{job_id}"))
+            if job_json:
+                return json.loads(job_json)
+        except Exception as e:
+            print(f"✗ 从 Redis 获取批量任务信息失败: {e}")
+    return job_storage.get(job_id)
+
+
+async def get_tasks_info(task_ids: List[str]) -> List[Optional[dict]]:
+    """
+    批量获取任务信息（不含大字段，Redis 模式下一次管道往返）
+    
+    Args:
+        task_ids: 任务ID列表
+    
+    Returns:
+        list: 与 task_ids 一一对应的任务数据，不存在为 None
+    """
+    if redis_client and task_ids:
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for task_id in task_ids:
+                    add_task_read(pipe, task_id)
+                values = await timed_redis("get_tasks", pipe.execute())
+            return [
+                merge_task(raw_fields, None) or task_storage.get(task_id)
+                for task_id, raw_fields in zip(task_ids, values)
+            ]
+        except Exception as e:
+            print(f"✗ 从 Redis 批量获取任务信息失败: {e}")
+    return [task_storage.get(task_id) for task_id in task_ids]
+
+
+@app.post("/batch")
+async def create_batch_job(
+    images: List[UploadFile] = File(...),
+    task_type: str = Form(...),
+    decoration_style: Optional[str] = Form(None),
+    max_price: Optional[int] = Form(None),
+    room_type: Optional[str] = Form(None),
+    x_tenant_id: Optional[str] = Header(None),
+    x_tenant_tier: Optional[str] = Header(None)
+):
+    """
+    批量提交任务（整套房源的多张照片一次提交，按批量优先级排队）
+    
+    请求头: X-Tenant-ID / X-Tenant-Tier，同 /process-task
+    
+    表单参数:
+    - images: 多张图片（必需）
+    - task_type: 任务类型 ('denoise' 或 'virtual')（必需）
+    - decoration_style / max_price / room_type: 所有图片共用的虚拟布置参数（可选）
+    
+    流程:
+    0. 准入控制：队列积压加上本批图片数超过上限时整批拒绝（429 + Retry-After）
+    1. 保存所有图片，每张图片创建一个任务，归属同一个 job_id
+    2. 命中结果缓存的任务直接完成，其余任务在一个 Redis 管道中入队
+    3. 返回 job_id，通过 GET /batch/{job_id} 查询整体进度
+    """
+    try:
+        validate_task_type(task_type)
+        if not images:
+            raise HTTPException(status_code=400, detail="请至少上传一张图片")
+        if len(images) > MAX_BATCH_SIZE:
+            raise HTTPException(status_code=400, detail=f"单次最多提交 {MAX_BATCH_SIZE} 张图片")
+        
+        # 准入控制：按整批图片数计入积压，超过上限时整批拒绝（429），不保存任何图片
+        backlog = await check_admission(task_type, len(images))
+        if not backlog["admitted"]:
+            raise admission_rejected(task_type, backlog, len(images))
+        
+        job_id = str(uuid.uuid4())
+        # 同一批量任务同时规范化的图片数不超过工作池线程数，大批量不会超出工作池的积压上限而被拒绝
+        limiter = asyncio.Semaphore(image_pool.workers)
+        
+        async def create_limited(image: UploadFile) -> dict:
+            async with limiter:
+                return await create_uploaded_task(image, task_type)
+        
+        results = await asyncio.gather(
+            *(create_limited(image) for image in images),
+            return_exceptions=True
+        )
+        
+        tasks = []
+        rejected = []
+        for image, result in zip(images, results):
+            if isinstance(result, BaseException):
+                error = result.detail if isinstance(result, HTTPException) else str(result)
+                rejected.append({"filename": image.filename, "error": error})
+                continue
+            result["job_id"] = job_id
+            result["source_filename"] = image.filename
+            prepare_task_for_queue(result, decoration_style, max_price, room_type)
+            assign_schedule(result, "batch", x_tenant_id, x_tenant_tier)
+            await apply_cached_result(result)
+            tasks.append(result)
+        
+        if not tasks:
+            raise HTTPException(status_code=400, detail={"message": "所有图片均上传失败", "rejected": rejected})
+        
+        job_data = {
+            "job_id": job_id,
+            "task_type": task_type,
+            "task_ids": [task["task_id"] for task in tasks],
+            "total": len(tasks),
+            "params": {
+                "decoration_style": decoration_style,
+                "max_price": max_price,
+                "room_type": room_type,
+            } if task_type == 'virtual' else None,
+            "created_at": datetime.now().isoformat(),
+        }
+        
+        send_success = await send_batch_to_redis(job_data, tasks)
+        for task in tasks:
+            TASKS_SUBMITTED.inc(task_type=task_type, outcome="cache_hit" if task.get("cache_hit") else "queued")
+        if not send_success:
+            # 队列不可用：保存到内存，queued 任务使用模拟处理
+            job_storage.set(job_id, job_data)
+            for task_data in tasks:
+                await store_task_info(task_data["task_id"], task_data)
+                if task_data["status"] == "queued" and redis_client is None:
+                    job = asyncio.create_task(simulate_task_processing(task_data["task_id"], task_type))
+                    background_jobs.add(job)
+                    job.add_done_callback(background_jobs.discard)
+        
+        return JSONResponse({
+            "success": True,
+            "job_id": job_id,
+            "task_type": task_type,
+            "total": len(tasks),
+            "cached": sum(1 for task in tasks if task.get("cache_hit")),
+            "redis_sent": send_success,
+            "tasks": [
+                {
+                    "task_id": task["task_id"],
+                    "filename": task["source_filename"],
+                    "original_url": task["original_url"],
+                    "status": task["status"],
+                }
+                for task in tasks
+            ],
+            "rejected": rejected,
+            "queue_depth": backlog["queue_depth"],
+            "estimated_wait": backlog["estimated_wait"],
+            "estimated_completion_at": (datetime.now() + timedelta(seconds=backlog["estimated_wait"])).isoformat(),
+            "message": f"批量任务已提交，共 {len(tasks)} 张图片"
+        })
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"批量提交失败: {str(e)}")
+
+
+@app.get("/batch/{job_id}")
+async def get_batch_status(job_id: str):
+    """
+    查询批量任务的整体进度（一次调用返回所有子任务状态）
+    """
+    job_data = await get_job_info(job_id)
+    if not job_data:
+        raise HTTPException(status_code=404, detail="批量任务不存在")
+    
+    task_ids = job_data.get("task_ids", [])
+    tasks = await get_tasks_info(task_ids)
+    
+    counts = {"completed": 0, "failed": 0, "processing": 0, "queued": 0}
+    task_summaries = []
+    for task_id, task_data in zip(task_ids, tasks):
+        status = task_data.get("status", "unknown") if task_data else "expired"
+        counts[status] = counts.get(status, 0) + 1
+        summary = {"task_id": task_id, "status": status}
+        if task_data:
+            summary["original_url"] = task_data.get("original_url")
+            if status == "completed":
+                summary["processed_url"] = task_data.get("processed_url")
+            elif status == "failed":
+                summary["error"] = task_data.get("error")
+        task_summaries.append(summary)
+    
+    total = len(task_ids)
+    finished = counts["completed"] + counts["failed"] + counts.get("expired", 0)
+    return {
+        "success": True,
+        "job_id": job_id,
+        "task_type": job_data.get("task_type"),
+        "total": total,
+        "completed": counts["completed"],
+        "failed": counts["failed"],
+        "processing": counts["processing"],
+        "queued": counts["queued"],
+        "progress": round(finished / total, 3) if total else 1.0,
+        "done": finished == total,
+        "tasks": task_summaries,
+    }
+
+
+@app.get("/tasks")
+async def list_tasks(status: str, limit: int = 100):
+    """
+    按状态列出任务（queued / processing / completed / failed），最近进入该状态的在前
+    
+    Redis 模式下直接读取状态索引（有序集合），不扫描任务键
+    """
+    if status not in INDEXED_STATUSES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"无效的状态: {status}。支持的状态: {', '.join(INDEXED_STATUSES)}"
+        )
+    limit = max(1, min(limit, 1000))
+    
+    if redis_client:
+        try:
+            min_score = datetime.now().timestamp() - TASK_TTL
+            entries = await timed_redis("list_tasks", redis_client.zrevrangebyscore(
+                status_index_key(status), "+inf", min_score, start=0, num=limit, withscores=True
+            ))
+            return {
+                "success": True,
+                "status": status,
+                "count": len(entries),
+                "tasks": [
+                    {"task_id": task_id, "since": datetime.fromtimestamp(score).isoformat()}
+                    for task_id, score in entries
+                ],
+            }
+        except Exception as e:
+            print(f"✗ 读取状态索引失败: {e}")
+    
+    # 内存模式：直接遍历
+    task_ids = [task_id for task_id, task_data in task_storage.items()
+                if task_data.get("status") == status][:limit]
+    return {
+        "success": True,
+        "status": status,
+        "count": len(task_ids),
+        "tasks": [{"task_id": task_id} for task_id in task_ids],
+    }
+
+
+@app.get("/dead-letter")
+async def list_dead_letter(limit: int = 50):
+    """
+    查看死信队列（失败次数超过 TASK_MAX_ATTEMPTS 的任务），最近放入的在前
+    """
+    if not redis_client:
+        raise HTTPException(status_code=503, detail="Redis 不可用")
+    limit = max(1, min(limit, 1000))
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.lrange(DEAD_LETTER_KEY, 0, limit - 1)
+            pipe.llen(DEAD_LETTER_KEY)
+            raw_entries, total = await timed_redis("dead_letter", pipe.execute())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"读取死信队列失败: {str(e)}")
+    
+    entries = []
+    for raw in raw_entries:
+        try:
+            entry = json.loads(raw)
+            task = json.loads(entry.get("task") or "null")
+        except (TypeError, ValueError):
+            entries.append({"raw": raw})
+            continue
+        failed_at = entry.get("failed_at")
+        entries.append({
+            "task_id": task.get("task_id") if isinstance(task, dict) else None,
+            "task_type": task.get("task_type") if isinstance(task, dict) else None,
+            "error": entry.get("error"),
+            "attempts": entry.get("attempts"),
+            "failed_at": datetime.fromtimestamp(failed_at).isoformat() if failed_at else None,
+            "task": task,
+        })
+    return {"success": True, "total": total, "count": len(entries), "entries": entries}
+
+
 @app.get("/task/{task_id}")
 async def get_task_status(task_id: str):
     """
@@ -364,13 +1397,13 @@ async def simulate_task_processing(task_id: str, task_type: str):
     await asyncio.sleep(3)  # 模拟处理时间
     
     # 获取任务信息
-    task_data = get_task_info(task_id)
+    task_data = await get_task_info(task_id)
     if not task_data:
         return
     
     # 更新任务状态为处理中
     task_data["status"] = "processing"
-    store_task_info(task_id, task_data)
+    await store_task_and_publish(task_id, {"status": "processing"}, {"status": "processing"})
     
     # 模拟处理：复制示例图片作为处理结果
     # 实际应该从Redis队列读取任务，进行AI处理，然后保存结果
@@ -380,16 +1413,18 @@ async def simulate_task_processing(task_id: str, task_type: str):
             example_image_path = os.path.join('example', 'empty_room.jpg')
             if os.path.exists(example_image_path):
                 processed_filename = f"{task_id}_processed.jpg"
-                processed_path = os.path.join(OUTPUT_FOLDER, processed_filename)
+                processed_path = artifact_path(OUTPUT_FOLDER, processed_filename)
                 
                 # 复制示例图片到输出目录
                 shutil.copy2(example_image_path, processed_path)
+                await publish_artifact(OUTPUT_FOLDER, processed_filename)
                 
                 # 更新任务数据
                 task_data["status"] = "completed"
                 task_data["processed_url"] = f"/output/{processed_filename}"
                 task_data["completed_at"] = datetime.now().isoformat()
-                store_task_info(task_id, task_data)
+                await store_task_and_publish(task_id, task_data, {"status": "completed"})
+                await save_cached_result(task_data)
                 
                 print(f"✓ 任务 {task_id} 处理完成，结果图片: {processed_filename}")
         else:
@@ -398,10 +1433,11 @@ async def simulate_task_processing(task_id: str, task_type: str):
             example_room_path = os.path.join('example', 'decorate_room.png')
             if os.path.exists(example_room_path):
                 processed_filename = f"{task_id}_staged.png"
-                processed_path = os.path.join(OUTPUT_FOLDER, processed_filename)
+                processed_path = artifact_path(OUTPUT_FOLDER, processed_filename)
                 
                 # 复制示例图片到输出目录
                 shutil.copy2(example_room_path, processed_path)
+                await publish_artifact(OUTPUT_FOLDER, processed_filename)
                 
                 # 复制家具列表 JSON
                 example_selection_path = os.path.join('example', 'selection.json')
@@ -419,8 +1455,9 @@ async def simulate_task_processing(task_id: str, task_type: str):
                             furniture_image_path = os.path.join(example_dir, f"{model_id}.png")
                             if os.path.exists(furniture_image_path):
                                 furniture_filename = f"{task_id}_{model_id}.png"
-                                furniture_output_path = os.path.join(OUTPUT_FOLDER, furniture_filename)
+                                furniture_output_path = artifact_path(OUTPUT_FOLDER, furniture_filename)
                                 shutil.copy2(furniture_image_path, furniture_output_path)
+                                await publish_artifact(OUTPUT_FOLDER, furniture_filename)
                                 
                                 furniture_images.append({
                                     "model_id": model_id,
@@ -433,41 +1470,111 @@ async def simulate_task_processing(task_id: str, task_type: str):
                 task_data["furniture_list"] = furniture_list
                 task_data["furniture_images"] = furniture_images
                 task_data["completed_at"] = datetime.now().isoformat()
-                store_task_info(task_id, task_data)
+                await store_task_and_publish(task_id, task_data, {"status": "completed"})
+                await save_cached_result(task_data)
                 
                 print(f"✓ 任务 {task_id} 处理完成，结果图片: {processed_filename}")
             else:
                 # 如果没有示例图片，则复制原图
                 original_path = task_data.get("original_path")
                 if original_path and os.path.exists(original_path):
-                    img = Image.open(original_path)
                     processed_filename = f"{task_id}_staged.jpg"
-                    processed_path = os.path.join(OUTPUT_FOLDER, processed_filename)
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
-                    img.save(processed_path, 'JPEG', quality=95)
+                    processed_path = artifact_path(OUTPUT_FOLDER, processed_filename)
+                    await image_pool.run("reencode_jpeg", reencode_jpeg, original_path, processed_path)
+                    await publish_artifact(OUTPUT_FOLDER, processed_filename)
                     
                     task_data["status"] = "completed"
                     task_data["processed_url"] = f"/output/{processed_filename}"
                     task_data["completed_at"] = datetime.now().isoformat()
-                    store_task_info(task_id, task_data)
+                    await store_task_and_publish(task_id, task_data, {"status": "completed"})
+                    await save_cached_result(task_data)
                     
                     print(f"✓ 任务 {task_id} 处理完成，结果图片: {processed_filename}")
                 else:
                     task_data["status"] = "failed"
                     task_data["error"] = "无法找到原始图片或示例图片"
-                    store_task_info(task_id, task_data)
+                    await store_task_and_publish(task_id, task_data, {"status": "failed", "error": task_data["error"]})
     except Exception as e:
         print(f"✗ 处理任务 {task_id} 失败: {e}")
         task_data["status"] = "failed"
         task_data["error"] = str(e)
-        store_task_info(task_id, task_data)
+        await store_task_and_publish(task_id, task_data, {"status": "failed", "error": str(e)})
+
+
+def build_task_result(task_data: dict) -> dict:
+    """
+    根据任务数据构建结果响应（轮询接口与 SSE 推送共用）
+    
+    Args:
+        task_data: 任务数据字典
+    
+    Returns:
+        dict: 响应数据
+    """
+    task_id = task_data.get("task_id")
+    task_status = task_data.get("status", "unknown")
+    task_type = task_data.get("task_type")
+    
+    # 如果任务已完成，返回处理后的图片URL
+    if task_status == "completed":
+        processed_url = task_data.get("processed_url")
+        if not processed_url:
+            return {
+                "success": False,
+                "status": "completed_no_result",
+                "error": "处理完成但未找到结果图片"
+            }
+        
+        response_data = {
+            "success": True,
+            "status": "completed",
+            "task_id": task_id,
+            "processed_url": processed_url,
+            "original_url": task_data.get("original_url")
+        }
+        
+        # 如果是虚拟布置任务，添加家具列表和图片信息
+        if task_type == "virtual":
+            furniture_list = task_data.get("furniture_list", [])
+            furniture_images = task_data.get("furniture_images", [])
+            
+            if furniture_list:
+                response_data["furniture_list"] = furniture_list
+            if furniture_images:
+                response_data["furniture_images"] = furniture_images
+        
+        return response_data
+    
+    # 如果任务失败
+    if task_status == "failed":
+        return {
+            "success": False,
+            "status": "failed",
+            "error": task_data.get("error", "处理失败")
+        }
+    
+    # 如果任务仍在处理中
+    if task_status == "processing":
+        return {
+            "success": True,
+            "status": "processing",
+            "task_id": task_id,
+            "message": "任务处理中，请稍候..."
+        }
+    
+    # 其他状态
+    return {
+        "success": True,
+        "status": task_status,
+        "task_id": task_id,
+        "message": "等待处理..."
+    }
 
 
 @app.get("/task/{task_id}/result")
 async def get_task_result(task_id: str, background_tasks: BackgroundTasks):
     """
-    获取任务处理结果（轮询接口）
+    获取任务处理结果（轮询接口，SSE 不可用时的备用方案）
     
     流程:
     1. 从Redis或存储中获取任务信息
@@ -478,7 +1585,7 @@ async def get_task_result(task_id: str, background_tasks: BackgroundTasks):
     """
     try:
         # 获取任务信息
-        task_data = get_task_info(task_id)
+        task_data = await get_task_info(task_id)
         if not task_data:
             return JSONResponse({
                 "success": False,
@@ -490,59 +1597,13 @@ async def get_task_result(task_id: str, background_tasks: BackgroundTasks):
         task_type = task_data.get("task_type")
         
         # 如果任务已加入队列但未开始处理，启动后台处理任务
-        if task_status == "queued":
+        # （只用于没有 Worker 的内存模式；Redis 模式下 queued 也可能是等待重试的任务，由 Worker 处理）
+        if task_status == "queued" and redis_client is None:
             # 启动后台处理任务（模拟从Redis队列读取并处理）
             background_tasks.add_task(simulate_task_processing, task_id, task_type)
-            # 更新状态为处理中
+            # 更新状态为处理中（只写 status 字段）
             task_data["status"] = "processing"
-            store_task_info(task_id, task_data)
-            return JSONResponse({
-                "success": True,
-                "status": "processing",
-                "task_id": task_id,
-                "message": "任务处理中，请稍候..."
-            })
-        
-        # 如果任务已完成，返回处理后的图片URL
-        if task_status == "completed":
-            processed_url = task_data.get("processed_url")
-            if processed_url:
-                response_data = {
-                    "success": True,
-                    "status": "completed",
-                    "task_id": task_id,
-                    "processed_url": processed_url,
-                    "original_url": task_data.get("original_url")
-                }
-                
-                # 如果是虚拟布置任务，添加家具列表和图片信息
-                if task_type == "virtual":
-                    furniture_list = task_data.get("furniture_list", [])
-                    furniture_images = task_data.get("furniture_images", [])
-                    
-                    if furniture_list:
-                        response_data["furniture_list"] = furniture_list
-                    if furniture_images:
-                        response_data["furniture_images"] = furniture_images
-                
-                return JSONResponse(response_data)
-            else:
-                return JSONResponse({
-                    "success": False,
-                    "status": "completed_no_result",
-                    "error": "处理完成但未找到结果图片"
-                })
-        
-        # 如果任务失败
-        elif task_status == "failed":
-            return JSONResponse({
-                "success": False,
-                "status": "failed",
-                "error": task_data.get("error", "处理失败")
-            })
-        
-        # 如果任务仍在处理中
-        elif task_status == "processing":
+            await store_task_info(task_id, {"status": "processing"})
             return JSONResponse({
                 "success": True,
                 "status": "processing",
@@ -550,14 +1611,7 @@ async def get_task_result(task_id: str, background_tasks: BackgroundTasks):
                 "message": "任务处理中，请稍候..."
             })
         
-        # 其他状态
-        else:
-            return JSONResponse({
-                "success": True,
-                "status": task_status,
-                "task_id": task_id,
-                "message": "等待处理..."
-            })
+        return JSONResponse(build_task_result(task_data))
             
     except Exception as e:
         return JSONResponse({
@@ -567,6 +1621,112 @@ async def get_task_result(task_id: str, background_tasks: BackgroundTasks):
         }, status_code=500)
 
 
+def format_sse(event_type: str, data: dict) -> str:
+    """格式化一条 SSE 消息"""
+    return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.on_event("startup")
+async def start_task_event_relay():
+    """Redis 可用时启动进程级任务事件订阅"""
+    global task_event_relay
+    if redis_client is not None:
+        task_event_relay = asyncio.create_task(relay_task_events())
+
+
+async def iter_task_messages(task_id: str):
+    """
+    订阅任务事件，逐条产出事件字典；超过心跳间隔没有事件时产出 None
+    
+    事件来自本进程的订阅队列（Redis 可用时由 relay_task_events 分发，否则由 publish_task_event 直接投递）
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    task_event_subscribers.setdefault(task_id, set()).add(queue)
+    try:
+        # 订阅成功后先产出一次 None，调用方借此读取当前状态，避免漏掉订阅前的状态变化
+        yield None
+        while True:
+            try:
+                yield await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield None
+    finally:
+        subscribers = task_event_subscribers.get(task_id)
+        if subscribers is not None:
+            subscribers.discard(queue)
+            if not subscribers:
+                task_event_subscribers.pop(task_id, None)
+
+
+@app.get("/task/{task_id}/events")
+async def task_events(task_id: str, request: Request):
+    """
+    任务进度推送（Server-Sent Events）
+    
+    事件类型:
+    - status: 任务状态变化（queued / processing / completed / failed）
+    - progress: 处理阶段进度（stage, progress）
+    - result: 任务结束时的最终结果（与 /task/{task_id}/result 的响应一致），随后连接关闭
+    """
+    task_data = await get_task_info(task_id)
+    if not task_data:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    
+    async def event_stream():
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SSE_MAX_DURATION
+        messages = iter_task_messages(task_id)
+        first = True
+        try:
+            async for message in messages:
+                if await request.is_disconnected() or loop.time() > deadline:
+                    break
+                
+                if first:
+                    # 订阅建立后立即发送当前状态
+                    first = False
+                    current = await get_task_info(task_id) or task_data
+                    status = current.get("status", "unknown")
+                    if status in TERMINAL_STATUSES:
+                        yield format_sse("result", build_task_result(current))
+                        break
+                    if status == "queued" and redis_client is None:
+                        # 内存模式没有 Worker，沿用轮询接口的模拟处理
+                        current["status"] = "processing"
+                        await store_task_info(task_id, {"status": "processing"})
+                        job = asyncio.create_task(simulate_task_processing(task_id, current.get("task_type")))
+                        background_jobs.add(job)
+                        job.add_done_callback(background_jobs.discard)
+                        status = "processing"
+                    yield format_sse("status", {"task_id": task_id, "status": status})
+                    continue
+                
+                if message is None:
+                    # 心跳，防止代理断开空闲连接
+                    yield ": keep-alive\n\n"
+                    continue
+                
+                event_type = message.pop("event", "status")
+                yield format_sse(event_type, message)
+                
+                if message.get("status") in TERMINAL_STATUSES:
+                    current = await get_task_info(task_id)
+                    if current:
+                        yield format_sse("result", build_task_result(current))
+                    break
+        finally:
+            await messages.aclose()
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+
+
 @app.options("/uploads/{filename}")
 async def options_upload(filename: str):
     """处理上传文件的 OPTIONS 预检请求"""
@@ -581,36 +1741,86 @@ async def options_upload(filename: str):
     )
 
 
-@app.get("/uploads/{filename}")
-async def get_upload(filename: str):
-    """获取上传的原始图片"""
-    file_path = os.path.join(UPLOAD_FOLDER, filename)
-    if not os.path.exists(file_path):
+async def stream_artifact(key: str, filename: str) -> Response:
+    """流式返回对象存储中的产物（不支持 Range / 条件请求）"""
+    try:
+        body = await asyncio.to_thread(storage.open_read, key)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="文件不存在")
     
-    # 读取文件内容
-    with open(file_path, "rb") as f:
-        file_content = f.read()
+    def chunks():
+        try:
+            while True:
+                chunk = body.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
     
-    # 确定媒体类型
-    if filename.endswith('.jpg') or filename.endswith('.jpeg'):
-        media_type = "image/jpeg"
-    elif filename.endswith('.png'):
-        media_type = "image/png"
-    else:
-        media_type = "application/octet-stream"
+    # 同步迭代器由 StreamingResponse 在线程池中读取
+    return StreamingResponse(chunks(), media_type=guess_media_type(filename), headers=CORS_HEADERS)
+
+
+async def serve_image(request: Request, folder: str, filename: str,
+                      w: Optional[int], fmt: Optional[str]) -> Response:
+    """
+    返回原图或其衍生版本（指定 w / fmt 时按需生成并缓存）
     
-    # 返回响应，手动设置 CORS 头
-    return Response(
-        content=file_content,
-        media_type=media_type,
-        headers={
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "GET, OPTIONS",
-            "Access-Control-Allow-Headers": "*",
-            "Content-Disposition": f'inline; filename="{filename}"',
-        }
-    )
+    Args:
+        request: 当前请求
+        folder: 原图所在目录
+        filename: 原图文件名
+        w: 目标宽度（向上取整到缓存档位，不放大）
+        fmt: 输出格式（webp / jpeg / png），默认与原图一致
+    """
+    if w is None and fmt is None:
+        # 对象存储支持预签名 URL 时重定向过去，产物字节不经过 API 进程
+        if storage.remote and filename and os.path.basename(filename) == filename:
+            key = storage_key(folder, filename)
+            url = storage.presigned_url(key)
+            if url:
+                return RedirectResponse(url, status_code=307, headers=CORS_HEADERS)
+            if not storage.is_cached(key):
+                # 本地没有缓存时直接转发对象存储的响应流，不先下载完整文件
+                return await stream_artifact(key, filename)
+        await fetch_artifact(folder, filename)
+        return serve_file(request, folder, filename, sharded=True)
+    
+    if fmt is not None:
+        fmt = fmt.lower()
+        if fmt not in DERIVATIVE_FORMATS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"不支持的格式: {fmt}。支持的格式: {', '.join(DERIVATIVE_FORMATS)}"
+            )
+    if w is not None and w <= 0:
+        raise HTTPException(status_code=400, detail="宽度必须为正整数")
+    
+    await fetch_artifact(folder, filename)
+    source_path, _ = resolve_file(folder, filename, sharded=True)
+    if not guess_media_type(filename).startswith("image/"):
+        raise HTTPException(status_code=400, detail="只有图片文件支持缩略图")
+    if fmt is None:
+        ext = os.path.splitext(filename)[1].lower().lstrip('.')
+        fmt = ext if ext in DERIVATIVE_FORMATS else "png"
+    width = snap_width(w) if w is not None else None
+    
+    try:
+        variant = await derivative_cache.get(source_path, width, fmt)
+    except (ImagePoolBusy, asyncio.TimeoutError):
+        # 图片工作池繁忙时退回原图，不让缩略图请求排队
+        return serve_file(request, folder, filename, sharded=True)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"生成缩略图失败: {str(e)}")
+    return serve_file(request, derivative_cache.cache_dir, variant)
+
+
+@app.get("/uploads/{filename}")
+async def get_upload(filename: str, request: Request,
+                     w: Optional[int] = None, fmt: Optional[str] = None):
+    """获取上传的原始图片（支持 Range、条件请求，以及 ?w=480&fmt=webp 缩略图）"""
+    return await serve_image(request, UPLOAD_FOLDER, filename, w, fmt)
 
 
 @app.options("/output/{filename}")
@@ -628,35 +1838,10 @@ async def options_output(filename: str):
 
 
 @app.get("/output/{filename}")
-async def get_output(filename: str):
-    """获取处理后的图片"""
-    file_path = os.path.join(OUTPUT_FOLDER, filename)
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="文件不存在")
-    
-    # 读取文件内容
-    with open(file_path, "rb") as f:
-        file_content = f.read()
-    
-    # 确定媒体类型
-    if filename.endswith('.jpg') or filename.endswith('.jpeg'):
-        media_type = "image/jpeg"
-    elif filename.endswith('.png'):
-        media_type = "image/png"
-    else:
-        media_type = "application/octet-stream"
-    
-    # 返回响应，手动设置 CORS 头
-    return Response(
-        content=file_content,
-        media_type=media_type,
-        headers={
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "GET, OPTIONS",
-            "Access-Control-Allow-Headers": "*",
-            "Content-Disposition": f'inline; filename="{filename}"',
-        }
-    )
+async def get_output(filename: str, request: Request,
+                     w: Optional[int] = None, fmt: Optional[str] = None):
+    """获取处理后的图片（支持 Range、条件请求，以及 ?w=480&fmt=webp 缩略图）"""
+    return await serve_image(request, OUTPUT_FOLDER, filename, w, fmt)
 
 
 if __name__ == "__main__":
@@ -668,6 +1853,7 @@ if __name__ == "__main__":
     print("=" * 60)
     print(f"访问 http://localhost:{PORT}/docs 查看 API 文档")
     print(f"访问 http://localhost:{PORT}/health 检查服务状态")
+    print(f"访问 http://localhost:{PORT}/metrics 查看监控指标")
     print(f"Redis 配置: {REDIS_HOST}:{REDIS_PORT}")
     print("=" * 60)
     uvicorn.run(app, host="0.0.0.0", port=PORT, log_level="info")
@@ -0,0 +1,202 @@
+"""
+任务产物的目录分片与过期清理（api_server.py 与 worker_server.py 共用）
+
+- 产物文件名以 task_id 开头，保存在 {root}/{task_id[0:2]}/{task_id[2:4]}/ 下，避免单个目录文件过多
+- URL 保持 /uploads/{filename}、/output/{filename} 不变，读取时按文件名定位分片目录
+- 分片之前的旧文件仍在根目录下，读取时回退到根目录
+- ArtifactGC 增量扫描产物目录，删除任务记录已过期的文件，并统计释放的字节数
+- 被结果缓存引用的任务通过 artifact_hold:{task_id} 延长产物保留时间
+"""
+
+import asyncio
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Iterable, Iterator, List, Optional, Set, Tuple
+
+from metrics import Counter
+
+ARTIFACT_SHARD_DEPTH = int(os.getenv("ARTIFACT_SHARD_DEPTH", 2))
+ARTIFACT_SHARD_WIDTH = 2
+
+# 清理配置：每批检查的文件数、批次间隔（秒）、文件最小保留时间（秒）
+ARTIFACT_GC_BATCH_SIZE = int(os.getenv("ARTIFACT_GC_BATCH_SIZE", 200))
+ARTIFACT_GC_INTERVAL = float(os.getenv("ARTIFACT_GC_INTERVAL", 5))
+ARTIFACT_GC_MIN_AGE = int(os.getenv("ARTIFACT_GC_MIN_AGE", 3600))
+
+GC_DELETED = Counter("artifact_gc_deleted_files_total", "产物清理删除的文件数")
+GC_RECLAIMED = Counter("artifact_gc_reclaimed_bytes_total", "产物清理释放的字节数")
+
+TASK_ID_LENGTH = 36
+
+# 结果缓存引用的源任务：task_id -> 标记，过期时间与结果缓存一致，期间产物不会被清理
+ARTIFACT_HOLD_PREFIX = "artifact_hold:"
+
+
+def task_id_from_filename(filename: str) -> Optional[str]:
+    """从产物文件名中解析 task_id（文件名以 UUID 开头），无法解析返回 None"""
+    candidate = filename[:TASK_ID_LENGTH]
+    try:
+        uuid.UUID(candidate)
+    except ValueError:
+        return None
+    return candidate
+
+
+def shard_dir(root: str, filename: str) -> str:
+    """产物文件所在的分片目录"""
+    parts = [filename[i * ARTIFACT_SHARD_WIDTH:(i + 1) * ARTIFACT_SHARD_WIDTH]
+             for i in range(ARTIFACT_SHARD_DEPTH)]
+    return os.path.join(root, *parts)
+
+
+def artifact_path(root: str, filename: str) -> str:
+    """
+    获取新产物的保存路径（自动创建分片目录）
+
+    Args:
+        root: 产物根目录（uploads / output）
+        filename: 以 task_id 开头的文件名
+
+    Returns:
+        str: 文件路径
+    """
+    directory = shard_dir(root, filename)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
+
+
+def locate_artifact(root: str, filename: str) -> Optional[str]:
+    """
+    定位已有产物（先查分片目录，再查根目录下的旧文件）
+
+    Returns:
+        str: 文件路径，不存在返回 None
+    """
+    for candidate in (os.path.join(shard_dir(root, filename), filename), os.path.join(root, filename)):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def _walk_files(root: str) -> Iterator[os.DirEntry]:
+    """按目录逐层遍历产物文件（生成器，可分批消费）"""
+    if not os.path.isdir(root):
+        return
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+class ArtifactGC:
+    """
+    增量产物清理
+
+    每次 step() 最多检查 batch_size 个文件，对应任务记录已不存在、且文件存在时间超过
+    min_age 的文件会被删除；一轮扫描结束后从头开始。
+    """
+
+    def __init__(self, roots: Iterable[str],
+                 tasks_exist: Callable[[List[str]], Awaitable[Set[str]]],
+                 batch_size: int = ARTIFACT_GC_BATCH_SIZE, min_age: int = ARTIFACT_GC_MIN_AGE):
+        self.roots = list(roots)
+        self.tasks_exist = tasks_exist
+        self.batch_size = batch_size
+        self.min_age = min_age
+        self._walker: Optional[Iterator[os.DirEntry]] = None
+        # 当前一轮扫描的统计
+        self.pass_deleted = 0
+        self.pass_reclaimed = 0
+
+    def _iter_all(self) -> Iterator[os.DirEntry]:
+        for root in self.roots:
+            yield from _walk_files(root)
+
+    def _scan_batch(self) -> Tuple[List[Tuple[str, str, int]], bool]:
+        """
+        取下一批文件，筛选出超过最小保留时间的产物
+
+        Returns:
+            tuple: ([(路径, task_id, 大小)], 本轮是否已扫描完)
+        """
+        if self._walker is None:
+            self._walker = self._iter_all()
+        now = time.time()
+        candidates = []
+        checked = 0
+        for entry in self._walker:
+            checked += 1
+            task_id = task_id_from_filename(entry.name)
+            if task_id is not None:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    st = None
+                # 复制的文件保留了源文件的 mtime，以 ctime 为准判断文件的实际写入时间
+                if st is not None and now - max(st.st_mtime, st.st_ctime) >= self.min_age:
+                    candidates.append((entry.path, task_id, st.st_size))
+            if checked >= self.batch_size:
+                return candidates, False
+        self._walker = None
+        return candidates, True
+
+    @staticmethod
+    def _delete(files: List[Tuple[str, str, int]]) -> Tuple[int, int]:
+        """删除文件，返回 (删除的文件数, 释放的字节数)"""
+        deleted = reclaimed = 0
+        for path, _, size in files:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            deleted += 1
+            reclaimed += size
+        return deleted, reclaimed
+
+    async def step(self) -> Tuple[int, int, bool]:
+        """
+        检查一批文件并删除过期产物（文件系统操作在线程中执行）
+
+        Returns:
+            tuple: (删除的文件数, 释放的字节数, 本轮是否已扫描完)
+        """
+        candidates, finished = await asyncio.to_thread(self._scan_batch)
+        deleted = reclaimed = 0
+        if candidates:
+            # 查询失败时抛出异常，本批不删除任何文件
+            alive = await self.tasks_exist(sorted({task_id for _, task_id, _ in candidates}))
+            expired = [item for item in candidates if item[1] not in alive]
+            if expired:
+                deleted, reclaimed = await asyncio.to_thread(self._delete, expired)
+
+        GC_DELETED.inc(deleted)
+        GC_RECLAIMED.inc(reclaimed)
+        self.pass_deleted += deleted
+        self.pass_reclaimed += reclaimed
+        return deleted, reclaimed, finished
+
+    async def run(self, interval: float = ARTIFACT_GC_INTERVAL) -> None:
+        """后台循环：每隔 interval 秒检查一批，每轮结束时打印统计"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                _, _, finished = await self.step()
+            except Exception as e:
+                print(f"⚠ 产物清理失败: {e}")
+                continue
+            if finished:
+                if self.pass_deleted:
+                    print(f"✓ 产物清理完成一轮: 删除 {self.pass_deleted} 个文件，"
+                          f"释放 {self.pass_reclaimed / (1024 * 1024):.1f} MB")
+                self.pass_deleted = 0
+                self.pass_reclaimed = 0
@@ -0,0 +1,283 @@
+"""
+扩散模型调用的动态微批处理（Worker 进程内共享）
+
+各阶段每个任务单独调用 batch=1 的 pipeline。Worker 并发处理多个任务时，分辨率、步数等参数相同的
+请求可以合并为一次 batch 调用，共享每一步的前向计算:
+
+- 相同模型 + 相同共享参数 + 相同输入尺寸的请求视为兼容，进入同一个批次
+- 第一个请求到达后最多等待 DIFFUSION_BATCH_WINDOW_MS 毫秒，批次凑满 DIFFUSION_MAX_BATCH 个时立即执行
+- 批次在单独的线程中依次执行（同一设备上不并行），结果按请求拆分返回给各任务线程
+- 合并调用失败时（例如显存不足）逐个重试，一个请求的错误不影响同批的其他请求
+- 同一个 pipeline（及其 scheduler）不是线程安全的，每个模型的调用由一把锁串行化
+- pipeline 在 CUDA 上时与 rcsd 的直接调用一样在 torch.autocast("cuda") 下执行
+
+只有线程工作池（WORKER_POOL_KIND=thread）且并发数大于 1 时，多个任务的请求才可能合并。
+DIFFUSION_MAX_BATCH=1 时不合并，直接在调用线程中执行。
+"""
+
+import os
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from metrics import Counter, Histogram
+from model_manager import ModelManager
+
+DIFFUSION_MAX_BATCH = max(1, int(os.getenv("DIFFUSION_MAX_BATCH", 4)))
+DIFFUSION_BATCH_WINDOW_MS = float(os.getenv("DIFFUSION_BATCH_WINDOW_MS", 50))
+
+# diffusers pipeline 中可以按请求传入列表的参数，其余参数必须在同一批次内相同
+PER_REQUEST_FIELDS = ("prompt", "negative_prompt", "image", "mask_image", "control_image", "generator")
+
+BATCH_SIZE = Histogram("diffusion_batch_size", "扩散模型每次调用合并的请求数", buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+BATCH_WAIT = Histogram("diffusion_batch_wait_seconds", "请求从提交到所在批次开始执行的等待时间（秒）",
+                       buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+BATCH_DURATION = Histogram("diffusion_batch_duration_seconds", "扩散模型批次的执行耗时（秒）",
+                           buckets=(0.5, 1, 2.5, 5, 10, 20, 40, 80, 160))
+BATCH_FALLBACKS = Counter("diffusion_batch_fallbacks_total", "合并调用失败后逐个重试的批次数")
+
+
+class BatchRequest:
+    """等待批次执行的单个请求"""
+
+    def __init__(self, inputs: Any):
+        self.inputs = inputs
+        self.submitted = time.perf_counter()
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class MicroBatcher:
+    """
+    按兼容键收集请求，在时间窗口内凑批后一次执行
+
+    Args:
+        runner: 执行函数 runner(key, [inputs, ...]) -> [result, ...]，结果与输入一一对应
+        max_batch: 每批最多的请求数
+        window: 第一个请求到达后最多等待的秒数
+        name: 指标中的名称
+    """
+
+    def __init__(self, runner: Callable[[Hashable, List[Any]], List[Any]],
+                 max_batch: int = DIFFUSION_MAX_BATCH, window: float = DIFFUSION_BATCH_WINDOW_MS / 1000,
+                 name: str = "default"):
+        self.runner = runner
+        self.max_batch = max(1, max_batch)
+        self.window = max(0.0, window)
+        self.name = name
+        self.cond = threading.Condition()
+        # 兼容键 -> (截止时间, 等待中的请求)
+        self.pending: Dict[Hashable, Tuple[float, List[BatchRequest]]] = {}
+        self.closed = False
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, key: Hashable, inputs: Any) -> Any:
+        """
+        提交请求并阻塞等待结果
+
+        Args:
+            key: 兼容键，相同键的请求才会合并
+            inputs: 传给 runner 的单个请求输入
+
+        Returns:
+            该请求的结果（runner 抛出的异常在这里重新抛出）
+        """
+        return self.submit_many([(key, inputs)])[0]
+
+    def submit_many(self, items: List[Tuple[Hashable, Any]]) -> List[Any]:
+        """
+        一次提交多个请求（同一调用方的请求也可以互相合并）并阻塞等待全部结果
+
+        Args:
+            items: [(兼容键, 请求输入), ...]
+
+        Returns:
+            list: 与 items 一一对应的结果（任一请求失败时抛出其异常）
+        """
+        requests = [(key, BatchRequest(inputs)) for key, inputs in items]
+        if self.max_batch == 1:
+            for key, request in requests:
+                self._run_batch(key, [request])
+        else:
+            with self.cond:
+                if self.closed:
+                    raise RuntimeError("批处理器已关闭")
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._loop, name=f"batcher-{self.name}", daemon=True)
+                    self._thread.start()
+                for key, request in requests:
+                    _, pending = self.pending.setdefault(key, (time.monotonic() + self.window, []))
+                    pending.append(request)
+                self.cond.notify_all()
+
+        results = []
+        for _, request in requests:
+            request.done.wait()
+            if request.error is not None:
+                raise request.error
+            results.append(request.result)
+        return results
+
+    def _next_batch(self) -> Optional[Tuple[Hashable, List[BatchRequest]]]:
+        """取出下一个可以执行的批次（已凑满或已到截止时间，先到期的优先），调用方需持有 self.cond"""
+        now = time.monotonic()
+        ready = [(deadline, key) for key, (deadline, requests) in self.pending.items()
+                 if len(requests) >= self.max_batch or deadline <= now or self.closed]
+        if not ready:
+            return None
+        _, key = min(ready, key=lambda item: item[0])
+        deadline, requests = self.pending.pop(key)
+        batch, rest = requests[:self.max_batch], requests[self.max_batch:]
+        if rest:
+            # 超出本批上限的请求立即进入下一批
+            self.pending[key] = (now, rest)
+        return key, batch
+
+    def _loop(self) -> None:
+        while True:
+            with self.cond:
+                item = self._next_batch()
+                while item is None:
+                    if self.closed and not self.pending:
+                        return
+                    timeout = None
+                    if self.pending:
+                        timeout = max(0.0, min(deadline for deadline, _ in self.pending.values()) - time.monotonic())
+                    self.cond.wait(timeout)
+                    item = self._next_batch()
+            key, batch = item
+            self._run_batch(key, batch)
+
+    def _run_batch(self, key: Hashable, batch: List[BatchRequest]) -> None:
+        """执行一个批次并把结果分发给各请求；合并调用失败时逐个重试"""
+        started = time.perf_counter()
+        for request in batch:
+            BATCH_WAIT.observe(started - request.submitted, batcher=self.name)
+        BATCH_SIZE.observe(len(batch), batcher=self.name)
+        try:
+            results = self.runner(key, [request.inputs for request in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"批次返回 {len(results)} 个结果，应为 {len(batch)} 个")
+            for request, result in zip(batch, results):
+                request.result = result
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = e
+            else:
+                print(f"⚠ 合并调用失败（{len(batch)} 个请求），逐个重试: {e}")
+                BATCH_FALLBACKS.inc(batcher=self.name)
+                for request in batch:
+                    try:
+                        request.result = self.runner(key, [request.inputs])[0]
+                    except Exception as single_error:
+                        request.error = single_error
+        finally:
+            BATCH_DURATION.observe(time.perf_counter() - started, batcher=self.name)
+            for request in batch:
+                request.done.set()
+
+    def close(self) -> None:
+        """执行完已提交的请求后停止批处理线程"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def _freeze(value: Any) -> Hashable:
+    """
+    把共享参数转换为可作为兼容键的值
+
+    不可哈希的对象（ndarray、PIL 图片等）按对象身份比较：只有传入同一个对象的请求才会合并。
+    请求等待期间调用方持有该对象，id 不会被复用。
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return ("<id>", type(value).__name__, id(value))
+    return value
+
+
+def _autocast(pipe: Any):
+    """pipeline 在 CUDA 上时返回 torch.autocast("cuda")，否则返回空上下文"""
+    if not str(getattr(pipe, "device", "")).startswith("cuda"):
+        return nullcontext()
+    import torch
+    return torch.autocast("cuda")
+
+
+class DiffusionBatcher:
+    """
+    diffusers pipeline 的微批处理（模型由 ModelManager 提供）
+
+    用法:
+        image = diffusion.generate("sd_inpaint", prompt=..., image=..., mask_image=...,
+                                   num_inference_steps=50, guidance_scale=7.5)
+    """
+
+    def __init__(self, models: ModelManager, max_batch: int = DIFFUSION_MAX_BATCH,
+                 window_ms: float = DIFFUSION_BATCH_WINDOW_MS):
+        self.models = models
+        self.batcher = MicroBatcher(self._run, max_batch, window_ms / 1000, name="diffusion")
+        # 模型名 -> 锁：DIFFUSION_MAX_BATCH=1 时调用在各任务线程中执行，同一个 pipeline 不能并发调用
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def generate(self, model_name: str, **kwargs) -> Any:
+        """
+        调用 pipeline 生成一张图片（可能与其他任务的请求合并为一个批次）
+
+        Args:
+            model_name: ModelManager 中登记的 pipeline 名
+            **kwargs: pipeline 参数；prompt / image / mask_image 等按请求传入，
+                      num_inference_steps / guidance_scale 等在同一批次内必须相同
+
+        Returns:
+            PIL.Image: 生成的图片
+        """
+        return self.generate_many(model_name, [kwargs])[0]
+
+    def generate_many(self, model_name: str, requests: List[Dict[str, Any]]) -> List[Any]:
+        """
+        一次提交多个生成请求（例如同一张图片的多个修复区域），兼容的请求合并为批次
+
+        Args:
+            model_name: ModelManager 中登记的 pipeline 名
+            requests: 每个请求的 pipeline 参数（同 generate 的 **kwargs）
+
+        Returns:
+            list: 与 requests 一一对应的图片
+        """
+        return self.batcher.submit_many([self._request(model_name, dict(kwargs)) for kwargs in requests])
+
+    @staticmethod
+    def _request(model_name: str, kwargs: Dict[str, Any]) -> Tuple[Hashable, Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """拆分为 (兼容键, (按请求传入的参数, 共享参数))"""
+        inputs = {field: kwargs.pop(field) for field in PER_REQUEST_FIELDS if kwargs.get(field) is not None}
+        kwargs.pop("num_images_per_prompt", None)
+        image = inputs.get("image")
+        size = getattr(image, "size", None)
+        return (model_name, size, tuple(sorted(inputs)), _freeze(kwargs)), (inputs, kwargs)
+
+    def _model_lock(self, model_name: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(model_name, threading.Lock())
+
+    def _run(self, key: Hashable, batch: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> List[Any]:
+        model_name, _, fields, _ = key
+        # 同一批次的共享参数相同（不可哈希的参数为同一对象），取第一个请求的原始参数
+        kwargs = dict(batch[0][1])
+        for field in fields:
+            kwargs[field] = [inputs[field] for inputs, _ in batch]
+        with self.models.use(model_name) as pipe, self._model_lock(model_name), _autocast(pipe):
+            return list(pipe(**kwargs).images)
+
+    def close(self) -> None:
+        self.batcher.close()
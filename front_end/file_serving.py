@@ -0,0 +1,228 @@
+"""
+静态文件服务 - 为 /uploads 与 /output 提供零拷贝文件响应
+
+支持:
+- sendfile / 分块流式传输（不把整个文件读入内存）
+- HTTP Range 单区间请求（206 / 416）
+- 强 ETag 与 If-None-Match / If-Modified-Since 条件请求（304）
+- 任务产物使用 Cache-Control: immutable
+"""
+
+import os
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Tuple
+
+import anyio
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+from artifacts import locate_artifact
+
+# 与原来手动设置的 CORS 头保持一致
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, OPTIONS",
+    "Access-Control-Allow-Headers": "*",
+}
+
+# 任务产物（文件名带 task_id）生成后不会再修改，可以长期缓存
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+DEFAULT_CACHE_CONTROL = "public, max-age=0, must-revalidate"
+
+STREAM_CHUNK_SIZE = 256 * 1024
+
+MEDIA_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".json": "application/json",
+}
+
+
+def guess_media_type(filename: str) -> str:
+    """根据扩展名确定媒体类型"""
+    ext = os.path.splitext(filename)[1].lower()
+    return MEDIA_TYPES.get(ext, "application/octet-stream")
+
+
+def resolve_file(directory: str, filename: str, sharded: bool = False) -> Tuple[str, os.stat_result]:
+    """
+    在指定目录中定位文件，拒绝路径穿越
+
+    Args:
+        directory: 根目录
+        filename: 请求的文件名
+        sharded: 是否为按 task_id 分片存放的任务产物（见 artifacts.py）
+
+    Returns:
+        tuple: (文件路径, stat 结果)
+
+    Raises:
+        HTTPException: 文件不存在时返回 404
+    """
+    if not filename or os.path.basename(filename) != filename or filename in (".", ".."):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    file_path = locate_artifact(directory, filename) if sharded else os.path.join(directory, filename)
+    if file_path is None:
+        raise HTTPException(status_code=404, detail="文件不存在")
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="文件不存在")
+    if not stat.S_ISREG(st.st_mode):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return file_path, st
+
+
+def make_etag(st: os.stat_result) -> str:
+    """根据修改时间和大小生成强 ETag（产物写入后不再修改）"""
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def _etag_matches(header_value: str, etag: str) -> bool:
+    """判断 If-None-Match 是否命中（弱比较，忽略 W/ 前缀）"""
+    if header_value.strip() == "*":
+        return True
+    for candidate in header_value.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """
+    判断条件请求是否可以返回 304
+
+    If-None-Match 存在时优先使用，否则比较 If-Modified-Since
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return False
+        return int(mtime) <= int(since)
+    return False
+
+
+def parse_range(range_header: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析单区间 Range 头
+
+    Args:
+        range_header: Range 请求头，如 "bytes=0-1023" / "bytes=-500" / "bytes=100-"
+        file_size: 文件大小
+
+    Returns:
+        tuple: (start, end)，end 为闭区间；多区间或格式不支持时返回 None（返回完整文件）
+
+    Raises:
+        ValueError: 区间不可满足（应返回 416）
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_str, sep, end_str = spec.strip().partition("-")
+    start_str, end_str = start_str.strip(), end_str.strip()
+    # 格式错误的 Range 按规范忽略
+    if not sep or not (start_str.isdigit() or start_str == ""):
+        return None
+    if not (end_str.isdigit() or end_str == "") or (start_str == "" and end_str == ""):
+        return None
+
+    if start_str == "":
+        # 后缀区间: 最后 N 个字节
+        suffix = int(end_str)
+        if suffix == 0:
+            raise ValueError("empty suffix range")
+        start = max(file_size - suffix, 0)
+        end = file_size - 1
+    else:
+        start = int(start_str)
+        end = min(int(end_str), file_size - 1) if end_str else file_size - 1
+    if start > end or start >= file_size:
+        raise ValueError("unsatisfiable range")
+    return start, end
+
+
+async def _iter_file_range(file_path: str, start: int, end: int):
+    """在线程中分块读取文件的指定区间"""
+    remaining = end - start + 1
+    async with await anyio.open_file(file_path, "rb") as f:
+        await f.seek(start)
+        while remaining > 0:
+            chunk = await f.read(min(STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def serve_file(request: Request, directory: str, filename: str, immutable: bool = True,
+               sharded: bool = False) -> Response:
+    """
+    返回文件响应（支持 Range、ETag、条件请求）
+
+    Args:
+        request: 当前请求
+        directory: 文件所在目录
+        filename: 文件名
+        immutable: 是否为不可变的任务产物
+        sharded: 是否为按 task_id 分片存放的任务产物
+
+    Returns:
+        Response: 200 / 206 / 304 / 416 响应
+    """
+    file_path, st = resolve_file(directory, filename, sharded)
+    etag = make_etag(st)
+    media_type = guess_media_type(filename)
+
+    headers = dict(CORS_HEADERS)
+    headers.update({
+        "ETag": etag,
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else DEFAULT_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    })
+
+    if is_not_modified(request, etag, st.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    headers["Content-Disposition"] = f'inline; filename="{filename}"'
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == etag):
+        try:
+            byte_range = parse_range(range_header, st.st_size)
+        except ValueError:
+            headers["Content-Range"] = f"bytes */{st.st_size}"
+            return Response(status_code=416, headers=headers)
+
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{st.st_size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(
+                _iter_file_range(file_path, start, end),
+                status_code=206,
+                media_type=media_type,
+                headers=headers,
+            )
+
+    # 完整文件：FileResponse 在服务器支持时使用 sendfile，否则分块读取
+    return FileResponse(
+        file_path,
+        media_type=media_type,
+        headers=headers,
+        stat_result=st,
+    )
@@ -0,0 +1,200 @@
+"""
+图片衍生版本缓存 - 按需生成缩略图 / WebP 并缓存在磁盘
+
+- 首次请求时生成指定宽度与格式的衍生图片，之后直接复用
+- 缓存总大小受 DERIVATIVE_CACHE_MAX_BYTES 限制，按最近最少使用（LRU）淘汰
+- 同一衍生版本的并发请求只会生成一次；生成在独立任务中进行，发起请求的客户端断开不影响其他等待者
+- 最近 DERIVATIVE_EVICT_GRACE 秒内被访问过的文件不会被淘汰，避免删除仍在发送中的文件
+"""
+
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import Dict, Optional
+
+from PIL import Image
+
+DERIVATIVE_CACHE_FOLDER = os.getenv("DERIVATIVE_CACHE_FOLDER", os.path.join("cache", "derivatives"))
+DERIVATIVE_CACHE_MAX_BYTES = int(os.getenv("DERIVATIVE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# 淘汰保护期（秒）：FileResponse 在返回后才打开文件，保护期内的文件即使超出上限也暂不删除
+DERIVATIVE_EVICT_GRACE = float(os.getenv("DERIVATIVE_EVICT_GRACE", 60))
+
+# 允许的宽度档位：请求宽度向上取整到最近的档位，避免缓存被任意宽度撑爆
+DERIVATIVE_WIDTHS = (160, 320, 480, 640, 960, 1280, 1920)
+
+# 支持的输出格式: fmt -> (PIL 格式, 扩展名, 保存参数)
+DERIVATIVE_FORMATS = {
+    "webp": ("WEBP", "webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "jpg", {"quality": 85, "optimize": True, "progressive": True}),
+    "jpg": ("JPEG", "jpg", {"quality": 85, "optimize": True, "progressive": True}),
+    "png": ("PNG", "png", {"optimize": True}),
+}
+
+
+def snap_width(width: int) -> int:
+    """将请求宽度向上取整到允许的档位"""
+    for candidate in DERIVATIVE_WIDTHS:
+        if width <= candidate:
+            return candidate
+    return DERIVATIVE_WIDTHS[-1]
+
+
+def render_derivative(src_path: str, dest_path: str, width: Optional[int], fmt: str) -> None:
+    """
+    生成衍生图片（CPU 密集，应在事件循环外执行）
+
+    Args:
+        src_path: 原图路径
+        dest_path: 衍生图片保存路径
+        width: 目标宽度（None 表示保持原尺寸，仅转码）
+        fmt: 输出格式键（见 DERIVATIVE_FORMATS）
+    """
+    pil_format, _, save_kwargs = DERIVATIVE_FORMATS[fmt]
+    with Image.open(src_path) as img:
+        if width and img.width > width:
+            height = max(1, round(img.height * width / img.width))
+            # JPEG 可在解码阶段直接缩小，减少内存与解码时间
+            img.draft("RGB", (width, height))
+            img = img.resize((width, height), Image.LANCZOS)
+        if pil_format == "JPEG" and img.mode != "RGB":
+            img = img.convert("RGB")
+        elif img.mode not in ("RGB", "RGBA", "L"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+
+        # 先写临时文件再原子替换，避免读到半成品
+        tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+        try:
+            img.save(tmp_path, pil_format, **save_kwargs)
+            os.replace(tmp_path, dest_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+class DerivativeCache:
+    """
+    磁盘上的衍生图片 LRU 缓存
+    """
+
+    def __init__(self, cache_dir: str = DERIVATIVE_CACHE_FOLDER, max_bytes: int = DERIVATIVE_CACHE_MAX_BYTES,
+                 pool=None, evict_grace: float = DERIVATIVE_EVICT_GRACE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.evict_grace = evict_grace
+        # 图片工作池（image_pool.ImagePool），未指定时使用默认线程池
+        self.pool = pool
+        self.total_bytes = 0
+        # 文件名 -> 大小，顺序即访问顺序（末尾为最近使用）
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        # 文件名 -> 最近访问时间（time.time()），用于淘汰保护期
+        self._touched: Dict[str, float] = {}
+        # 正在生成的衍生版本（独立任务），用于合并并发请求
+        self._inflight: Dict[str, asyncio.Task] = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_existing()
+
+    def _load_existing(self) -> None:
+        """启动时扫描已有缓存文件，按访问时间恢复 LRU 顺序"""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+                continue
+            st = entry.stat()
+            entries.append((st.st_atime, entry.name, st.st_size))
+        for atime, name, size in sorted(entries):
+            self._entries[name] = size
+            self._touched[name] = atime
+            self.total_bytes += size
+        self._evict()
+
+    @staticmethod
+    def variant_name(source_path: str, width: Optional[int], fmt: str) -> str:
+        """
+        生成衍生版本文件名（包含源文件的修改时间与大小，源文件变化后自动失效）
+        """
+        st = os.stat(source_path)
+        source_key = f"{os.path.abspath(source_path)}:{st.st_mtime_ns}:{st.st_size}"
+        digest = hashlib.sha1(source_key.encode("utf-8")).hexdigest()[:12]
+        stem = os.path.splitext(os.path.basename(source_path))[0]
+        ext = DERIVATIVE_FORMATS[fmt][1]
+        return f"{stem}_{digest}_w{width or 0}.{ext}"
+
+    def _touch(self, name: str) -> None:
+        """标记为最近使用"""
+        self._entries.move_to_end(name)
+        self._touched[name] = time.time()
+
+    def _add(self, name: str) -> None:
+        """登记新生成的文件并按需淘汰"""
+        size = os.path.getsize(os.path.join(self.cache_dir, name))
+        self.total_bytes += size - self._entries.get(name, 0)
+        self._entries[name] = size
+        self._touch(name)
+        self._evict(keep=name)
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        """淘汰最久未使用的文件，直到总大小不超过上限（保护期内的文件暂不淘汰）"""
+        now = time.time()
+        while self.total_bytes > self.max_bytes and self._entries:
+            name, size = next(iter(self._entries.items()))
+            # 按访问顺序排列，最旧的文件仍在保护期内时其余文件也都在保护期内
+            if name == keep or now - self._touched.get(name, 0) < self.evict_grace:
+                break
+            self._entries.popitem(last=False)
+            self._touched.pop(name, None)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+    async def get(self, source_path: str, width: Optional[int], fmt: str) -> str:
+        """
+        获取衍生图片文件名（不存在则生成）
+
+        Args:
+            source_path: 原图路径
+            width: 目标宽度（已取整到档位，None 表示不缩放）
+            fmt: 输出格式键
+
+        Returns:
+            str: 缓存目录中的衍生图片文件名
+        """
+        name = self.variant_name(source_path, width, fmt)
+        if name in self._entries and os.path.exists(os.path.join(self.cache_dir, name)):
+            self._touch(name)
+            return name
+
+        # 生成在独立任务中进行，所有请求（包括发起者）都只等待其结果：
+        # 某个客户端断开只会取消它自己的等待，不会中断生成或影响其他等待者
+        task = self._inflight.get(name)
+        if task is None:
+            task = asyncio.create_task(self._render(source_path, name, width, fmt))
+            self._inflight[name] = task
+            task.add_done_callback(partial(self._render_done, name))
+        await asyncio.shield(task)
+        return name
+
+    async def _render(self, source_path: str, name: str, width: Optional[int], fmt: str) -> None:
+        """生成衍生图片并登记到缓存"""
+        dest_path = os.path.join(self.cache_dir, name)
+        if self.pool is not None:
+            await self.pool.run("render_derivative", render_derivative, source_path, dest_path, width, fmt)
+        else:
+            await asyncio.to_thread(render_derivative, source_path, dest_path, width, fmt)
+        self._add(name)
+
+    def _render_done(self, name: str, task: asyncio.Task) -> None:
+        """生成任务结束后移出 _inflight"""
+        if self._inflight.get(name) is task:
+            del self._inflight[name]
+        # 所有等待者都已断开时，避免 "exception was never retrieved" 警告
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,187 @@
+"""
+图片编解码工作池 - 把 CPU 密集的解码 / 转码放到事件循环之外
+
+- IMAGE_POOL_KIND=thread（默认，PIL 编解码大部分时间释放 GIL）或 process（完全隔离 GIL）
+- 排队中 + 执行中的任务数不超过 IMAGE_POOL_MAX_PENDING，超出直接拒绝（ImagePoolBusy）
+- 每次调用有超时（IMAGE_POOL_TIMEOUT 秒），超时后不再等待结果；超时的任务在真正结束前仍计入积压
+- 记录每类操作的耗时、结果与当前积压
+
+提交到进程池的函数必须是模块级函数（可被 pickle），因此上传规范化等转码函数也放在本模块。
+"""
+
+import asyncio
+import hashlib
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from PIL import Image
+
+from metrics import Counter, Gauge, Histogram
+
+IMAGE_POOL_KIND = os.getenv("IMAGE_POOL_KIND", "thread").lower()
+IMAGE_POOL_WORKERS = int(os.getenv("IMAGE_POOL_WORKERS", min(4, os.cpu_count() or 1)))
+IMAGE_POOL_MAX_PENDING = int(os.getenv("IMAGE_POOL_MAX_PENDING", 32))
+IMAGE_POOL_TIMEOUT = float(os.getenv("IMAGE_POOL_TIMEOUT", 30))
+
+POOL_PENDING = Gauge("image_pool_pending", "图片工作池中排队与执行中的任务数")
+POOL_DURATION = Histogram("image_pool_duration_seconds", "图片工作池任务耗时（秒，含排队）")
+POOL_CALLS = Counter("image_pool_calls_total", "图片工作池调用次数（outcome: ok / error / timeout / rejected）")
+
+
+class ImagePoolBusy(Exception):
+    """工作池积压已满"""
+
+
+class ImagePool:
+    """
+    有界的图片编解码工作池
+    """
+
+    def __init__(self, kind: str = IMAGE_POOL_KIND, workers: int = IMAGE_POOL_WORKERS,
+                 max_pending: int = IMAGE_POOL_MAX_PENDING, timeout: float = IMAGE_POOL_TIMEOUT):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"不支持的工作池类型: {kind}（thread / process）")
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.timeout = timeout
+        self.pending = 0
+        self._executor: Optional[Executor] = None
+
+    def _get_executor(self) -> Executor:
+        """首次使用时创建执行器"""
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image-pool")
+        return self._executor
+
+    def _release(self) -> None:
+        self.pending -= 1
+        POOL_PENDING.set(self.pending)
+
+    async def run(self, op: str, func: Callable, *args, timeout: Optional[float] = None,
+                  after: Optional[Callable[[], None]] = None):
+        """
+        在工作池中执行函数
+
+        Args:
+            op: 操作名称（用于指标）
+            func: 模块级函数
+            *args: 函数参数
+            timeout: 超时（秒），默认 IMAGE_POOL_TIMEOUT
+            after: 任务真正结束后调用（例如删除输入文件）；超时后仍在执行的任务结束时才调用，
+                   被拒绝时立即调用。在工作线程中执行，不能访问事件循环
+
+        Returns:
+            函数返回值
+
+        Raises:
+            ImagePoolBusy: 积压已满
+            asyncio.TimeoutError: 超时（已开始执行的任务仍会在后台完成）
+        """
+        if self.pending >= self.max_pending:
+            POOL_CALLS.inc(op=op, outcome="rejected")
+            if after is not None:
+                after()
+            raise ImagePoolBusy(f"图片处理繁忙（{self.pending} 个任务排队中）")
+
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        POOL_PENDING.set(self.pending)
+        future = self._get_executor().submit(func, *args)
+
+        def on_done(_):
+            # 积压在任务真正结束时才减少（超时不等于停止执行）
+            if after is not None:
+                try:
+                    after()
+                except Exception as e:
+                    print(f"⚠ 图片工作池任务的清理失败: {e}")
+            try:
+                loop.call_soon_threadsafe(self._release)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+
+        future.add_done_callback(on_done)
+
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout if timeout is None else timeout)
+            outcome = "ok"
+            return result
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise
+        finally:
+            POOL_DURATION.observe(time.perf_counter() - started, op=op)
+            POOL_CALLS.inc(op=op, outcome=outcome)
+
+    def shutdown(self) -> None:
+        """关闭执行器（不等待未完成的任务）"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def remove_file(path: str) -> None:
+    """删除文件（不存在时忽略）"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def hash_image_pixels(img: Image.Image, strip_height: int = 256) -> str:
+    """
+    计算图片像素的 SHA-256（按条带分段读取，不复制整幅图片的像素）
+
+    Args:
+        img: 已解码的 PIL 图片
+        strip_height: 每段的行数
+
+    Returns:
+        str: 十六进制摘要
+    """
+    width, height = img.size
+    digest = hashlib.sha256(f"{img.mode}:{width}x{height}:".encode("utf-8"))
+    for top in range(0, height, strip_height):
+        digest.update(img.crop((0, top, width, min(top + strip_height, height))).tobytes())
+    return digest.hexdigest()
+
+
+def normalize_upload(src_path: str, dest_path: str) -> str:
+    """
+    将上传的原始文件解码、转换为 RGB 并保存为 PNG
+
+    Args:
+        src_path: 原始上传文件路径
+        dest_path: 规范化后的 PNG 路径
+
+    Returns:
+        str: 规范化后像素的 SHA-256，用于结果缓存
+    """
+    with Image.open(src_path) as img:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.save(dest_path, 'PNG')
+        return hash_image_pixels(img)
+
+
+def reencode_jpeg(src_path: str, dest_path: str, quality: int = 95) -> None:
+    """
+    将图片重新编码为 JPEG
+
+    Args:
+        src_path: 源图片路径
+        dest_path: JPEG 保存路径
+        quality: JPEG 质量
+    """
+    with Image.open(src_path) as img:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.save(dest_path, 'JPEG', quality=quality)
@@ -0,0 +1,112 @@
+"""
+进程内 TTL + LRU 存储
+
+Redis 不可用时代替 Redis 保存任务信息；Redis 可用时作为热点任务的近端缓存。
+
+- 每个条目带过期时间，读取时惰性过期（与 Redis 的 TTL 语义一致）
+- 条目数超过上限时淘汰最久未使用的条目
+- get / set / update / pop 均为 O(1)
+- 另用最小堆按过期时间排序（惰性删除），sweep() 只检查已到期的条目，可在后台周期性调用
+"""
+
+import heapq
+import time
+from collections import OrderedDict
+from typing import Any, Iterator, List, Optional, Tuple
+
+
+class TTLCache:
+    """
+    带过期时间与条目上限的 LRU 字典
+    """
+
+    def __init__(self, max_entries: int, default_ttl: float):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        # key -> (过期时间, 值)，顺序即访问顺序（末尾为最近使用）
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        # (过期时间, key) 最小堆；条目被覆盖或删除后旧记录留在堆中，sweep 时跳过
+        self._expiry: List[Tuple[float, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """读取条目，已过期则删除并返回 default"""
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """写入条目并刷新过期时间"""
+        ttl = self.default_ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        heapq.heappush(self._expiry, (expires_at, key))
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+        # 失效记录过多时重建堆，避免频繁更新的条目使堆无限增长
+        if len(self._expiry) > 2 * len(self._data) + 64:
+            self._expiry = [(expires_at, key) for key, (expires_at, _) in self._data.items()]
+            heapq.heapify(self._expiry)
+
+    def extend(self, key: str, value: Any, min_ttl: float) -> None:
+        """写入条目，过期时间至少延长到 min_ttl 秒之后（已有更晚的过期时间时保留）"""
+        entry = self._data.get(key)
+        remaining = entry[0] - time.monotonic() if entry is not None else 0
+        self.set(key, value, max(remaining, min_ttl))
+
+    def update(self, key: str, fields: dict, ttl: Optional[float] = None) -> dict:
+        """
+        合并字段到字典条目（相当于 HSET + EXPIRE）
+
+        Returns:
+            dict: 合并后的条目
+        """
+        current = self.get(key)
+        merged = dict(current) if current else {}
+        merged.update(fields)
+        self.set(key, merged, ttl)
+        return merged
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        """删除条目"""
+        entry = self._data.pop(key, None)
+        if entry is None or entry[0] <= time.monotonic():
+            return default
+        return entry[1]
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        """遍历未过期的条目（不改变访问顺序）"""
+        now = time.monotonic()
+        for key, (expires_at, value) in list(self._data.items()):
+            if expires_at > now:
+                yield key, value
+
+    def sweep(self) -> int:
+        """
+        按过期时间顺序删除所有已过期的条目（与访问顺序无关，最近访问过的过期条目同样会被删除）
+
+        Returns:
+            int: 删除的条目数
+        """
+        now = time.monotonic()
+        removed = 0
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, key = heapq.heappop(self._expiry)
+            entry = self._data.get(key)
+            # 跳过已被覆盖（过期时间不同）或已删除的条目的旧记录
+            if entry is not None and entry[0] == expires_at:
+                del self._data[key]
+                removed += 1
+        return removed
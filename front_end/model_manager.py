@@ -0,0 +1,277 @@
+"""
+模型常驻管理（Worker 进程内共享）
+
+各阶段脚本（rcsd.py / generate_views.py / furnishing.py）在导入时或每次调用时加载模型，
+每个任务都要付出数十秒的加载时间。ModelManager 让每个模型只加载一次并常驻内存:
+
+- register() 登记模型的加载函数与预计占用；use() 第一次使用时加载，之后直接复用
+- 常驻模型的总占用超过 MODEL_MEMORY_BUDGET_MB 时，按最久未使用的顺序淘汰
+- 正在使用中的模型不会被淘汰；同一模型被并发请求时只加载一次
+- 记录加载耗时、命中率、淘汰次数与常驻占用（GET /metrics）
+
+模型只在本进程内常驻：WORKER_POOL_KIND=process 时每个子进程各自加载一份，预算需按进程数折算。
+"""
+
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from metrics import Counter, Gauge, Histogram
+
+MB = 1024 * 1024
+
+# 常驻模型的总内存预算（MB，GPU 显存与内存合计）；0 表示不限制
+MODEL_MEMORY_BUDGET_MB = int(os.getenv("MODEL_MEMORY_BUDGET_MB", 0))
+# 启动时预加载的模型（逗号分隔的模型名）
+MODEL_PRELOAD = [name.strip() for name in os.getenv("MODEL_PRELOAD", "").split(",") if name.strip()]
+
+MODEL_LOAD_SECONDS = Histogram("model_load_seconds", "模型加载耗时（秒）",
+                               buckets=(0.5, 1, 2.5, 5, 10, 20, 40, 80, 160))
+MODEL_REQUESTS = Counter("model_requests_total", "模型使用次数（outcome: hit 已常驻 / miss 需要加载）")
+MODEL_EVICTIONS = Counter("model_evictions_total", "因超出内存预算被淘汰的模型数")
+MODEL_RESIDENT_BYTES = Gauge("model_resident_bytes", "常驻模型的内存占用（字节）")
+
+
+def measure_model_bytes(obj: Any) -> int:
+    """
+    统计模型参数与缓冲区占用的字节数
+
+    支持 torch.nn.Module、diffusers pipeline（components）以及由它们组成的 dict / list / tuple；
+    无法统计的对象返回 0。
+    """
+    seen = set()
+
+    def walk(value: Any) -> int:
+        if value is None or id(value) in seen:
+            return 0
+        seen.add(id(value))
+        if isinstance(value, dict):
+            return sum(walk(v) for v in value.values())
+        if isinstance(value, (list, tuple)):
+            return sum(walk(v) for v in value)
+        components = getattr(value, "components", None)
+        if isinstance(components, dict):
+            return walk(components)
+        if hasattr(value, "parameters") and hasattr(value, "buffers"):
+            tensors = list(value.parameters()) + list(value.buffers())
+            return sum(t.numel() * t.element_size() for t in tensors)
+        return 0
+
+    try:
+        return walk(obj)
+    except Exception:
+        return 0
+
+
+def release_accelerator_memory() -> None:
+    """回收已释放模型占用的 GPU 显存（未安装 torch 时忽略）"""
+    gc.collect()
+    try:
+        import torch
+    except ImportError:
+        return
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class ModelSpec:
+    """
+    已登记的模型
+
+    Args:
+        name: 模型名
+        loader: 无参数的加载函数，返回模型对象
+        estimated_mb: 加载前预计的内存占用（MB），用于提前腾出空间
+        unloader: 淘汰时调用的清理函数（可选），参数为模型对象
+    """
+
+    def __init__(self, name: str, loader: Callable[[], Any], estimated_mb: float = 0,
+                 unloader: Optional[Callable[[Any], None]] = None):
+        self.name = name
+        self.loader = loader
+        self.estimated_bytes = int(estimated_mb * MB)
+        self.unloader = unloader
+
+
+class ResidentModel:
+    """常驻模型及其占用、使用计数"""
+
+    def __init__(self, model: Any, size_bytes: int, load_seconds: float):
+        self.model = model
+        self.size_bytes = size_bytes
+        self.load_seconds = load_seconds
+        self.in_use = 0
+
+
+class ModelManager:
+    """
+    按内存预算常驻模型的 LRU 管理器（线程安全）
+    """
+
+    def __init__(self, budget_mb: int = MODEL_MEMORY_BUDGET_MB):
+        self.budget_bytes = budget_mb * MB
+        self.specs: Dict[str, ModelSpec] = {}
+        # 模型名 -> 常驻模型，顺序即使用顺序（末尾为最近使用）
+        self.resident: "OrderedDict[str, ResidentModel]" = OrderedDict()
+        self.lock = threading.Condition()
+        self.loading = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def register(self, name: str, loader: Callable[[], Any], estimated_mb: float = 0,
+                 unloader: Optional[Callable[[Any], None]] = None) -> None:
+        """登记模型（不会立即加载）"""
+        self.specs[name] = ModelSpec(name, loader, estimated_mb, unloader)
+
+    def resident_bytes(self) -> int:
+        return sum(entry.size_bytes for entry in self.resident.values())
+
+    def _evict_for(self, needed_bytes: int, keep: str) -> List[Tuple[str, ResidentModel]]:
+        """
+        淘汰最久未使用且未在使用中的模型，直到能放下 needed_bytes（调用方需持有 self.lock）
+
+        Returns:
+            list: 被淘汰的 (模型名, 常驻模型)，在锁外清理
+        """
+        evicted = []
+        if self.budget_bytes <= 0:
+            return evicted
+        for name in list(self.resident):
+            if self.resident_bytes() + needed_bytes <= self.budget_bytes:
+                break
+            entry = self.resident[name]
+            if name == keep or entry.in_use:
+                continue
+            del self.resident[name]
+            evicted.append((name, entry))
+        for name, entry in evicted:
+            self.evictions += 1
+            MODEL_EVICTIONS.inc(model=name)
+            print(f"⚠ 模型 {name} 已被淘汰（释放 {entry.size_bytes / MB:.0f} MB，内存预算 {self.budget_bytes / MB:.0f} MB）")
+        MODEL_RESIDENT_BYTES.set(self.resident_bytes())
+        return evicted
+
+    def _unload(self, evicted: List[Tuple[str, ResidentModel]]) -> None:
+        """清理被淘汰的模型（不持有锁）"""
+        if not evicted:
+            return
+        for name, entry in evicted:
+            spec = self.specs.get(name)
+            if spec is not None and spec.unloader is not None:
+                try:
+                    spec.unloader(entry.model)
+                except Exception as e:
+                    print(f"⚠ 模型 {name} 清理失败: {e}")
+            entry.model = None
+        release_accelerator_memory()
+
+    def _acquire(self, name: str) -> ResidentModel:
+        """取得常驻模型并增加使用计数，未常驻时加载"""
+        spec = self.specs.get(name)
+        if spec is None:
+            raise KeyError(f"未登记的模型: {name}")
+
+        with self.lock:
+            # 同一模型正在被其他线程加载时等待，不重复加载
+            while name in self.loading:
+                self.lock.wait()
+            entry = self.resident.get(name)
+            if entry is not None:
+                entry.in_use += 1
+                self.resident.move_to_end(name)
+                self.hits += 1
+                MODEL_REQUESTS.inc(model=name, outcome="hit")
+                return entry
+            self.loading.add(name)
+            self.misses += 1
+            MODEL_REQUESTS.inc(model=name, outcome="miss")
+            evicted = self._evict_for(spec.estimated_bytes, keep=name)
+
+        try:
+            self._unload(evicted)
+            print(f"加载模型 {name}...")
+            started = time.perf_counter()
+            model = spec.loader()
+            load_seconds = time.perf_counter() - started
+            size_bytes = measure_model_bytes(model) or spec.estimated_bytes
+        except BaseException:
+            with self.lock:
+                self.loading.discard(name)
+                self.lock.notify_all()
+            raise
+
+        MODEL_LOAD_SECONDS.observe(load_seconds, model=name)
+        print(f"✓ 模型 {name} 加载完成: {load_seconds:.1f} 秒，{size_bytes / MB:.0f} MB")
+        with self.lock:
+            entry = ResidentModel(model, size_bytes, load_seconds)
+            entry.in_use = 1
+            self.resident[name] = entry
+            self.loading.discard(name)
+            # 实际占用可能超过预计值，加载后再检查一次预算
+            evicted = self._evict_for(0, keep=name)
+            if self.budget_bytes and self.resident_bytes() > self.budget_bytes:
+                print(f"⚠ 常驻模型占用 {self.resident_bytes() / MB:.0f} MB 超出预算（使用中的模型无法淘汰）")
+            MODEL_RESIDENT_BYTES.set(self.resident_bytes())
+            self.lock.notify_all()
+        self._unload(evicted)
+        return entry
+
+    def _release(self, name: str) -> None:
+        with self.lock:
+            entry = self.resident.get(name)
+            if entry is not None:
+                entry.in_use -= 1
+
+    @contextmanager
+    def use(self, name: str) -> Iterator[Any]:
+        """
+        使用模型（with 块内模型不会被淘汰）
+
+        Args:
+            name: 已登记的模型名
+
+        Yields:
+            模型对象
+        """
+        entry = self._acquire(name)
+        try:
+            yield entry.model
+        finally:
+            self._release(name)
+
+    def preload(self, names: Optional[List[str]] = None) -> None:
+        """预加载模型（默认 MODEL_PRELOAD），加载失败只打印警告"""
+        for name in MODEL_PRELOAD if names is None else names:
+            try:
+                with self.use(name):
+                    pass
+            except Exception as e:
+                print(f"✗ 预加载模型 {name} 失败: {e}")
+
+    def stats(self) -> dict:
+        """常驻模型、加载耗时与命中率"""
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "budget_mb": round(self.budget_bytes / MB),
+                "resident_mb": round(self.resident_bytes() / MB),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / requests, 4) if requests else None,
+                "evictions": self.evictions,
+                "registered": sorted(self.specs),
+                "resident": [
+                    {
+                        "name": name,
+                        "size_mb": round(entry.size_bytes / MB),
+                        "load_seconds": round(entry.load_seconds, 2),
+                        "in_use": entry.in_use,
+                    }
+                    for name, entry in self.resident.items()
+                ],
+            }
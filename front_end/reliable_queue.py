@@ -0,0 +1,322 @@
+"""
+可靠任务队列（至少一次投递，api_server.py 与 worker_server.py 共用）
+
+- task_queue:{task_type}        Sorted Set，待处理任务 -> 调度分数（越小越先处理，见 scheduling.py）
+- task_queue_signal             List，入队通知；队列为空时 Worker 在这里 BLPOP 等待
+- task_processing:{worker_id}   List，Worker 已取出、尚未确认的任务
+- task_leases                   Sorted Set，"{worker_id}|{task_id}" -> 租约到期时间
+- task_delayed                  Sorted Set，等待重试的任务 -> 重试时间
+- task_attempts                 Hash，task_id -> 已失败次数
+- task_dead_letter              List，超过最大重试次数的任务（可通过 GET /dead-letter 查看）
+- tenant_clock:{task_type}      Hash，租户虚拟时钟（入队脚本维护，用于租户公平）
+
+取任务时用 Lua 脚本把任务从队列原子地移入 Worker 的处理中列表并登记租约；处理期间 Worker 定期续租。
+Worker 崩溃或重启后租约过期，回收脚本把任务放回队列（计为一次失败）。
+处理失败的任务按指数退避延迟重试，超过 TASK_MAX_ATTEMPTS 次后进入死信队列。
+
+旧版本的队列是 List，Worker 启动时通过 migrate_legacy_queues() 原样转换为 Sorted Set。
+"""
+
+import json
+import os
+import random
+import socket
+import time
+from typing import Iterable, List, Optional, Tuple
+
+from scheduling import (
+    QUEUE_AGING_LIMIT, REQUEUE_BOOST, TENANT_CLOCK_TTL,
+    priority_boost, task_cost, tenant_clock_field, tenant_clock_key,
+)
+
+TASK_QUEUE_PREFIX = "task_queue:"
+QUEUE_SIGNAL_KEY = "task_queue_signal"
+PROCESSING_PREFIX = "task_processing:"
+LEASE_KEY = "task_leases"
+DELAYED_KEY = "task_delayed"
+ATTEMPTS_KEY = "task_attempts"
+DEAD_LETTER_KEY = "task_dead_letter"
+
+VISIBILITY_TIMEOUT = int(os.getenv("TASK_VISIBILITY_TIMEOUT", 600))  # 租约时长（秒）
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", 3))  # 失败几次后进入死信队列
+RETRY_BASE_DELAY = float(os.getenv("TASK_RETRY_BASE_DELAY", 5))  # 首次重试延迟（秒）
+RETRY_MAX_DELAY = float(os.getenv("TASK_RETRY_MAX_DELAY", 300))  # 重试延迟上限（秒）
+REAPER_BATCH_SIZE = 100
+SIGNAL_MAX_LENGTH = 1000  # 入队通知列表的最大长度（通知只是唤醒提示，多余的可以丢弃）
+
+# 入队：按租户虚拟时钟与优先级计算分数，写入队列并发送入队通知
+# KEYS: 队列, 租户虚拟时钟, 入队通知
+# ARGV: 当前时间, 时钟字段, 预计耗时, 优先级提前量, 任务 JSON, 通知列表上限, 时钟过期时间
+ENQUEUE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local start = math.max(now, tonumber(redis.call('HGET', KEYS[2], ARGV[2]) or 0))
+redis.call('HSET', KEYS[2], ARGV[2], start + tonumber(ARGV[3]))
+redis.call('EXPIRE', KEYS[2], ARGV[7])
+redis.call('ZADD', KEYS[1], start - tonumber(ARGV[4]), ARGV[5])
+redis.call('LPUSH', KEYS[3], 1)
+redis.call('LTRIM', KEYS[3], 0, tonumber(ARGV[6]) - 1)
+return 1
+"""
+
+# 原子取任务：按调用方给出的顺序（队列权重）选择第一个非空队列，队首分数早于老化阈值的队列优先；
+# 取出分数最小的任务，移入处理中列表并登记租约
+# KEYS: 处理中列表, 租约, 死信队列, 队列...   ARGV: 租约到期时间, worker_id, 当前时间, 老化阈值
+# 返回: {队列, 任务 JSON, 是否因老化而选中}
+CLAIM_SCRIPT = """
+local cutoff = tonumber(ARGV[4])
+while true do
+    local chosen, aged, oldest = nil, 0, nil
+    for i = 4, #KEYS do
+        local head = redis.call('ZRANGE', KEYS[i], 0, 0, 'WITHSCORES')
+        if head[1] then
+            local score = tonumber(head[2])
+            if not chosen then
+                chosen = i
+            end
+            if score <= cutoff and (not oldest or score < oldest) then
+                chosen, aged, oldest = i, 1, score
+            end
+        end
+    end
+    if not chosen then
+        return false
+    end
+    local job = redis.call('ZPOPMIN', KEYS[chosen])[1]
+    local ok, data = pcall(cjson.decode, job)
+    if ok and type(data) == 'table' and data['task_id'] then
+        redis.call('LPUSH', KEYS[1], job)
+        redis.call('ZADD', KEYS[2], ARGV[1], ARGV[2] .. '|' .. data['task_id'])
+        return {KEYS[chosen], job, aged}
+    end
+    redis.call('LPUSH', KEYS[3], cjson.encode({task = job, error = 'invalid task json',
+                                               attempts = 0, failed_at = tonumber(ARGV[3])}))
+end
+"""
+
+# 回收：租约过期的任务放回队列（或进入死信队列），到期的延迟重试任务放回队列；每放回一个任务发送一次入队通知
+# KEYS: 租约, 延迟重试, 失败次数, 死信队列, 入队通知
+# ARGV: 当前时间, 最大失败次数, 处理中列表前缀, 队列前缀, 单次上限, 重新入队的优先级提前量, 通知列表上限
+# 处理中列表与队列的键名由前缀拼接（未在 KEYS 中声明），只支持单实例 Redis，不支持 Redis Cluster
+REAP_SCRIPT = """
+local results = {}
+local limit = tonumber(ARGV[5])
+local requeued = 0
+local requeue_score = tonumber(ARGV[1]) - tonumber(ARGV[6])
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, limit)
+for _, member in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], member)
+    local worker_id, task_id = string.match(member, '^(.*)|([^|]*)$')
+    if worker_id then
+        local processing = ARGV[3] .. worker_id
+        for _, job in ipairs(redis.call('LRANGE', processing, 0, -1)) do
+            local ok, data = pcall(cjson.decode, job)
+            if ok and data['task_id'] == task_id then
+                redis.call('LREM', processing, 1, job)
+                local attempts = redis.call('HINCRBY', KEYS[3], task_id, 1)
+                if attempts >= tonumber(ARGV[2]) then
+                    redis.call('HDEL', KEYS[3], task_id)
+                    redis.call('LPUSH', KEYS[4], cjson.encode({task = job, error = 'visibility timeout',
+                                                               attempts = attempts, failed_at = tonumber(ARGV[1])}))
+                    table.insert(results, {task_id, 'dead', attempts})
+                else
+                    redis.call('ZADD', ARGV[4] .. data['task_type'], requeue_score, job)
+                    requeued = requeued + 1
+                    table.insert(results, {task_id, 'requeued', attempts})
+                end
+                break
+            end
+        end
+    end
+end
+local due = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, limit)
+for _, job in ipairs(due) do
+    redis.call('ZREM', KEYS[2], job)
+    local data = cjson.decode(job)
+    redis.call('ZADD', ARGV[4] .. data['task_type'], requeue_score, job)
+    requeued = requeued + 1
+end
+if requeued > 0 then
+    for _ = 1, math.min(requeued, tonumber(ARGV[7])) do
+        redis.call('LPUSH', KEYS[5], 1)
+    end
+    redis.call('LTRIM', KEYS[5], 0, tonumber(ARGV[7]) - 1)
+end
+return results
+"""
+
+# 旧版 List 队列转换为 Sorted Set（保持原来的先后顺序）
+# KEYS: 队列   ARGV: 当前时间
+MIGRATE_SCRIPT = """
+if redis.call('TYPE', KEYS[1])['ok'] ~= 'list' then
+    return 0
+end
+local jobs = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+local now = tonumber(ARGV[1])
+for i = #jobs, 1, -1 do
+    redis.call('ZADD', KEYS[1], now + (#jobs - i) * 0.001, jobs[i])
+end
+return #jobs
+"""
+
+
+def add_enqueue(pipe, task_type: str, task_data: dict, task_json: str) -> None:
+    """
+    向 pipeline 追加入队命令（按调度分数写入队列 + 入队通知）
+
+    使用 EVAL 而不是已注册的脚本，同步与异步客户端的 pipeline 都可以直接调用。
+
+    Args:
+        pipe: Redis pipeline（同步或异步）
+        task_type: 任务类型
+        task_data: 任务数据（读取 priority / tenant_id / tier，见 scheduling.assign_schedule）
+        task_json: 入队的任务 JSON
+    """
+    pipe.eval(
+        ENQUEUE_SCRIPT, 3,
+        f"{TASK_QUEUE_PREFIX}{task_type}", tenant_clock_key(task_type), QUEUE_SIGNAL_KEY,
+        time.time(), tenant_clock_field(task_data), task_cost(task_type), priority_boost(task_data),
+        task_json, SIGNAL_MAX_LENGTH, TENANT_CLOCK_TTL,
+    )
+
+
+def retry_delay(attempts: int) -> float:
+    """第 attempts 次失败后的重试延迟（指数退避，带 ±20% 抖动，不超过 RETRY_MAX_DELAY）"""
+    delay = min(RETRY_BASE_DELAY * (2 ** max(attempts - 1, 0)), RETRY_MAX_DELAY)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def default_worker_id() -> str:
+    """Worker 标识（设置固定的 WORKER_ID 后，重启时可以立即回收自己未完成的任务）"""
+    return os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+
+class ReliableQueue:
+    """
+    Worker 端的可靠队列操作（同步 Redis 客户端）
+    """
+
+    def __init__(self, redis_client, worker_id: str):
+        self.redis = redis_client
+        self.worker_id = worker_id
+        self.processing_key = f"{PROCESSING_PREFIX}{worker_id}"
+        self._claim = redis_client.register_script(CLAIM_SCRIPT)
+        self._reap = redis_client.register_script(REAP_SCRIPT)
+        self._migrate = redis_client.register_script(MIGRATE_SCRIPT)
+
+    def _lease_member(self, task_id: str) -> str:
+        return f"{self.worker_id}|{task_id}"
+
+    def claim(self, queue_names: List[str]) -> Optional[Tuple[str, str, bool]]:
+        """
+        从队列中取出一个任务（非阻塞）
+
+        Args:
+            queue_names: 按优先尝试顺序排列的队列；队首排队过久的队列会被提前
+
+        Returns:
+            tuple: (队列名, 任务 JSON, 是否因老化而选中)，所有队列为空时返回 None
+        """
+        if not queue_names:
+            return None
+        now = time.time()
+        result = self._claim(
+            keys=[self.processing_key, LEASE_KEY, DEAD_LETTER_KEY, *queue_names],
+            args=[now + VISIBILITY_TIMEOUT, self.worker_id, now, now - QUEUE_AGING_LIMIT],
+        )
+        if not result:
+            return None
+        queue, job, aged = result
+        return (queue.decode() if isinstance(queue, bytes) else queue,
+                job.decode() if isinstance(job, bytes) else job,
+                bool(int(aged)))
+
+    def wait(self, timeout: float) -> None:
+        """等待入队通知（队列为空时代替轮询）"""
+        self.redis.blpop(QUEUE_SIGNAL_KEY, timeout=max(1, int(timeout)))
+
+    def heartbeat(self, task_ids: Iterable[str]) -> None:
+        """为处理中的任务续租"""
+        task_ids = list(task_ids)
+        if not task_ids:
+            return
+        deadline = time.time() + VISIBILITY_TIMEOUT
+        self.redis.zadd(LEASE_KEY, {self._lease_member(task_id): deadline for task_id in task_ids}, xx=True)
+
+    def _add_ack(self, pipe, task_id: str, job: str) -> None:
+        pipe.lrem(self.processing_key, 1, job)
+        pipe.zrem(LEASE_KEY, self._lease_member(task_id))
+
+    def ack(self, task_id: str, job: str) -> None:
+        """确认任务已处理完成（成功或最终失败）"""
+        pipe = self.redis.pipeline(transaction=True)
+        self._add_ack(pipe, task_id, job)
+        pipe.hdel(ATTEMPTS_KEY, task_id)
+        pipe.execute()
+
+    def record_failure(self, task_id: str) -> int:
+        """记录一次失败，返回累计失败次数"""
+        return int(self.redis.hincrby(ATTEMPTS_KEY, task_id, 1))
+
+    def retry(self, task_id: str, job: str, delay: float) -> None:
+        """确认本次处理并安排延迟重试"""
+        pipe = self.redis.pipeline(transaction=True)
+        self._add_ack(pipe, task_id, job)
+        pipe.zadd(DELAYED_KEY, {job: time.time() + delay})
+        pipe.execute()
+
+    def dead_letter(self, task_id: str, job: str, error: str, attempts: int) -> None:
+        """确认本次处理并把任务放入死信队列"""
+        entry = {"task": job, "error": error, "attempts": attempts, "failed_at": time.time()}
+        pipe = self.redis.pipeline(transaction=True)
+        self._add_ack(pipe, task_id, job)
+        pipe.hdel(ATTEMPTS_KEY, task_id)
+        pipe.lpush(DEAD_LETTER_KEY, json.dumps(entry, ensure_ascii=False))
+        pipe.execute()
+
+    def reap(self) -> List[Tuple[str, str, int]]:
+        """
+        回收租约过期的任务，并把到期的延迟重试任务放回队列（多个 Worker 同时执行也是安全的）
+
+        Returns:
+            list: [(task_id, "requeued" / "dead", 失败次数)]
+        """
+        results = self._reap(
+            keys=[LEASE_KEY, DELAYED_KEY, ATTEMPTS_KEY, DEAD_LETTER_KEY, QUEUE_SIGNAL_KEY],
+            args=[time.time(), TASK_MAX_ATTEMPTS, PROCESSING_PREFIX, TASK_QUEUE_PREFIX, REAPER_BATCH_SIZE,
+                  REQUEUE_BOOST, SIGNAL_MAX_LENGTH],
+        )
+        reaped = []
+        for task_id, action, attempts in results or []:
+            if isinstance(task_id, bytes):
+                task_id, action = task_id.decode(), action.decode()
+            reaped.append((task_id, action, int(attempts)))
+        return reaped
+
+    def recover(self) -> int:
+        """
+        启动时把本 Worker 处理中列表里的任务标记为租约已过期，由下一次 reap() 放回队列
+
+        Returns:
+            int: 待回收的任务数
+        """
+        jobs = self.redis.lrange(self.processing_key, 0, -1)
+        members = {}
+        for job in jobs:
+            try:
+                members[self._lease_member(json.loads(job)["task_id"])] = 0
+            except (TypeError, ValueError, KeyError):
+                continue
+        if members:
+            self.redis.zadd(LEASE_KEY, members)
+        return len(members)
+
+    def migrate_legacy_queues(self, queue_names: Iterable[str]) -> int:
+        """
+        把旧版本留下的 List 队列转换为 Sorted Set（已转换的队列不受影响）
+
+        Returns:
+            int: 转换的任务数
+        """
+        now = time.time()
+        return sum(int(self._migrate(keys=[queue], args=[now]) or 0) for queue in queue_names)
@@ -0,0 +1,117 @@
+"""
+任务调度策略（api_server.py 与 worker_server.py 共用）
+
+队列 task_queue:{task_type} 是 Sorted Set，分数越小越先处理:
+
+    分数 = 租户虚拟开始时间 - 优先级提前量（秒）
+
+- 优先级: 交互式提交（/process-task）比批量提交（/batch）提前 PRIORITY_BOOST 秒，付费租户再提前 TIER_BOOST 秒
+- 老化: 提前量是固定的秒数，低优先级任务排队超过提前量之差后，一定排在之后提交的高优先级任务前面，不会饿死
+- 租户公平: 每个租户（按优先级）在每个队列有一个虚拟时钟，每入队一个任务前进该类任务的预计耗时；
+  同一租户一次提交的大量任务被依次排到"未来"，其他租户新提交的任务可以插到中间
+- 队列权重: Worker 有多个队列都有空闲槽位时按 QUEUE_WEIGHTS 做步幅调度（stride scheduling）；
+  某个队列的队首任务有效排队时间超过 QUEUE_AGING_LIMIT 秒时优先处理该队列
+
+租户与付费等级来自请求头 X-Tenant-ID / X-Tenant-Tier，应由网关在认证后设置，不要直接信任浏览器传入的值。
+"""
+
+import os
+from typing import Dict, Iterable, List, Optional
+
+from admission import DEFAULT_SERVICE_TIME
+
+TENANT_CLOCK_PREFIX = "tenant_clock:"  # Hash，"{tenant_id}|{priority}" -> 虚拟时钟
+TENANT_CLOCK_TTL = int(os.getenv("TENANT_CLOCK_TTL", 24 * 3600))
+DEFAULT_TENANT = "anonymous"
+TENANT_ID_MAX_LENGTH = 64
+
+# 队列权重：多个队列同时有任务且都有空闲槽位时，取任务次数之比
+QUEUE_WEIGHTS = {
+    "denoise": max(0.01, float(os.getenv("QUEUE_WEIGHT_DENOISE", 1))),
+    "virtual": max(0.01, float(os.getenv("QUEUE_WEIGHT_VIRTUAL", 1))),
+}
+# 队首任务有效排队时间（含优先级提前量）超过该值（秒）时，不再按权重轮转，优先处理该队列
+QUEUE_AGING_LIMIT = float(os.getenv("QUEUE_AGING_LIMIT", 300))
+
+# 优先级提前量（秒）
+PRIORITY_BOOST = {
+    "interactive": float(os.getenv("PRIORITY_BOOST_INTERACTIVE", 60)),
+    "batch": 0.0,
+}
+TIER_BOOST = {
+    "paid": float(os.getenv("TIER_BOOST_PAID", 120)),
+    "free": 0.0,
+}
+DEFAULT_TIER = "free"
+
+# 租约过期或延迟重试后重新入队的任务已经排过一次队，按最高优先级排队
+REQUEUE_BOOST = max(PRIORITY_BOOST.values()) + max(TIER_BOOST.values())
+
+
+def assign_schedule(task_data: dict, priority: str, tenant_id: Optional[str] = None,
+                    tier: Optional[str] = None) -> dict:
+    """
+    写入任务的调度属性（priority / tenant_id / tier），无效值使用默认值
+
+    Args:
+        task_data: 任务数据字典
+        priority: 'interactive' 或 'batch'
+        tenant_id: 租户标识
+        tier: 付费等级（'paid' / 'free'）
+
+    Returns:
+        dict: 更新后的任务数据
+    """
+    tenant_id = (tenant_id or "").strip()[:TENANT_ID_MAX_LENGTH]
+    tier = (tier or "").strip().lower()
+    task_data["priority"] = priority if priority in PRIORITY_BOOST else "batch"
+    task_data["tenant_id"] = tenant_id or DEFAULT_TENANT
+    task_data["tier"] = tier if tier in TIER_BOOST else DEFAULT_TIER
+    return task_data
+
+
+def priority_boost(task_data: dict) -> float:
+    """任务的优先级提前量（秒）"""
+    return (PRIORITY_BOOST.get(task_data.get("priority"), 0.0)
+            + TIER_BOOST.get(task_data.get("tier"), 0.0))
+
+
+def tenant_clock_key(task_type: str) -> str:
+    """租户虚拟时钟键"""
+    return f"{TENANT_CLOCK_PREFIX}{task_type}"
+
+
+def tenant_clock_field(task_data: dict) -> str:
+    """租户虚拟时钟字段（同一租户的交互式任务不排在自己的批量任务之后）"""
+    return f"{task_data.get('tenant_id') or DEFAULT_TENANT}|{task_data.get('priority') or 'batch'}"
+
+
+def task_cost(task_type: str) -> float:
+    """入队一个任务时租户虚拟时钟前进的秒数（该类任务的预计处理耗时）"""
+    return DEFAULT_SERVICE_TIME.get(task_type, 5.0)
+
+
+class StrideScheduler:
+    """
+    按权重在多个队列之间轮转（步幅调度）
+
+    每个队列有一个 pass 值，每取一个任务前进 1 / 权重，优先尝试 pass 最小的队列。
+    空闲过的队列重新开始取任务时从当前进度开始计算，不会用积攒的额度连续抢占。
+    只在 Worker 的主循环线程中使用，不加锁。
+    """
+
+    def __init__(self, weights: Dict[str, float] = QUEUE_WEIGHTS):
+        self.weights = dict(weights)
+        self.passes = {task_type: 0.0 for task_type in self.weights}
+        self.clock = 0.0
+
+    def order(self, task_types: Iterable[str]) -> List[str]:
+        """按本轮应尝试的先后顺序排列任务类型"""
+        return sorted(task_types, key=lambda t: (max(self.passes.get(t, 0.0), self.clock),
+                                                 -self.weights.get(t, 1.0)))
+
+    def charge(self, task_type: str) -> None:
+        """记录从该队列取出了一个任务"""
+        start = max(self.passes.get(task_type, 0.0), self.clock)
+        self.passes[task_type] = start + 1.0 / self.weights.get(task_type, 1.0)
+        self.clock = start
@@ -7,10 +7,19 @@ import TutorialSection from './components/TutorialSection';
 import LoadingOverlay from './components/LoadingOverlay';
 import ErrorMessage from './components/ErrorMessage';
 import Sidebar from './components/Sidebar';
+import { variantUrl, variantSrcSet } from './utils/imageVariants';
 // PDF libraries will be imported dynamically
 
 const API_BASE_URL = 'http://localhost:5001';
 
+// Message shown when the backend rejects a task because the queue is full (HTTP 429)
+const queueBusyMessage = (response, result) => {
+  const retryAfter = response.headers.get('Retry-After') || result.detail?.retry_after;
+  return retryAfter
+    ? `The server is busy, please try again in ${retryAfter} seconds`
+    : 'The server is busy, please try again later';
+};
+
 function App() {
   const [selectedModule, setSelectedModule] = useState(null);
   const [isLoading, setIsLoading] = useState(false);
@@ -83,9 +92,15 @@ function App() {
 
       const result = await response.json();
 
-      if (result.success) {
-        // Start polling task status, wait for processing to complete
-        await pollTaskResult(taskId);
+      if (result.success && result.status === 'completed' && result.processed_url) {
+        // Identical image and parameters were processed before: result is returned immediately
+        applyTaskResult(result);
+      } else if (response.status === 429) {
+        setError(queueBusyMessage(response, result));
+        setIsLoading(false);
+      } else if (result.success) {
+        // Wait for task progress events (falls back to polling)
+        waitForTaskResult(taskId);
       } else {
         setError(result.error || 'Processing failed, please try again');
         setIsLoading(false);
@@ -97,6 +112,57 @@ function App() {
     }
   };
 
+  // Display a completed task result (shared by the SSE stream and the polling fallback)
+  const applyTaskResult = (result) => {
+    setProcessedUrl(`${API_BASE_URL}${result.processed_url}`);
+    
+    // Handle virtual staging results (furniture list and images)
+    if (result.furniture_list) {
+      setFurnitureList(result.furniture_list);
+    }
+    if (result.furniture_images) {
+      const imagesMap = {};
+      result.furniture_images.forEach(item => {
+        imagesMap[item.model_id] = `${API_BASE_URL}${item.image_url}`;
+      });
+      setFurnitureImages(imagesMap);
+    }
+    
+    setIsLoading(false);
+  };
+
+  // Wait for the task result via server-sent events, falling back to polling
+  const waitForTaskResult = (taskId) => {
+    if (typeof EventSource === 'undefined') {
+      pollTaskResult(taskId);
+      return;
+    }
+
+    const source = new EventSource(`${API_BASE_URL}/task/${taskId}/events`);
+    let finished = false;
+
+    source.addEventListener('result', (event) => {
+      finished = true;
+      source.close();
+      const result = JSON.parse(event.data);
+      if (result.success && result.processed_url) {
+        applyTaskResult(result);
+      } else {
+        setError(result.error || 'Processing failed, please try again');
+        setIsLoading(false);
+      }
+    });
+
+    source.onerror = () => {
+      // Stream unavailable or dropped before the result arrived: use polling instead
+      source.close();
+      if (!finished) {
+        finished = true;
+        pollTaskResult(taskId);
+      }
+    };
+  };
+
   const pollTaskResult = async (taskId) => {
     const maxAttempts = 60; // Maximum 60 polling attempts
     const pollInterval = 2000; // Poll every 2 seconds
@@ -109,21 +175,7 @@ function App() {
 
         if (result.success && result.processed_url) {
           // Processing complete, display result
-          setProcessedUrl(`${API_BASE_URL}${result.processed_url}`);
-          
-          // Handle virtual staging results (furniture list and images)
-          if (result.furniture_list) {
-            setFurnitureList(result.furniture_list);
-          }
-          if (result.furniture_images) {
-            const imagesMap = {};
-            result.furniture_images.forEach(item => {
-              imagesMap[item.model_id] = `${API_BASE_URL}${item.image_url}`;
-            });
-            setFurnitureImages(imagesMap);
-          }
-          
-          setIsLoading(false);
+          applyTaskResult(result);
           return;
         } else if (result.status === 'processing' || result.status === 'queued') {
           // Still processing, continue polling
@@ -190,9 +242,15 @@ function App() {
 
       const result = await response.json();
 
-      if (result.success) {
-        // Start polling task status, wait for processing to complete
-        await pollTaskResult(taskId);
+      if (result.success && result.status === 'completed' && result.processed_url) {
+        // Identical image and parameters were processed before: result is returned immediately
+        applyTaskResult(result);
+      } else if (response.status === 429) {
+        setError(queueBusyMessage(response, result));
+        setIsLoading(false);
+      } else if (result.success) {
+        // Wait for task progress events (falls back to polling)
+        waitForTaskResult(taskId);
       } else {
         setError(result.error || 'Processing failed, please try again');
         setIsLoading(false);
@@ -521,7 +579,7 @@ function App() {
     if (!processedUrl || !originalUrl || !comparisonContainerRef.current) return;
 
     const originalImg = new Image();
-    originalImg.src = originalUrl;
+    originalImg.src = variantUrl(originalUrl, 1280);
     
     originalImg.onload = () => {
       if (comparisonContainerRef.current && comparisonContainerRef.current.parentElement) {
@@ -722,13 +780,17 @@ function App() {
                     <div className="result-comparison-container" ref={comparisonContainerRef}>
                       <img
                         className="result-comparison-before"
-                        src={originalUrl}
+                        src={variantUrl(originalUrl, 1280)}
+                        srcSet={variantSrcSet(originalUrl)}
+                        sizes="(max-width: 1280px) 100vw, 1280px"
                         alt="Original Image"
                       />
                       <img
                         className="result-comparison-after"
                         ref={afterImageRef}
-                        src={processedUrl}
+                        src={variantUrl(processedUrl, 1280)}
+                        srcSet={variantSrcSet(processedUrl)}
+                        sizes="(max-width: 1280px) 100vw, 1280px"
                         alt="Processed Image"
                       />
                       <div className="result-comparison-slider" ref={sliderRef}>
@@ -747,7 +809,7 @@ function App() {
                           <div key={index} className="furniture-item">
                             {furnitureImages[furniture.model_id] && (
                               <img 
-                                src={furnitureImages[furniture.model_id]} 
+                                src={variantUrl(furnitureImages[furniture.model_id], 320)} 
                                 alt={furniture.category}
                                 className="furniture-image"
                               />
@@ -770,7 +832,9 @@ function App() {
               ) : (
                 <div className="uploaded-image-container">
                   <img 
-                    src={originalUrl} 
+                    src={variantUrl(originalUrl, 1280)} 
+                    srcSet={variantSrcSet(originalUrl)}
+                    sizes="(max-width: 1280px) 100vw, 1280px"
                     alt="Uploaded Image" 
                     className="uploaded-image"
                   />
@@ -1,4 +1,5 @@
 import React, { useEffect, useRef, useState } from 'react';
+import { variantUrl, variantSrcSet } from '../utils/imageVariants';
 
 const ComparisonViewer = ({ originalUrl, processedUrl, isVisible }) => {
   const containerRef = useRef(null);
@@ -10,7 +11,7 @@ const ComparisonViewer = ({ originalUrl, processedUrl, isVisible }) => {
     if (!isVisible || !originalUrl || !processedUrl) return;
 
     const originalImg = new Image();
-    originalImg.src = originalUrl;
+    originalImg.src = variantUrl(originalUrl, 1280);
     
     originalImg.onload = () => {
       if (containerRef.current && containerRef.current.parentElement) {
@@ -137,13 +138,17 @@ const ComparisonViewer = ({ originalUrl, processedUrl, isVisible }) => {
         <div className="comparison-container" ref={containerRef}>
           <img
             className="comparison-before"
-            src={originalUrl}
+            src={variantUrl(originalUrl, 1280)}
+            srcSet={variantSrcSet(originalUrl)}
+            sizes="(max-width: 1280px) 100vw, 1280px"
             alt="Original Image"
           />
           <img
             className="comparison-after"
             ref={afterImageRef}
-            src={processedUrl}
+            src={variantUrl(processedUrl, 1280)}
+            srcSet={variantSrcSet(processedUrl)}
+            sizes="(max-width: 1280px) 100vw, 1280px"
             alt="Processed Result"
           />
           <div className="comparison-slider" ref={sliderRef}>
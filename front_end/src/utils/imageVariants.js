@@ -0,0 +1,17 @@
+// Helpers for requesting resized / re-encoded image variants from the backend
+// derivative cache (GET /uploads/{file}?w=480&fmt=webp, GET /output/{file}?w=...).
+
+const VARIANT_PATH_PATTERN = /\/(uploads|output)\/[^/?#]+$/;
+
+// Only backend task artifacts support variants; blob: and data: URLs pass through unchanged
+export const supportsVariants = (url) => !!url && VARIANT_PATH_PATTERN.test(url);
+
+export const variantUrl = (url, width, fmt = 'webp') => {
+  if (!supportsVariants(url)) return url;
+  return `${url}?w=${width}&fmt=${fmt}`;
+};
+
+export const variantSrcSet = (url, widths = [640, 1280, 1920], fmt = 'webp') => {
+  if (!supportsVariants(url)) return undefined;
+  return widths.map((width) => `${variantUrl(url, width, fmt)} ${width}w`).join(', ');
+};
@@ -0,0 +1,155 @@
+"""
+各阶段使用的模型（登记到 model_manager.ModelManager）
+
+加载参数与各阶段脚本保持一致:
+- segformer / segformer_cpu / sd_inpaint: stage1_clutter removal/rcsd.py
+- zero123 / carvekit / safety_checker: stage2_furniture selection/furniture_place/generate_views.py
+- controlnet_inpaint / sd_img2img: stage3_room rendering/furnishing.py
+
+阶段2、阶段3 目前在 Worker 中仍为模拟（见 worker_server.simulate_select / simulate_place / simulate_render），
+它们的模型只保留加载函数（PENDING_STAGE_MODELS），接入真实引擎时再登记，
+因此 /models 中的命中率与内存预算目前只反映阶段1 的模型。
+
+torch / diffusers / transformers / ldm 在加载函数内导入，未安装时只影响对应模型的加载，Worker 仍可启动。
+"""
+
+import os
+import sys
+
+from model_manager import ModelManager
+
+MODEL_DEVICE = os.getenv("MODEL_DEVICE", "cuda")
+# 阶段1 分割的推理后端（torch / int8 / onnx / onnx-int8，后三种在 CPU 上运行，见 rcsd.SegFormerCPU）
+SEG_BACKEND = os.getenv("SEG_BACKEND", "torch").lower()
+SEG_THREADS = int(os.getenv("SEG_THREADS", 0))
+SEG_ONNX_PATH = os.getenv("SEG_ONNX_PATH", "segformer-b3-ade.onnx")
+
+# 阶段脚本所在目录（目录名含空格，不是 Python 包，导入前加入 sys.path）
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGE1_DIR = os.path.join(REPO_ROOT, "stage1_clutter removal")
+
+SEGFORMER_MODEL = "nvidia/segformer-b3-finetuned-ade-512-512"
+SD_INPAINT_MODEL = "runwayml/stable-diffusion-inpainting"
+SD_BASE_MODEL = "runwayml/stable-diffusion-v1-5"
+CONTROLNET_CANNY_MODEL = "lllyasviel/sd-controlnet-canny"
+SAFETY_CHECKER_MODEL = "CompVis/stable-diffusion-safety-checker"
+ZERO123_CKPT = os.getenv("ZERO123_CKPT", "105000.ckpt")
+ZERO123_CONFIG = os.getenv("ZERO123_CONFIG", "configs/sd-objaverse-finetune-c_concat-256.yaml")
+
+
+def load_segformer(device: str = MODEL_DEVICE):
+    """SegFormer 语义分割（加载到 device），返回 (processor, model)"""
+    from transformers import AutoImageProcessor, AutoModelForSemanticSegmentation
+
+    processor = AutoImageProcessor.from_pretrained(SEGFORMER_MODEL)
+    model = AutoModelForSemanticSegmentation.from_pretrained(SEGFORMER_MODEL)
+    model.to(device)
+    model.eval()
+    return processor, model
+
+
+def load_segformer_cpu():
+    """SegFormer CPU 推理后端（已预热），返回 (processor, SegFormerCPU)"""
+    rcsd = import_stage1()
+    processor, model = load_segformer("cpu")
+    segmenter = rcsd.SegFormerCPU(model, SEG_BACKEND, SEG_THREADS, SEG_ONNX_PATH)
+    segmenter.warmup()
+    return processor, segmenter
+
+
+def load_sd_inpaint():
+    """Stable Diffusion Inpainting（去杂物）"""
+    import torch
+    from diffusers import StableDiffusionInpaintPipeline
+
+    pipe = StableDiffusionInpaintPipeline.from_pretrained(SD_INPAINT_MODEL, torch_dtype=torch.float16)
+    return pipe.to(MODEL_DEVICE)
+
+
+def load_controlnet_inpaint():
+    """ControlNet（Canny）+ Stable Diffusion Inpaint（家具渲染）"""
+    import torch
+    from diffusers import ControlNetModel, StableDiffusionControlNetInpaintPipeline, UniPCMultistepScheduler
+
+    controlnet = ControlNetModel.from_pretrained(CONTROLNET_CANNY_MODEL, torch_dtype=torch.float16)
+    pipe = StableDiffusionControlNetInpaintPipeline.from_pretrained(
+        SD_BASE_MODEL, controlnet=controlnet, torch_dtype=torch.float16
+    )
+    pipe.scheduler = UniPCMultistepScheduler.from_config(pipe.scheduler.config)
+    pipe.enable_attention_slicing()
+    return pipe.to(MODEL_DEVICE)
+
+
+def load_sd_img2img():
+    """Stable Diffusion Img2Img（渲染结果的整体协调）"""
+    import torch
+    from diffusers import StableDiffusionImg2ImgPipeline, UniPCMultistepScheduler
+
+    pipe = StableDiffusionImg2ImgPipeline.from_pretrained(SD_BASE_MODEL, torch_dtype=torch.float16)
+    pipe.scheduler = UniPCMultistepScheduler.from_config(pipe.scheduler.config)
+    return pipe.to(MODEL_DEVICE)
+
+
+def load_zero123():
+    """Zero123 多视角生成模型（turncam）"""
+    import torch
+    from ldm.util import instantiate_from_config
+    from omegaconf import OmegaConf
+
+    config = OmegaConf.load(ZERO123_CONFIG)
+    state_dict = torch.load(ZERO123_CKPT, map_location="cpu")["state_dict"]
+    model = instantiate_from_config(config.model)
+    model.load_state_dict(state_dict, strict=False)
+    model.to(MODEL_DEVICE)
+    model.eval()
+    return model
+
+
+def load_carvekit():
+    """carvekit 抠图"""
+    from ldm.util import create_carvekit_interface
+
+    return create_carvekit_interface()
+
+
+def load_safety_checker():
+    """NSFW 安全检查，返回 (checker, feature_extractor)"""
+    from diffusers.pipelines.stable_diffusion import StableDiffusionSafetyChecker
+    from transformers import AutoFeatureExtractor
+
+    checker = StableDiffusionSafetyChecker.from_pretrained(SAFETY_CHECKER_MODEL).to(MODEL_DEVICE)
+    checker.concept_embeds_weights *= 1.07
+    checker.special_care_embeds_weights *= 1.07
+    return checker, AutoFeatureExtractor.from_pretrained(SAFETY_CHECKER_MODEL)
+
+
+# 模型名 -> (加载函数, 预计占用 MB)
+STAGE_MODELS = {
+    "segformer": (load_segformer, 200),
+    "segformer_cpu": (load_segformer_cpu, 300),
+    "sd_inpaint": (load_sd_inpaint, 2200),
+}
+
+# 阶段2、阶段3 接入真实引擎后再移入 STAGE_MODELS（目前不登记）
+PENDING_STAGE_MODELS = {
+    "zero123": (load_zero123, 4500),
+    "carvekit": (load_carvekit, 300),
+    "safety_checker": (load_safety_checker, 1200),
+    "controlnet_inpaint": (load_controlnet_inpaint, 3000),
+    "sd_img2img": (load_sd_img2img, 2200),
+}
+
+
+def import_stage1():
+    """导入阶段1的 rcsd 模块（EmptyRoomEngine）"""
+    if STAGE1_DIR not in sys.path:
+        sys.path.insert(0, STAGE1_DIR)
+    import rcsd
+    return rcsd
+
+
+def register_stage_models(manager: ModelManager) -> ModelManager:
+    """把各阶段的模型登记到管理器"""
+    for name, (loader, estimated_mb) in STAGE_MODELS.items():
+        manager.register(name, loader, estimated_mb)
+    return manager
@@ -0,0 +1,388 @@
+"""
+阶段流水线：把各阶段建模为 DAG，按输入哈希缓存每个节点的产物
+
+    empty_room（阶段1 去杂物）→ select（阶段2 家具选择）→ place（阶段2 家具摆放）→ render（阶段3 渲染）
+
+- 节点键 = 哈希(节点名, 节点版本, 上游节点键, 节点使用的参数)；根节点还包含原图内容的哈希
+- 节点产物（文件 + JSON 数据）保存在 STAGE_CACHE_DIR 下，键相同则直接复用，不再执行
+- 只修改风格或预算时，empty_room 的键不变，只重新执行失效的下游节点
+- 缓存总大小超过 STAGE_CACHE_MAX_MB 时按最近使用时间淘汰（大小增量统计，只在超出上限时扫描缓存目录）
+- run() 返回的节点产物在调用方 release() 之前被钉住，淘汰时跳过（仅对本进程内的读取有效）
+
+节点函数签名: func(ctx: StageContext) -> None，通过 ctx.output_path() 写文件、ctx.data 写 JSON 数据。
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Iterable, List, Optional
+
+from artifacts import shard_dir
+from metrics import Counter, Histogram
+
+STAGE_CACHE_DIR = os.getenv("STAGE_CACHE_DIR", "stage_cache")
+STAGE_CACHE_MAX_MB = int(os.getenv("STAGE_CACHE_MAX_MB", 2048))
+MANIFEST_NAME = "manifest.json"
+
+STAGE_RUNS = Counter("stage_node_runs_total", "流水线节点执行次数（outcome: hit 复用缓存 / miss 重新执行）")
+STAGE_DURATION = Histogram("stage_node_duration_seconds", "流水线节点执行耗时（秒，不含缓存命中）",
+                           buckets=(0.1, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320))
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """分块计算文件内容的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StageNode:
+    """
+    流水线节点
+
+    Args:
+        name: 节点名
+        func: 节点函数 func(ctx: StageContext)
+        deps: 上游节点名
+        params: 节点使用的任务参数名（只有这些参数变化时节点才失效）
+        version: 节点实现版本，修改算法后递增使旧缓存失效
+    """
+
+    def __init__(self, name: str, func: Callable[["StageContext"], None], deps: Iterable[str] = (),
+                 params: Iterable[str] = (), version: str = "1"):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.params = list(params)
+        self.version = version
+
+
+class NodeResult:
+    """节点产物：文件名 -> 缓存中的路径，以及 JSON 数据"""
+
+    def __init__(self, node: str, key: str, files: Dict[str, str], data: dict, cached: bool):
+        self.node = node
+        self.key = key
+        self.files = files
+        self.data = data
+        self.cached = cached
+
+    def file(self, name: str) -> str:
+        return self.files[name]
+
+
+class StageContext:
+    """传给节点函数的输入与输出位置"""
+
+    def __init__(self, node: StageNode, source_path: str, inputs: Dict[str, NodeResult],
+                 params: dict, workdir: str):
+        self.node = node
+        self.source_path = source_path
+        self.inputs = inputs
+        self.params = params
+        self.workdir = workdir
+        self.files: Dict[str, str] = {}
+        self.data: dict = {}
+
+    def output_path(self, name: str, filename: str) -> str:
+        """登记一个输出文件并返回写入路径"""
+        self.files[name] = filename
+        return os.path.join(self.workdir, filename)
+
+
+class StageCache:
+    """
+    节点产物缓存（{root}/{分片}/{节点键}/ 下保存产物文件与 manifest.json）
+    """
+
+    def __init__(self, root: str = STAGE_CACHE_DIR, max_mb: int = STAGE_CACHE_MAX_MB):
+        self.root = root
+        self.max_bytes = max_mb * 1024 * 1024
+        os.makedirs(root, exist_ok=True)
+        # 缓存总大小（首次写入时扫描一次，之后按写入增量累加；其他进程写入的条目在下次淘汰扫描时计入）
+        self._size: Optional[int] = None
+        self._size_lock = threading.Lock()
+        # 节点键 -> 正在读取的次数，被钉住的条目不会被淘汰
+        self._pins: Dict[str, int] = {}
+        self._pin_lock = threading.Lock()
+
+    def entry_dir(self, key: str) -> str:
+        return os.path.join(shard_dir(self.root, key), key)
+
+    def pin(self, key: str) -> None:
+        """钉住条目（在 get() 之前调用），直到对应的 unpin()"""
+        with self._pin_lock:
+            self._pins[key] = self._pins.get(key, 0) + 1
+
+    def unpin(self, key: str) -> None:
+        with self._pin_lock:
+            count = self._pins.get(key, 0) - 1
+            if count > 0:
+                self._pins[key] = count
+            else:
+                self._pins.pop(key, None)
+
+    def get(self, node: str, key: str) -> Optional[NodeResult]:
+        """读取缓存的节点产物，不存在或文件不完整返回 None"""
+        directory = self.entry_dir(key)
+        manifest_path = os.path.join(directory, MANIFEST_NAME)
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        files = {name: os.path.join(directory, filename) for name, filename in manifest["files"].items()}
+        if not all(os.path.isfile(path) for path in files.values()):
+            return None
+        # 更新最近使用时间（淘汰依据）
+        try:
+            os.utime(manifest_path)
+        except OSError:
+            pass
+        return NodeResult(node, key, files, manifest.get("data", {}), cached=True)
+
+    def new_workdir(self) -> str:
+        """节点执行用的临时目录（与缓存在同一文件系统，完成后原子改名）"""
+        workdir = os.path.join(self.root, "tmp", uuid.uuid4().hex)
+        os.makedirs(workdir)
+        return workdir
+
+    def put(self, ctx: StageContext, key: str) -> NodeResult:
+        """把节点执行结果从临时目录移入缓存"""
+        size = sum(os.path.getsize(os.path.join(ctx.workdir, filename)) for filename in ctx.files.values())
+        manifest = {
+            "node": ctx.node.name,
+            "version": ctx.node.version,
+            "files": ctx.files,
+            "data": ctx.data,
+            "size": size,
+            "created_at": time.time(),
+        }
+        with open(os.path.join(ctx.workdir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+
+        directory = self.entry_dir(key)
+        os.makedirs(os.path.dirname(directory), exist_ok=True)
+        try:
+            os.rename(ctx.workdir, directory)
+            self._add_size(size)
+        except OSError:
+            # 其他进程已写入相同的键（内容等价），丢弃本次结果
+            shutil.rmtree(ctx.workdir, ignore_errors=True)
+        return self.get(ctx.node.name, key) or NodeResult(
+            ctx.node.name, key, {name: os.path.join(directory, filename) for name, filename in ctx.files.items()},
+            ctx.data, cached=False)
+
+    def _add_size(self, size: int) -> None:
+        """累加新条目的大小，超过上限时淘汰"""
+        if self.max_bytes <= 0:
+            return
+        with self._size_lock:
+            if self._size is None:
+                self._size = sum(entry_size for _, entry_size, _ in self._scan())
+            else:
+                self._size += size
+            over = self._size > self.max_bytes
+        if over:
+            self.prune()
+
+    def _scan(self) -> List[tuple]:
+        """扫描缓存目录，返回 [(最近使用时间, 大小, 目录), ...]"""
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root:
+                # 跳过正在执行的节点的临时目录
+                dirnames[:] = [d for d in dirnames if d != "tmp"]
+            if MANIFEST_NAME not in filenames:
+                continue
+            dirnames[:] = []
+            manifest_path = os.path.join(dirpath, MANIFEST_NAME)
+            try:
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    size = int(json.load(f).get("size", 0))
+                entries.append((os.path.getmtime(manifest_path), size, dirpath))
+            except (OSError, ValueError):
+                continue
+        return entries
+
+    def prune(self) -> int:
+        """
+        缓存超过大小上限时淘汰最久未使用的条目（跳过被钉住的条目）
+
+        Returns:
+            int: 淘汰的条目数
+        """
+        if self.max_bytes <= 0:
+            return 0
+        entries = self._scan()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, dirpath in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            # 持有锁删除，避免读取方在检查之后、删除之前钉住条目
+            with self._pin_lock:
+                if os.path.basename(dirpath) in self._pins:
+                    continue
+                shutil.rmtree(dirpath, ignore_errors=True)
+            total -= size
+            removed += 1
+        with self._size_lock:
+            self._size = total
+        return removed
+
+
+class StagePipeline:
+    """
+    按 DAG 执行阶段节点，节点产物按输入哈希缓存（线程安全，相同的节点键只执行一次）
+    """
+
+    def __init__(self, nodes: Iterable[StageNode], cache: Optional[StageCache] = None):
+        self.nodes: Dict[str, StageNode] = {}
+        for node in nodes:
+            missing = [dep for dep in node.deps if dep not in self.nodes]
+            if missing:
+                raise ValueError(f"节点 {node.name} 的上游 {missing} 未定义（节点需按拓扑顺序给出）")
+            self.nodes[node.name] = node
+        self.cache = cache or StageCache()
+        # 节点键 -> [锁, 引用数]：最后一个使用者释放后才删除，等待中的线程与新到达的线程共用同一把锁
+        self._locks: Dict[str, list] = {}
+        self._locks_guard = threading.Lock()
+
+    def _acquire_key(self, key: str) -> threading.Lock:
+        with self._locks_guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def _release_key(self, key: str) -> None:
+        with self._locks_guard:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def node_key(self, node: StageNode, source_hash: str, dep_keys: Dict[str, str], params: dict) -> str:
+        """节点键：节点定义 + 上游键 + 参数（根节点包含原图哈希）"""
+        payload = {
+            "node": node.name,
+            "version": node.version,
+            "deps": dep_keys,
+            "params": {name: params.get(name) for name in node.params},
+        }
+        if not node.deps:
+            payload["source"] = source_hash
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _required(self, targets: Iterable[str]) -> List[str]:
+        """目标节点及其全部上游（按拓扑顺序）"""
+        needed = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in self.nodes:
+                raise KeyError(f"未定义的节点: {name}")
+            if name not in needed:
+                needed.add(name)
+                pending.extend(self.nodes[name].deps)
+        return [name for name in self.nodes if name in needed]
+
+    def run(self, source_path: str, params: dict, targets: Optional[Iterable[str]] = None,
+            progress: Optional[Callable[[str, bool], None]] = None) -> Dict[str, NodeResult]:
+        """
+        执行流水线
+
+        Args:
+            source_path: 原图路径
+            params: 任务参数（decoration_style / max_price / room_type 等）
+            targets: 需要的节点（默认全部），只执行它们及其上游
+            progress: 回调 progress(节点名, 是否命中缓存)，在每个节点开始前调用
+
+        Returns:
+            dict: 节点名 -> NodeResult（产物文件被钉住，读取完成后需调用 release(results)）
+        """
+        source_hash = file_sha256(source_path)
+        results: Dict[str, NodeResult] = {}
+        try:
+            for name in self._required(targets or list(self.nodes)):
+                node = self.nodes[name]
+                inputs = {dep: results[dep] for dep in node.deps}
+                key = self.node_key(node, source_hash, {dep: inputs[dep].key for dep in node.deps}, params)
+
+                lock = self._acquire_key(key)
+                try:
+                    with lock:
+                        # 先钉住再读取：下游节点执行与调用方复制产物期间条目不会被淘汰
+                        self.cache.pin(key)
+                        try:
+                            result = self.cache.get(name, key)
+                            if progress is not None:
+                                progress(name, result is not None)
+                            if result is not None:
+                                STAGE_RUNS.inc(node=name, outcome="hit")
+                            else:
+                                STAGE_RUNS.inc(node=name, outcome="miss")
+                                result = self._execute(node, key, source_path, inputs, params)
+                        except BaseException:
+                            self.cache.unpin(key)
+                            raise
+                finally:
+                    self._release_key(key)
+                results[name] = result
+        except BaseException:
+            self.release(results)
+            raise
+        return results
+
+    def release(self, results: Dict[str, NodeResult]) -> None:
+        """释放 run() 钉住的节点产物"""
+        for result in results.values():
+            self.cache.unpin(result.key)
+
+    def _execute(self, node: StageNode, key: str, source_path: str,
+                 inputs: Dict[str, NodeResult], params: dict) -> NodeResult:
+        ctx = StageContext(node, source_path, inputs, {name: params.get(name) for name in node.params},
+                           self.cache.new_workdir())
+        started = time.perf_counter()
+        try:
+            node.func(ctx)
+        except BaseException:
+            shutil.rmtree(ctx.workdir, ignore_errors=True)
+            raise
+        STAGE_DURATION.observe(time.perf_counter() - started, node=node.name)
+        result = self.cache.put(ctx, key)
+        result.cached = False
+        return result
+
+
+def build_virtual_staging_pipeline(empty_room: Callable[[StageContext], None],
+                                   select: Callable[[StageContext], None],
+                                   place: Callable[[StageContext], None],
+                                   render: Callable[[StageContext], None],
+                                   cache: Optional[StageCache] = None,
+                                   versions: Optional[Dict[str, str]] = None) -> StagePipeline:
+    """
+    构建 empty_room → select → place → render 流水线
+
+    Args:
+        empty_room: 阶段1，输出文件 "image"（空房间）
+        select: 阶段2 家具选择，输出文件 "selection"（selection.json），数据 "furniture_list"
+        place: 阶段2 家具摆放，输出文件 "composed"（家具草图）
+        render: 阶段3 渲染，输出文件 "image"（效果图）
+        versions: 节点名 -> 实现版本（更换节点实现时使用不同的版本，避免复用旧实现的缓存）
+    """
+    versions = versions or {}
+    return StagePipeline([
+        StageNode("empty_room", empty_room, version=versions.get("empty_room", "1")),
+        StageNode("select", select, deps=["empty_room"], params=["decoration_style", "max_price", "room_type"],
+                  version=versions.get("select", "1")),
+        StageNode("place", place, deps=["empty_room", "select"], version=versions.get("place", "1")),
+        StageNode("render", render, deps=["empty_room", "place"], params=["decoration_style"],
+                  version=versions.get("render", "1")),
+    ], cache)
@@ -0,0 +1,336 @@
+"""
+任务产物存储后端（api_server.py 与 worker_server.py 共用）
+
+产物用存储键标识: "uploads/{filename}" / "output/{filename}"（文件名以 task_id 开头）。
+
+- STORAGE_BACKEND=local（默认）: 产物保存在本地 uploads/、output/ 的分片目录中（见 artifacts.py），
+  API 与 Worker 需要共享文件系统
+- STORAGE_BACKEND=s3: 产物保存在 S3 兼容的对象存储（AWS S3 / MinIO），本地分片目录只作为读写缓存，
+  Worker 可以部署在其他节点；浏览器通过预签名 URL 直接下载，产物字节不经过 API 进程
+
+API 节点本地缓存中的文件与 local 模式一样由 api_server 的产物清理删除；Worker 节点没有产物清理，
+由 S3Storage.prune_cache() 按大小上限（STORAGE_CACHE_MAX_MB）淘汰最久未使用的缓存文件。
+对象存储中的过期对象请使用存储桶的生命周期规则（lifecycle）清理。
+
+连通性检查（例如本地 MinIO）: STORAGE_BACKEND=s3 python storage.py
+
+所有方法都是同步阻塞调用，在事件循环中请通过 asyncio.to_thread 调用。
+"""
+
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from artifacts import artifact_path, locate_artifact
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").lower()
+
+# S3 兼容存储配置（MinIO 示例: S3_ENDPOINT_URL=http://localhost:9000）
+S3_BUCKET = os.getenv("S3_BUCKET", "capstone-artifacts")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+S3_PREFIX = os.getenv("S3_PREFIX", "")
+S3_PRESIGN_EXPIRES = int(os.getenv("S3_PRESIGN_EXPIRES", 3600))  # 预签名 URL 有效期（秒）
+S3_PRESIGN = os.getenv("S3_PRESIGN", "1") != "0"  # 关闭后由 API 从本地缓存返回文件
+
+# 分段上传：超过阈值的文件按 S3_MULTIPART_CHUNK_SIZE 分段并发上传 / 下载
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+S3_MULTIPART_CHUNK_SIZE = max(5 * 1024 * 1024, int(os.getenv("S3_MULTIPART_CHUNK_SIZE", 8 * 1024 * 1024)))
+S3_MAX_CONCURRENCY = int(os.getenv("S3_MAX_CONCURRENCY", 4))
+
+# 远端存储的本地缓存（Worker 节点）：总大小上限、最近使用过的文件的最小保留时间（秒，避免删除处理中的文件）
+STORAGE_CACHE_ROOTS = ("uploads", "output")
+STORAGE_CACHE_MAX_MB = int(os.getenv("STORAGE_CACHE_MAX_MB", 2048))
+STORAGE_CACHE_MIN_AGE = int(os.getenv("STORAGE_CACHE_MIN_AGE", 1800))
+
+CONTENT_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".json": "application/json",
+}
+
+
+def storage_key(folder: str, filename: str) -> str:
+    """根据产物目录（uploads / output）与文件名生成存储键"""
+    return f"{folder.strip('/')}/{filename}"
+
+
+def split_key(key: str) -> Tuple[str, str]:
+    """拆分存储键为 (目录, 文件名)"""
+    folder, _, filename = key.partition("/")
+    return folder, filename
+
+
+def key_from_url(url: Optional[str]) -> Optional[str]:
+    """将 /uploads/{filename}、/output/{filename} 形式的 URL 转换为存储键"""
+    if not url or not url.startswith("/"):
+        return None
+    key = url.lstrip("/")
+    folder, filename = split_key(key)
+    if folder not in ("uploads", "output") or not filename or "/" in filename:
+        return None
+    return key
+
+
+def _is_not_found(error) -> bool:
+    """判断 botocore ClientError 是否为对象不存在"""
+    return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+
+class LocalStorage:
+    """
+    本地文件系统存储（产物位于 uploads/、output/ 的分片目录中）
+    """
+
+    name = "local"
+    remote = False  # 产物是否保存在远端（需要上传 / 下载）
+
+    def local_path(self, key: str) -> str:
+        """新产物在本地的写入路径（自动创建分片目录）"""
+        return artifact_path(*split_key(key))
+
+    def put_file(self, key: str, src_path: str) -> None:
+        """发布已写好的本地文件；文件不在规范路径时移动过去"""
+        dest_path = self.local_path(key)
+        if os.path.abspath(src_path) != os.path.abspath(dest_path):
+            shutil.move(src_path, dest_path)
+
+    @contextmanager
+    def open_write(self, key: str) -> Iterator[BinaryIO]:
+        """流式写入产物（先写临时文件，成功后原子替换）"""
+        dest_path = self.local_path(key)
+        tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                yield f
+            os.replace(tmp_path, dest_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def fetch(self, key: str) -> Optional[str]:
+        """返回产物的本地路径，不存在返回 None"""
+        return locate_artifact(*split_key(key))
+
+    def open_read(self, key: str) -> BinaryIO:
+        """
+        打开产物用于流式读取（调用方负责关闭）
+
+        Raises:
+            FileNotFoundError: 产物不存在
+        """
+        local_path = LocalStorage.fetch(self, key)
+        if local_path is None:
+            raise FileNotFoundError(key)
+        return open(local_path, "rb")
+
+    def is_cached(self, key: str) -> bool:
+        """产物是否已在本地"""
+        return LocalStorage.fetch(self, key) is not None
+
+    def exists(self, key: str) -> bool:
+        return self.fetch(key) is not None
+
+    def prune_cache(self) -> int:
+        """本地文件即产物本身，不清理"""
+        return 0
+
+    def presigned_url(self, key: str) -> Optional[str]:
+        """本地存储没有直链，由 API 返回文件"""
+        return None
+
+
+class S3Storage(LocalStorage):
+    """
+    S3 兼容对象存储（本地分片目录作为读写缓存）
+    """
+
+    name = "s3"
+    remote = True
+
+    def __init__(self, bucket: str = S3_BUCKET, endpoint_url: Optional[str] = S3_ENDPOINT_URL,
+                 region: str = S3_REGION, prefix: str = S3_PREFIX):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=s3 需要安装 boto3: pip install boto3")
+
+        self.client_error = ClientError
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        # 凭证按 boto3 的默认方式读取（AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY 等）
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            config=Config(signature_version="s3v4", s3={"addressing_style": "path" if endpoint_url else "auto"}),
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=S3_MULTIPART_CHUNK_SIZE,
+            max_concurrency=S3_MAX_CONCURRENCY,
+        )
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    @staticmethod
+    def _content_type(key: str) -> str:
+        return CONTENT_TYPES.get(os.path.splitext(key)[1].lower(), "application/octet-stream")
+
+    def put_file(self, key: str, src_path: str) -> None:
+        """上传本地文件（大文件自动分段上传），并保留在本地缓存中"""
+        super().put_file(key, src_path)
+        self.client.upload_file(
+            self.local_path(key), self.bucket, self._object_key(key),
+            ExtraArgs={"ContentType": self._content_type(key)},
+            Config=self.transfer_config,
+        )
+
+    @contextmanager
+    def open_write(self, key: str) -> Iterator[BinaryIO]:
+        """流式写入产物：写入本地缓存文件，关闭后上传"""
+        with super().open_write(key) as f:
+            yield f
+        self.put_file(key, self.local_path(key))
+
+    def fetch(self, key: str) -> Optional[str]:
+        """返回产物的本地缓存路径，缓存中没有时从对象存储分段下载"""
+        local_path = super().fetch(key)
+        if local_path is not None:
+            # 更新最近使用时间（本地缓存淘汰依据）
+            try:
+                os.utime(local_path)
+            except OSError:
+                pass
+            return local_path
+        dest_path = self.local_path(key)
+        tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+        try:
+            self.client.download_file(self.bucket, self._object_key(key), tmp_path, Config=self.transfer_config)
+            os.replace(tmp_path, dest_path)
+        except self.client_error as e:
+            if _is_not_found(e):
+                return None
+            raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return dest_path
+
+    def open_read(self, key: str) -> BinaryIO:
+        """流式读取产物：本地缓存中有则读本地文件，否则直接读取对象存储的响应流（不写入本地缓存）"""
+        if self.is_cached(key):
+            return super().open_read(key)
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))["Body"]
+        except self.client_error as e:
+            if _is_not_found(e):
+                raise FileNotFoundError(key)
+            raise
+
+    def exists(self, key: str) -> bool:
+        if super().fetch(key) is not None:
+            return True
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except self.client_error as e:
+            if _is_not_found(e):
+                return False
+            raise
+
+    def prune_cache(self, max_mb: int = STORAGE_CACHE_MAX_MB, min_age: int = STORAGE_CACHE_MIN_AGE) -> int:
+        """
+        本地缓存超过大小上限时淘汰最久未使用的文件（对象存储中仍有副本）
+
+        Args:
+            max_mb: 缓存大小上限（MB）
+            min_age: 最近 min_age 秒内使用过的文件不删除（可能正在处理）
+
+        Returns:
+            int: 删除的文件数
+        """
+        entries = []
+        for root in STORAGE_CACHE_ROOTS:
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    if filename.endswith(".tmp"):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        max_bytes = max_mb * 1024 * 1024
+        cutoff = time.time() - min_age
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= max_bytes or mtime > cutoff:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    def check(self) -> None:
+        """检查存储桶的读写权限：写入、读取并删除一个测试对象（失败时抛出异常）"""
+        self.client.head_bucket(Bucket=self.bucket)
+        key = self._object_key(f"healthcheck/{uuid.uuid4().hex}")
+        payload = b"ok"
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=payload)
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+            if body.read() != payload:
+                raise RuntimeError("读取的测试对象内容不一致")
+        finally:
+            self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def presigned_url(self, key: str) -> Optional[str]:
+        """生成预签名下载 URL（S3_PRESIGN=0 时返回 None）"""
+        if not S3_PRESIGN:
+            return None
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self._object_key(key)},
+            ExpiresIn=S3_PRESIGN_EXPIRES,
+        )
+
+
+def create_storage(backend: str = STORAGE_BACKEND) -> LocalStorage:
+    """根据配置创建存储后端"""
+    if backend == "s3":
+        storage = S3Storage()
+        print(f"✓ 产物存储: S3 兼容存储 bucket={storage.bucket} endpoint={S3_ENDPOINT_URL or 'AWS'}")
+        return storage
+    if backend != "local":
+        raise ValueError(f"不支持的存储后端: {backend}（local / s3）")
+    return LocalStorage()
+
+
+if __name__ == "__main__":
+    # 连通性检查: STORAGE_BACKEND=s3 S3_ENDPOINT_URL=http://localhost:9000 python storage.py
+    backend = create_storage()
+    if not backend.remote:
+        print("STORAGE_BACKEND=local，无需检查")
+    else:
+        try:
+            backend.check()
+            print(f"✓ 存储桶 {backend.bucket} 可读写")
+        except Exception as e:
+            print(f"✗ 存储桶 {backend.bucket} 检查失败: {e}")
+            raise SystemExit(1)
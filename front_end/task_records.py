@@ -0,0 +1,123 @@
+"""
+任务记录的 Redis 存储格式（api_server.py 与 worker_server.py 共用）
+
+- task_storage:{task_id}   Hash，每个字段一个 JSON 值，状态变化只 HSET 变化的字段
+- task_payload:{task_id}   String，大字段（家具列表等）单独存放，只在任务完成后读取
+- task_index:{status}      Sorted Set，按状态索引任务，score 为进入该状态的时间戳
+
+写入函数只向 pipeline 追加命令，同步与异步 Redis 客户端的 pipeline 都可以使用。
+"""
+
+import json
+import time
+from typing import Dict, Optional, Tuple
+
+TASK_STORAGE_PREFIX = "task_storage:"
+TASK_PAYLOAD_PREFIX = "task_payload:"
+TASK_STATUS_INDEX_PREFIX = "task_index:"
+TASK_TTL = 3600  # 任务信息保存时间（秒）
+
+# 建立索引的状态
+INDEXED_STATUSES = ("queued", "processing", "completed", "failed")
+
+# 体积较大、只在任务完成后需要的字段
+PAYLOAD_FIELDS = ("furniture_list", "furniture_images")
+
+
+def split_payload(task_data: dict) -> Tuple[dict, dict]:
+    """
+    拆分普通字段与大字段
+
+    Returns:
+        tuple: (普通字段, 大字段)
+    """
+    fields = {k: v for k, v in task_data.items() if k not in PAYLOAD_FIELDS}
+    payload = {k: v for k, v in task_data.items() if k in PAYLOAD_FIELDS}
+    return fields, payload
+
+
+def encode_fields(fields: dict) -> Dict[str, str]:
+    """将字段值编码为 JSON 字符串（保留数字、None、列表等类型）"""
+    return {k: json.dumps(v, ensure_ascii=False) for k, v in fields.items()}
+
+
+def decode_fields(raw: Dict[str, str]) -> dict:
+    """解码 HGETALL 的结果"""
+    fields = {}
+    for k, v in raw.items():
+        try:
+            fields[k] = json.loads(v)
+        except (TypeError, ValueError):
+            fields[k] = v
+    return fields
+
+
+def add_task_write(pipe, task_id: str, changes: dict, ttl: int = TASK_TTL,
+                   now: Optional[float] = None) -> None:
+    """
+    向 pipeline 追加写任务字段的命令
+
+    Args:
+        pipe: Redis pipeline（同步或异步）
+        task_id: 任务ID
+        changes: 需要更新的字段（可以是完整任务数据，也可以只是变化的字段）
+        ttl: 过期时间（秒）
+        now: 当前时间戳（用于状态索引）
+    """
+    now = time.time() if now is None else now
+    key = f"{TASK_STORAGE_PREFIX}{task_id}"
+    fields, payload = split_payload(changes)
+
+    if fields:
+        pipe.hset(key, mapping=encode_fields(fields))
+    pipe.expire(key, ttl)
+
+    if payload:
+        payload_key = f"{TASK_PAYLOAD_PREFIX}{task_id}"
+        pipe.set(payload_key, json.dumps(payload, ensure_ascii=False), ex=ttl)
+
+    status = fields.get("status")
+    if status is not None:
+        for indexed in INDEXED_STATUSES:
+            index_key = f"{TASK_STATUS_INDEX_PREFIX}{indexed}"
+            if indexed == status:
+                pipe.zadd(index_key, {task_id: now})
+                pipe.expire(index_key, ttl)
+            else:
+                pipe.zrem(index_key, task_id)
+        # 顺带清理已过期任务的索引项
+        pipe.zremrangebyscore(f"{TASK_STATUS_INDEX_PREFIX}{status}", "-inf", now - ttl)
+
+
+def add_task_read(pipe, task_id: str) -> None:
+    """向 pipeline 追加读取任务普通字段的命令（HGETALL）"""
+    pipe.hgetall(f"{TASK_STORAGE_PREFIX}{task_id}")
+
+
+def merge_task(raw_fields: Dict[str, str], raw_payload: Optional[str]) -> Optional[dict]:
+    """
+    合并 HGETALL 与大字段的读取结果
+
+    Returns:
+        dict: 任务数据，不存在返回 None
+    """
+    if not raw_fields:
+        return None
+    task_data = decode_fields(raw_fields)
+    if raw_payload:
+        try:
+            task_data.update(json.loads(raw_payload))
+        except (TypeError, ValueError):
+            pass
+    return task_data
+
+
+def changed_fields(before: dict, after: dict) -> dict:
+    """计算两次任务数据之间变化的字段"""
+    return {k: v for k, v in after.items() if k not in before or before[k] != v}
+
+
+def status_index_key(status: str) -> str:
+    """状态索引键"""
+    return f"{TASK_STATUS_INDEX_PREFIX}{status}"
+
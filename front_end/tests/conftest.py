@@ -0,0 +1,8 @@
+"""测试公共配置：后端模块位于 front_end/ 根目录，按模块名直接导入"""
+
+import os
+import sys
+
+FRONT_END_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if FRONT_END_DIR not in sys.path:
+    sys.path.insert(0, FRONT_END_DIR)
@@ -0,0 +1,54 @@
+"""admission.estimate_backlog：准入阈值与 Retry-After"""
+
+import pytest
+
+import admission
+from admission import estimate_backlog
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_MAX_QUEUE_DEPTH", 10)
+    monkeypatch.setattr(admission, "ADMISSION_MAX_WAIT", 100)
+    monkeypatch.setattr(admission, "WORKER_CONCURRENCY", {"denoise": 2})
+    monkeypatch.setattr(admission, "WORKER_INSTANCES", 1)
+
+
+def test_average_uses_samples_or_default():
+    assert admission.average_service_time("denoise", ["1", "3", "bad"]) == 2
+    assert admission.average_service_time("denoise", None) == admission.DEFAULT_SERVICE_TIME["denoise"]
+
+
+def test_empty_queue_is_admitted():
+    backlog = estimate_backlog("denoise", 0, ["4"])
+    assert backlog["admitted"]
+    assert backlog["estimated_wait"] == 4
+    assert backlog["retry_after"] == 0
+
+
+def test_wait_scales_with_worker_slots():
+    backlog = estimate_backlog("denoise", 6, ["4"])
+    # 6 个排队任务由 2 个槽位消化（12 秒），再加本任务 4 秒
+    assert backlog["estimated_wait"] == 16
+
+
+def test_rejects_at_queue_depth_limit():
+    assert estimate_backlog("denoise", 9, ["1"])["admitted"]
+    backlog = estimate_backlog("denoise", 10, ["1"])
+    assert not backlog["admitted"]
+    assert backlog["retry_after"] >= 1
+
+
+def test_rejects_when_wait_exceeds_limit():
+    backlog = estimate_backlog("denoise", 5, ["60"])
+    assert backlog["estimated_wait"] == 210
+    assert not backlog["admitted"]
+    assert backlog["retry_after"] == 110
+
+
+def test_batch_counts_every_incoming_task():
+    assert estimate_backlog("denoise", 5, ["1"], incoming=5)["admitted"]
+    backlog = estimate_backlog("denoise", 5, ["1"], incoming=6)
+    assert not backlog["admitted"]
+    # 按批次中最后一个任务估算等待时间
+    assert estimate_backlog("denoise", 0, ["4"], incoming=5)["estimated_wait"] == 12
@@ -0,0 +1,117 @@
+"""diffusion_batcher：微批合并、拆分与失败重试"""
+
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+from diffusion_batcher import DiffusionBatcher, MicroBatcher, _freeze
+
+
+class RecordingRunner:
+    def __init__(self, fail_batches: bool = False):
+        self.batches = []
+        self.fail_batches = fail_batches
+        self.lock = threading.Lock()
+
+    def __call__(self, key, inputs):
+        with self.lock:
+            self.batches.append((key, list(inputs)))
+        if self.fail_batches and len(inputs) > 1:
+            raise RuntimeError("out of memory")
+        if "bad" in inputs:
+            raise ValueError("bad input")
+        return [f"{key}:{value}" for value in inputs]
+
+
+def test_compatible_requests_are_merged():
+    runner = RecordingRunner()
+    batcher = MicroBatcher(runner, max_batch=4, window=0.05)
+    try:
+        results = batcher.submit_many([("a", 1), ("a", 2), ("b", 3), ("a", 4)])
+    finally:
+        batcher.close()
+    assert results == ["a:1", "a:2", "b:3", "a:4"]
+    assert sorted((key, inputs) for key, inputs in runner.batches) == [("a", [1, 2, 4]), ("b", [3])]
+
+
+def test_batches_are_capped_at_max_batch():
+    runner = RecordingRunner()
+    batcher = MicroBatcher(runner, max_batch=2, window=0.05)
+    try:
+        results = batcher.submit_many([("a", i) for i in range(5)])
+    finally:
+        batcher.close()
+    assert results == [f"a:{i}" for i in range(5)]
+    assert [len(inputs) for _, inputs in runner.batches] == [2, 2, 1]
+
+
+def test_failed_batch_is_retried_one_by_one():
+    runner = RecordingRunner(fail_batches=True)
+    batcher = MicroBatcher(runner, max_batch=4, window=0.05)
+    try:
+        assert batcher.submit_many([("a", 1), ("a", 2)]) == ["a:1", "a:2"]
+        with pytest.raises(ValueError):
+            batcher.submit_many([("a", 3), ("a", "bad")])
+    finally:
+        batcher.close()
+
+
+def test_max_batch_one_runs_in_caller_thread():
+    runner = RecordingRunner()
+    batcher = MicroBatcher(runner, max_batch=1)
+    assert batcher.submit("a", 1) == "a:1"
+    assert batcher._thread is None
+
+
+def test_freeze_keys_unhashable_values_by_identity():
+    class Unhashable:
+        __hash__ = None
+
+    value = Unhashable()
+    assert _freeze({"x": [1, 2], "y": value}) == _freeze({"y": value, "x": (1, 2)})
+    assert _freeze({"y": value}) != _freeze({"y": Unhashable()})
+    hash(_freeze({"y": value}))
+
+
+class FakeImage:
+    size = (512, 512)
+
+
+class FakePipe:
+    device = "cpu"
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        output = type("Output", (), {})()
+        output.images = [f"{prompt}@{kwargs['num_inference_steps']}" for prompt in kwargs["prompt"]]
+        return output
+
+
+class FakeModels:
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    @contextmanager
+    def use(self, name):
+        yield self.pipe
+
+
+def test_diffusion_batcher_passes_shared_kwargs_through():
+    pipe = FakePipe()
+    batcher = DiffusionBatcher(FakeModels(pipe), max_batch=4, window_ms=50)
+    image = FakeImage()
+    try:
+        results = batcher.generate_many("sd_inpaint", [
+            {"prompt": "a", "image": image, "num_inference_steps": 20},
+            {"prompt": "b", "image": image, "num_inference_steps": 20},
+            {"prompt": "c", "image": image, "num_inference_steps": 30},
+        ])
+    finally:
+        batcher.close()
+    assert results == ["a@20", "b@20", "c@30"]
+    assert sorted(len(call["prompt"]) for call in pipe.calls) == [1, 2]
+    assert all(isinstance(call["image"], list) for call in pipe.calls)
@@ -0,0 +1,36 @@
+"""file_serving.parse_range：单区间 Range 头解析"""
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from file_serving import parse_range  # noqa: E402
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=0-0", (0, 0)),
+])
+def test_satisfiable_ranges(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "items=0-99",
+    "bytes=0-10,20-30",
+    "bytes=abc-",
+    "bytes=-",
+    "bytes=5",
+])
+def test_unsupported_ranges_serve_full_file(header):
+    assert parse_range(header, 1000) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=500-100", "bytes=-0"])
+def test_unsatisfiable_ranges(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 1000)
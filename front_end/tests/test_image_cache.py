@@ -0,0 +1,127 @@
+"""image_cache.DerivativeCache：并发请求合并、取消与淘汰"""
+
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("PIL")
+
+import image_cache  # noqa: E402
+from image_cache import DerivativeCache  # noqa: E402
+
+
+class FakeRender:
+    """代替 render_derivative：写入固定大小的文件，可阻塞到 release 被设置"""
+
+    def __init__(self, size: int = 100, error: Exception = None):
+        self.size = size
+        self.error = error
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, src_path, dest_path, width, fmt):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        with open(dest_path, "wb") as f:
+            f.write(b"x" * self.size)
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(b"jpeg")
+    return str(path)
+
+
+@pytest.fixture
+def render(monkeypatch):
+    fake = FakeRender()
+    monkeypatch.setattr(image_cache, "render_derivative", fake)
+    return fake
+
+
+async def wait_started(render: FakeRender) -> None:
+    while not render.started.is_set():
+        await asyncio.sleep(0.001)
+
+
+def test_concurrent_requests_render_once(tmp_path, source, render):
+    cache = DerivativeCache(str(tmp_path / "cache"))
+
+    async def scenario():
+        requests = [asyncio.create_task(cache.get(source, 160, "webp")) for _ in range(5)]
+        await wait_started(render)
+        render.release.set()
+        return await asyncio.gather(*requests)
+
+    names = asyncio.run(scenario())
+    assert render.calls == 1
+    assert len(set(names)) == 1
+    assert os.path.isfile(os.path.join(cache.cache_dir, names[0]))
+    assert cache._inflight == {}
+
+
+def test_first_requester_cancel_does_not_break_others(tmp_path, source, render):
+    cache = DerivativeCache(str(tmp_path / "cache"))
+
+    async def scenario():
+        first = asyncio.create_task(cache.get(source, 160, "webp"))
+        await wait_started(render)
+        second = asyncio.create_task(cache.get(source, 160, "webp"))
+        await asyncio.sleep(0)
+        # 第一个客户端断开
+        first.cancel()
+        await asyncio.sleep(0)
+        render.release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    name = asyncio.run(scenario())
+    assert render.calls == 1
+    assert name in cache._entries
+    assert os.path.isfile(os.path.join(cache.cache_dir, name))
+
+
+def test_render_error_reaches_every_waiter(tmp_path, source, monkeypatch):
+    render = FakeRender(error=OSError("decode failed"))
+    monkeypatch.setattr(image_cache, "render_derivative", render)
+    cache = DerivativeCache(str(tmp_path / "cache"))
+
+    async def scenario():
+        requests = [asyncio.create_task(cache.get(source, 160, "webp")) for _ in range(3)]
+        await wait_started(render)
+        render.release.set()
+        return await asyncio.gather(*requests, return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, OSError) for result in results)
+    assert cache._inflight == {}
+
+
+def test_evicts_lru_outside_grace_period(tmp_path, source, render):
+    render.release.set()
+    cache = DerivativeCache(str(tmp_path / "cache"), max_bytes=250, evict_grace=60)
+
+    async def fetch(width):
+        return await cache.get(source, width, "webp")
+
+    oldest = asyncio.run(fetch(160))
+    asyncio.run(fetch(320))
+    asyncio.run(fetch(480))
+    # 三个文件都在保护期内，暂时超出上限也不删除
+    assert len(cache._entries) == 3
+
+    cache._touched[oldest] = time.time() - 120
+    newest = asyncio.run(fetch(640))
+    assert oldest not in cache._entries
+    assert not os.path.exists(os.path.join(cache.cache_dir, oldest))
+    assert newest in cache._entries
+    assert cache.total_bytes == 300
@@ -0,0 +1,94 @@
+"""memory_store.TTLCache：过期、LRU 淘汰与 sweep"""
+
+import pytest
+
+import memory_store
+from memory_store import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(memory_store, "time", fake)
+    return fake
+
+
+def test_get_expires_lazily(clock):
+    cache = TTLCache(max_entries=10, default_ttl=5)
+    cache.set("a", 1)
+    clock.now += 4
+    assert cache.get("a") == 1
+    clock.now += 1
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_evicts_least_recently_used(clock):
+    cache = TTLCache(max_entries=2, default_ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+
+
+def test_sweep_removes_recently_used_expired_entries(clock):
+    cache = TTLCache(max_entries=100, default_ttl=10)
+    cache.set("long", 1, ttl=100)
+    for i in range(20):
+        cache.set(f"short{i}", i)
+    # 访问使过期条目排到 LRU 末尾，sweep 仍应删除
+    cache.get("short0")
+    clock.now += 11
+    assert cache.sweep() == 20
+    assert list(cache.items()) == [("long", 1)]
+
+
+def test_sweep_skips_overwritten_entries(clock):
+    cache = TTLCache(max_entries=10, default_ttl=10)
+    cache.set("a", 1)
+    clock.now += 5
+    cache.set("a", 2)
+    clock.now += 6
+    assert cache.sweep() == 0
+    assert cache.get("a") == 2
+    clock.now += 5
+    assert cache.sweep() == 1
+    assert len(cache) == 0
+
+
+def test_expiry_heap_stays_bounded(clock):
+    cache = TTLCache(max_entries=10, default_ttl=10)
+    for i in range(1000):
+        cache.set("a", i)
+    assert len(cache._expiry) <= 2 * len(cache) + 64
+
+
+def test_extend_keeps_later_expiry(clock):
+    cache = TTLCache(max_entries=10, default_ttl=10)
+    cache.set("a", 1, ttl=100)
+    cache.extend("a", 2, min_ttl=5)
+    clock.now += 50
+    assert cache.get("a") == 2
+    cache.extend("a", 3, min_ttl=200)
+    clock.now += 150
+    assert cache.get("a") == 3
+
+
+def test_update_merges_fields(clock):
+    cache = TTLCache(max_entries=10, default_ttl=10)
+    cache.update("task", {"status": "queued"})
+    merged = cache.update("task", {"progress": 0.5})
+    assert merged == {"status": "queued", "progress": 0.5}
+    assert cache.pop("task") == merged
+    assert cache.pop("task") is None
@@ -0,0 +1,44 @@
+"""阶段1 rcsd.EmptyRoomEngine.mask_boxes：区域修复的裁剪框"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+pytest.importorskip("transformers")
+
+from stage_models import import_stage1  # noqa: E402
+
+rcsd = import_stage1()
+
+
+def mask_boxes(mask):
+    # 只用到静态的 _fit_box，不需要加载模型
+    return rcsd.EmptyRoomEngine.mask_boxes(rcsd.EmptyRoomEngine.__new__(rcsd.EmptyRoomEngine), mask)
+
+
+def test_empty_mask_has_no_regions():
+    assert mask_boxes(np.zeros((1000, 1500), dtype=np.uint8)) == []
+
+
+def test_region_is_square_and_inside_image():
+    mask = np.zeros((1000, 1500), dtype=np.uint8)
+    mask[10:60, 20:80] = 1
+    (x0, y0, x1, y1), = mask_boxes(mask)
+    assert x1 - x0 == y1 - y0 == rcsd.REGION_SIZE
+    assert x0 >= 0 and y0 >= 0 and x1 <= 1500 and y1 <= 1000
+    assert x0 <= 20 and y0 <= 10 and x1 >= 80 and y1 >= 60
+
+
+def test_overlapping_regions_are_merged():
+    mask = np.zeros((2000, 3000), dtype=np.uint8)
+    mask[100:200, 100:200] = 1
+    mask[150:250, 400:500] = 1
+    mask[1500:1600, 2500:2600] = 1
+    boxes = mask_boxes(mask)
+    assert len(boxes) == 2
+    for box in boxes:
+        for other in boxes:
+            if box is not other:
+                assert not (box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3])
@@ -0,0 +1,33 @@
+"""scheduling.StrideScheduler：按权重轮转队列"""
+
+from collections import Counter
+
+from scheduling import StrideScheduler
+
+
+def take(scheduler: StrideScheduler, task_types, rounds: int) -> Counter:
+    taken = Counter()
+    for _ in range(rounds):
+        task_type = scheduler.order(task_types)[0]
+        scheduler.charge(task_type)
+        taken[task_type] += 1
+    return taken
+
+
+def test_shares_follow_weights():
+    scheduler = StrideScheduler({"denoise": 3, "virtual": 1})
+    taken = take(scheduler, ["denoise", "virtual"], 40)
+    assert taken == {"denoise": 30, "virtual": 10}
+
+
+def test_higher_weight_goes_first_on_tie():
+    scheduler = StrideScheduler({"denoise": 1, "virtual": 2})
+    assert scheduler.order(["denoise", "virtual"]) == ["virtual", "denoise"]
+
+
+def test_idle_queue_does_not_bank_credit():
+    scheduler = StrideScheduler({"denoise": 1, "virtual": 1})
+    take(scheduler, ["denoise"], 10)
+    # virtual 空闲期间没有积攒额度，重新出现后仍按 1:1 轮转
+    taken = take(scheduler, ["denoise", "virtual"], 10)
+    assert taken == {"denoise": 5, "virtual": 5}
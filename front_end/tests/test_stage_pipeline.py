@@ -0,0 +1,113 @@
+"""stage_pipeline：节点缓存、失效与淘汰"""
+
+import os
+
+import pytest
+
+from stage_pipeline import MANIFEST_NAME, StageCache, StageNode, StagePipeline, build_virtual_staging_pipeline
+
+KB = 1024
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "source.jpg"
+    path.write_bytes(b"original image")
+    return str(path)
+
+
+def write_node(size: int, calls: list):
+    def func(ctx):
+        calls.append(ctx.node.name)
+        with open(ctx.output_path("image", f"{ctx.node.name}.bin"), "wb") as f:
+            f.write(os.urandom(size))
+        ctx.data["params"] = ctx.params
+    return func
+
+
+def set_last_used(cache: StageCache, key: str, timestamp: float) -> None:
+    manifest = os.path.join(cache.entry_dir(key), MANIFEST_NAME)
+    os.utime(manifest, (timestamp, timestamp))
+
+
+def test_reuses_cached_nodes(tmp_path, source):
+    calls = []
+    pipeline = build_virtual_staging_pipeline(
+        write_node(KB, calls), write_node(KB, calls), write_node(KB, calls), write_node(KB, calls),
+        cache=StageCache(str(tmp_path / "cache")),
+    )
+    params = {"decoration_style": "modern", "max_price": 1000, "room_type": "bedroom"}
+    results = pipeline.run(source, params)
+    pipeline.release(results)
+    assert calls == ["empty_room", "select", "place", "render"]
+    assert not any(result.cached for result in results.values())
+
+    # 只修改风格：empty_room 复用，select / render 失效，place 的上游键变化也重新执行
+    calls.clear()
+    results = pipeline.run(source, dict(params, decoration_style="classic"))
+    pipeline.release(results)
+    assert calls == ["select", "place", "render"]
+    assert results["empty_room"].cached
+
+    # 只需要 empty_room 时不执行下游
+    calls.clear()
+    results = pipeline.run(source, params, targets=["empty_room"])
+    pipeline.release(results)
+    assert calls == []
+    assert list(results) == ["empty_room"]
+
+
+def test_failed_node_leaves_no_entry(tmp_path, source):
+    def broken(ctx):
+        with open(ctx.output_path("image", "partial.bin"), "wb") as f:
+            f.write(b"partial")
+        raise RuntimeError("boom")
+
+    cache = StageCache(str(tmp_path / "cache"))
+    pipeline = StagePipeline([StageNode("broken", broken)], cache)
+    with pytest.raises(RuntimeError):
+        pipeline.run(source, {})
+    assert os.listdir(os.path.join(cache.root, "tmp")) == []
+    assert cache._pins == {}
+
+
+def test_prune_removes_least_recently_used(tmp_path, source):
+    calls = []
+    cache = StageCache(str(tmp_path / "cache"), max_mb=1)
+    pipeline = StagePipeline([StageNode("node", write_node(400 * KB, calls), params=["i"])], cache)
+
+    keys = []
+    for i in range(2):
+        results = pipeline.run(source, {"i": i})
+        pipeline.release(results)
+        keys.append(results["node"].key)
+    set_last_used(cache, keys[0], 2000)
+    set_last_used(cache, keys[1], 1000)
+
+    results = pipeline.run(source, {"i": 2})
+    pipeline.release(results)
+    # 超出 1MB 后淘汰最久未使用的 i=1，保留最近使用过的 i=0
+    assert os.path.isdir(cache.entry_dir(keys[0]))
+    assert not os.path.exists(cache.entry_dir(keys[1]))
+    assert os.path.isdir(cache.entry_dir(results["node"].key))
+
+
+def test_prune_skips_pinned_entries(tmp_path, source):
+    calls = []
+    cache = StageCache(str(tmp_path / "cache"), max_mb=1)
+    pipeline = StagePipeline([StageNode("node", write_node(400 * KB, calls), params=["i"])], cache)
+
+    held = pipeline.run(source, {"i": 0})
+    set_last_used(cache, held["node"].key, 1000)
+    for i in (1, 2):
+        pipeline.release(pipeline.run(source, {"i": i}))
+
+    # 仍在读取的条目即使最久未使用也不会被删除
+    path = held["node"].file("image")
+    assert os.path.isfile(path)
+    pipeline.release(held)
+    assert cache._pins == {}
+
+    cache.max_bytes = 1
+    cache.prune()
+    assert not os.path.exists(path)
@@ -6,14 +6,30 @@ Worker Server - 从 Redis 队列读取任务，处理后写回 Redis
 import os
 import json
 import time
+import threading
 import redis
 import shutil
+from functools import partial
 from PIL import Image
 from datetime import datetime
 from pathlib import Path
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
+from admission import WORKER_CONCURRENCY, add_service_time_write
+from artifacts import ARTIFACT_HOLD_PREFIX
+from storage import create_storage, storage_key
+from reliable_queue import ReliableQueue, TASK_MAX_ATTEMPTS, default_worker_id, retry_delay
+from scheduling import QUEUE_AGING_LIMIT, QUEUE_WEIGHTS, StrideScheduler
+from model_manager import ModelManager
+from stage_models import MODEL_DEVICE, SEG_BACKEND, import_stage1, register_stage_models
+from diffusion_batcher import DiffusionBatcher
+from stage_pipeline import StageContext, build_virtual_staging_pipeline
+from metrics import REGISTRY, CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, REDIS_BUCKETS
+from task_records import TASK_PAYLOAD_PREFIX, TASK_STORAGE_PREFIX, add_task_write, merge_task, changed_fields
 
 app = FastAPI(title="Worker Server - Task Processor", version="1.0.0")
 
@@ -37,7 +53,39 @@ REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
 REDIS_QUEUE_PREFIX = "task_queue:"
-TASK_STORAGE_PREFIX = "task_storage:"
+TASK_EVENTS_PREFIX = "task_events:"  # 任务状态推送频道（api_server 的 /task/{task_id}/events 订阅）
+RESULT_INDEX_PREFIX = "result_index:"  # 结果缓存索引（与 api_server.py 保持一致）
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 24 * 3600))
+RESULT_FIELDS = ("processed_url", "processed_path", "furniture_list", "furniture_images", "selection_url")
+TASK_TYPES = ("denoise", "virtual")
+
+# 工作池配置（各任务类型的并发数见 admission.WORKER_CONCURRENCY）
+WORKER_POOL_KIND = os.getenv("WORKER_POOL_KIND", "thread").lower()
+WORKER_POLL_TIMEOUT = 1  # 等待入队通知的超时（秒），只影响停止信号的响应速度
+WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", 300))  # 停止时等待进行中任务的最长时间（秒）
+WORKER_MAINTENANCE_INTERVAL = 5  # 续租与回收过期任务的间隔（秒）
+
+# 产物存储（STORAGE_BACKEND=s3 时 Worker 不需要与 API 共享文件系统）
+storage = create_storage()
+STORAGE_CACHE_PRUNE_INTERVAL = 60  # 清理对象存储本地缓存的间隔（秒）
+
+# 常驻模型：每个模型只加载一次，超出 MODEL_MEMORY_BUDGET_MB 时淘汰最久未使用的模型
+models = register_stage_models(ModelManager())
+# 扩散模型调用的微批处理：并发任务中参数兼容的 pipeline 调用合并为一个批次
+diffusion = DiffusionBatcher(models)
+
+# 监控指标（GET /metrics）
+QUEUE_DEPTH = Gauge("task_queue_depth", "Redis 队列 task_queue:* 中等待处理的任务数")
+TASK_WAIT = Histogram("task_wait_seconds", "任务从入队到开始处理的等待时间（秒，按任务类型 / 优先级 / 付费等级）")
+TASKS_CLAIMED = Counter("tasks_claimed_total", "按队列取出的任务数（reason: weighted 按权重 / aged 队首排队过久）")
+TASK_PROCESSING = Histogram("task_processing_seconds", "任务从开始处理到完成的耗时（秒）")
+TASKS_PROCESSED = Counter("tasks_processed_total", "Worker 处理完成的任务数（按最终状态）")
+TASKS_REAPED = Counter("tasks_reaped_total", "租约过期被回收的任务数（action: requeued / dead）")
+REDIS_LATENCY = Histogram("redis_call_duration_seconds", "Worker Redis 调用耗时（秒，不含等待入队通知的阻塞时间）",
+                          buckets=REDIS_BUCKETS)
+WORKER_BUSY = Counter("worker_busy_seconds_total", "Worker 槽位处理任务的累计时间（秒）")
+WORKER_IDLE = Counter("worker_idle_seconds_total", "Worker 槽位空闲的累计时间（秒）")
+WORKER_INFLIGHT = Gauge("worker_inflight_tasks", "Worker 正在处理的任务数")
 
 # 初始化 Redis 连接
 redis_client = None
@@ -56,6 +104,10 @@ except Exception as e:
     print("✗ Worker Server 需要 Redis 才能运行，请先启动 Redis 服务")
     exit(1)
 
+# 可靠队列：任务取出后在处理中列表里保留到确认为止，Worker 崩溃后由回收任务重新入队
+WORKER_ID = default_worker_id()
+task_queue = ReliableQueue(redis_client, WORKER_ID)
+
 
 def get_task_info(task_id: str) -> dict:
     """
@@ -68,36 +120,211 @@ def get_task_info(task_id: str) -> dict:
         dict: 任务数据，如果不存在返回 None
     """
     try:
-        key = f"{TASK_STORAGE_PREFIX}{task_id}"
-        task_json = redis_client.get(key)
-        if task_json:
-            return json.loads(task_json)
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hgetall(f"{TASK_STORAGE_PREFIX}{task_id}")
+        pipe.get(f"{TASK_PAYLOAD_PREFIX}{task_id}")
+        with REDIS_LATENCY.time(op="get_task"):
+            raw_fields, raw_payload = pipe.execute()
+        return merge_task(raw_fields, raw_payload)
     except Exception as e:
         print(f"✗ 从 Redis 获取任务信息失败: {e}")
     return None
 
 
-def update_task_info(task_id: str, task_data: dict) -> bool:
+def update_task_info(task_id: str, changes: dict) -> bool:
     """
-    更新任务信息到 Redis
+    更新任务信息到 Redis（只 HSET 变化的字段，并维护状态索引）
     
     Args:
         task_id: 任务ID
-        task_data: 任务数据字典
+        changes: 需要更新的字段
     
     Returns:
         bool: 是否成功更新
     """
     try:
-        key = f"{TASK_STORAGE_PREFIX}{task_id}"
-        task_json = json.dumps(task_data, ensure_ascii=False)
-        redis_client.setex(key, 3600, task_json)  # 存储1小时
+        pipe = redis_client.pipeline(transaction=True)
+        add_task_write(pipe, task_id, changes)  # 存储1小时
+        with REDIS_LATENCY.time(op="update_task"):
+            pipe.execute()
         return True
     except Exception as e:
         print(f"✗ 更新任务信息到 Redis 失败: {e}")
         return False
 
 
+def save_cached_result(task_data: dict) -> None:
+    """
+    任务成功后登记结果索引，之后相同图片 + 相同参数的任务可直接复用产物
+    
+    Args:
+        task_data: 已完成的任务数据（result_cache_key 由 api_server 计算）
+    """
+    result_key = task_data.get("result_cache_key")
+    if not result_key or task_data.get("status") != "completed":
+        return
+    try:
+        cached = {field: task_data.get(field) for field in RESULT_FIELDS}
+        cached["source_task_id"] = task_data.get("task_id")
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.setex(f"{RESULT_INDEX_PREFIX}{result_key}", RESULT_CACHE_TTL,
+                   json.dumps(cached, ensure_ascii=False))
+        # 结果缓存有效期内保留源任务的产物（api_server 的产物清理会跳过这些任务）
+        pipe.setex(f"{ARTIFACT_HOLD_PREFIX}{cached['source_task_id']}", RESULT_CACHE_TTL, 1)
+        with REDIS_LATENCY.time(op="result_save"):
+            pipe.execute()
+    except Exception as e:
+        print(f"✗ 保存结果缓存失败: {e}")
+
+
+def publish_task_event(task_id: str, event_type: str, data: dict) -> None:
+    """
+    通过 Redis pub/sub 推送任务事件（状态变化或阶段进度）
+    
+    Args:
+        task_id: 任务ID
+        event_type: 事件类型（status / progress）
+        data: 事件数据
+    """
+    try:
+        message = {"event": event_type, "task_id": task_id, **data}
+        with REDIS_LATENCY.time(op="publish"):
+            redis_client.publish(f"{TASK_EVENTS_PREFIX}{task_id}", json.dumps(message, ensure_ascii=False))
+    except Exception as e:
+        print(f"✗ 发布任务事件失败: {e}")
+
+
+def report_progress(task_id: str, stage: str, progress: float) -> None:
+    """
+    推送处理阶段进度
+    
+    Args:
+        task_id: 任务ID
+        stage: 阶段名称
+        progress: 进度（0~1）
+    """
+    publish_task_event(task_id, "progress", {"stage": stage, "progress": round(progress, 2)})
+
+
+def fetch_original(task_data: dict) -> str:
+    """
+    获取原始图片的本地路径（对象存储中的图片会先下载到本地缓存）
+    
+    Args:
+        task_data: 任务数据字典
+    
+    Returns:
+        str: 本地路径
+    
+    Raises:
+        FileNotFoundError: 原始图片不存在
+    """
+    original_key = task_data.get("original_key")
+    original_path = storage.fetch(original_key) if original_key else task_data.get("original_path")
+    if not original_path or not os.path.exists(original_path):
+        raise FileNotFoundError(f"原始图片不存在: {original_key or original_path}")
+    return original_path
+
+
+def save_output(filename: str, src_path: str = None) -> str:
+    """
+    保存处理结果到产物存储
+    
+    Args:
+        filename: 产物文件名
+        src_path: 要复制的源文件（为空表示产物已写入 storage.local_path 返回的路径）
+    
+    Returns:
+        str: 产物的本地路径
+    """
+    key = storage_key(OUTPUT_FOLDER, filename)
+    local_path = storage.local_path(key)
+    if src_path is not None:
+        shutil.copyfile(src_path, local_path)
+    storage.put_file(key, local_path)
+    return local_path
+
+
+def simulate_empty_room(ctx: StageContext) -> None:
+    """阶段1 去杂物（模拟：使用示例空房间图片，实际应调用 rcsd.py 的 SegFormer + SD Inpainting）"""
+    time.sleep(2)  # 模拟处理耗时
+    example_image_path = os.path.join('example', 'empty_room.jpg')
+    if os.path.exists(example_image_path):
+        shutil.copyfile(example_image_path, ctx.output_path("image", "empty_room.jpg"))
+    else:
+        # 如果没有示例图片，则简单复制原图
+        with Image.open(ctx.source_path) as img:
+            img.convert('RGB').save(ctx.output_path("image", "empty_room.png"), 'PNG')
+
+
+def simulate_select(ctx: StageContext) -> None:
+    """阶段2 家具选择（模拟：使用示例 selection.json，实际应按风格、预算、房间类型选择）"""
+    example_selection_path = os.path.join('example', 'selection.json')
+    furniture_list = []
+    if os.path.exists(example_selection_path):
+        with open(example_selection_path, 'r', encoding='utf-8') as f:
+            furniture_list = json.load(f)
+    with open(ctx.output_path("selection", "selection.json"), 'w', encoding='utf-8') as f:
+        json.dump(furniture_list, f, ensure_ascii=False, indent=2)
+    ctx.data["furniture_list"] = furniture_list
+
+
+def simulate_place(ctx: StageContext) -> None:
+    """阶段2 家具摆放（模拟：使用示例效果图作为家具草图）"""
+    example_room_path = os.path.join('example', 'decorate_room.png')
+    src_path = example_room_path if os.path.exists(example_room_path) else ctx.inputs["empty_room"].file("image")
+    shutil.copyfile(src_path, ctx.output_path("composed", f"composed{os.path.splitext(src_path)[1]}"))
+
+
+def simulate_render(ctx: StageContext) -> None:
+    """阶段3 渲染（模拟：直接使用家具草图，实际应调用 furnishing.py 的 ControlNet Inpaint + Img2Img）"""
+    time.sleep(1)  # 模拟处理耗时
+    composed_path = ctx.inputs["place"].file("composed")
+    shutil.copyfile(composed_path, ctx.output_path("image", f"rendered{os.path.splitext(composed_path)[1]}"))
+
+
+def engine_empty_room(ctx: StageContext) -> None:
+    """阶段1 去杂物（rcsd.EmptyRoomEngine，模型来自常驻模型管理器）"""
+    rcsd = import_stage1()
+    cpu_segmentation = SEG_BACKEND != "torch"  # 分割在 CPU 上运行，GPU 只用于 Inpainting
+    with models.use("segformer_cpu" if cpu_segmentation else "segformer") as (processor, segformer):
+        # Inpainting 经过微批处理器：与其他任务的兼容请求合并，同一个 pipeline 的调用串行执行
+        engine = rcsd.EmptyRoomEngine(device=MODEL_DEVICE, region_inpaint=STAGE1_REGION_INPAINT,
+                                      processor=processor,
+                                      model=None if cpu_segmentation else segformer,
+                                      segmenter=segformer if cpu_segmentation else None,
+                                      pipe_call=partial(diffusion.generate_many, "sd_inpaint"))
+        with Image.open(ctx.source_path) as img:
+            result = engine.remove_clutter(img)
+    result.image.save(ctx.output_path("image", "empty_room.png"), 'PNG')
+    ctx.data["iterations"] = result.iterations
+    ctx.data["converged"] = result.converged
+    ctx.data["stop_reason"] = result.stop_reason
+
+
+# 阶段流水线：节点产物按输入哈希缓存在 STAGE_CACHE_DIR
+# STAGE1_ENGINE=rcsd 时阶段1 使用真实模型，否则使用示例图片模拟
+STAGE1_ENGINE = os.getenv("STAGE1_ENGINE", "simulate").lower()
+STAGE1_REGION_INPAINT = os.getenv("STAGE1_REGION_INPAINT", "0") != "0"  # 阶段1 只裁剪杂物所在区域修复
+STAGE1_VERSION = "simulate-1"
+if STAGE1_ENGINE == "rcsd":
+    # 修复方式与分割后端都会影响结果，使用不同的缓存版本
+    STAGE1_VERSION = f"rcsd-3-{SEG_BACKEND}" + ("-region" if STAGE1_REGION_INPAINT else "")
+stage_pipeline = build_virtual_staging_pipeline(
+    engine_empty_room if STAGE1_ENGINE == "rcsd" else simulate_empty_room,
+    simulate_select, simulate_place, simulate_render,
+    versions={"empty_room": STAGE1_VERSION},
+)
+
+
+def stage_progress_reporter(task_id: str, fractions: Dict[str, float]):
+    """返回流水线进度回调：每个节点开始时推送阶段进度（命中缓存的节点标记为 cached）"""
+    def report(node: str, cached: bool) -> None:
+        if node in fractions:
+            report_progress(task_id, f"{node}:cached" if cached else node, fractions[node])
+    return report
+
+
 def process_denoise_task(task_data: dict) -> dict:
     """
     处理 AI 高清放大与去杂任务
@@ -109,42 +336,35 @@ def process_denoise_task(task_data: dict) -> dict:
         dict: 更新后的任务数据
     """
     task_id = task_data.get("task_id")
-    original_path = task_data.get("original_path")
     
     print(f"[处理中] 任务 {task_id}: AI高清放大与去杂处理")
     
     # 更新任务状态为处理中
     task_data["status"] = "processing"
     task_data["processing_started_at"] = datetime.now().isoformat()
-    update_task_info(task_id, task_data)
+    update_task_info(task_id, {
+        "status": "processing",
+        "processing_started_at": task_data["processing_started_at"]
+    })
+    publish_task_event(task_id, "status", {"status": "processing"})
     
     try:
-        # 模拟处理时间（实际应该是 AI 模型处理）
-        time.sleep(2)  # 模拟处理耗时
+        # 获取原始图片（不存在时抛出 FileNotFoundError）
+        original_path = fetch_original(task_data)
         
-        # 检查原始图片是否存在
-        if not os.path.exists(original_path):
-            raise FileNotFoundError(f"原始图片不存在: {original_path}")
+        # 去杂处理即流水线的 empty_room 节点（与虚拟布置共用缓存）
+        report_progress(task_id, "inference", 0.1)
+        results = stage_pipeline.run(original_path, {}, targets=["empty_room"],
+                                     progress=stage_progress_reporter(task_id, {"empty_room": 0.1}))
         
-        # 读取原始图片
-        img = Image.open(original_path)
-        
-        # 模拟 AI 处理：这里使用示例图片作为处理结果
-        # 实际应该调用 AI 模型进行去杂处理
-        example_image_path = os.path.join('example', 'empty_room.jpg')
-        
-        if os.path.exists(example_image_path):
-            # 使用示例图片作为处理结果
-            processed_filename = f"{task_id}_processed.jpg"
-            processed_path = os.path.join(OUTPUT_FOLDER, processed_filename)
-            shutil.copy2(example_image_path, processed_path)
-        else:
-            # 如果没有示例图片，则简单复制原图（实际应该进行 AI 处理）
-            processed_filename = f"{task_id}_processed.png"
-            processed_path = os.path.join(OUTPUT_FOLDER, processed_filename)
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            img.save(processed_path, 'PNG')
+        report_progress(task_id, "saving", 0.9)
+        try:
+            empty_room_path = results["empty_room"].file("image")
+            processed_filename = f"{task_id}_processed{os.path.splitext(empty_room_path)[1]}"
+            processed_path = save_output(processed_filename, empty_room_path)
+        finally:
+            # 复制完成后才允许淘汰缓存中的产物
+            stage_pipeline.release(results)
         
         # 更新任务数据
         task_data["status"] = "completed"
@@ -174,7 +394,6 @@ def process_virtual_staging_task(task_data: dict) -> dict:
         dict: 更新后的任务数据
     """
     task_id = task_data.get("task_id")
-    original_path = task_data.get("original_path")
     decoration_style = task_data.get("decoration_style", "modern")
     max_price = task_data.get("max_price", 50000)
     room_type = task_data.get("room_type", "living room")
@@ -185,48 +404,42 @@ def process_virtual_staging_task(task_data: dict) -> dict:
     # 更新任务状态为处理中
     task_data["status"] = "processing"
     task_data["processing_started_at"] = datetime.now().isoformat()
-    update_task_info(task_id, task_data)
+    update_task_info(task_id, {
+        "status": "processing",
+        "processing_started_at": task_data["processing_started_at"]
+    })
+    publish_task_event(task_id, "status", {"status": "processing"})
     
     try:
-        # 模拟处理时间（实际应该是 AI 虚拟布置模型处理）
-        time.sleep(3)  # 虚拟布置可能需要更长时间
-        
-        # 检查原始图片是否存在
-        if not os.path.exists(original_path):
-            raise FileNotFoundError(f"原始图片不存在: {original_path}")
+        # 获取原始图片（不存在时抛出 FileNotFoundError）
+        original_path = fetch_original(task_data)
         
-        # 模拟 AI 虚拟布置处理
-        # 实际应该调用 AI 模型根据 decoration_style, max_price, room_type 进行虚拟布置
-        # 这里使用示例文件作为处理结果
+        # 按 DAG 执行各阶段：只修改风格 / 预算时复用已缓存的空房间，只重新执行失效的下游节点
+        params = {"decoration_style": decoration_style, "max_price": max_price, "room_type": room_type}
+        results = stage_pipeline.run(original_path, params, progress=stage_progress_reporter(
+            task_id, {"empty_room": 0.1, "select": 0.5, "place": 0.6, "render": 0.7}))
         
-        # 1. 复制效果图
-        example_room_path = os.path.join('example', 'decorate_room.png')
-        if os.path.exists(example_room_path):
-            processed_filename = f"{task_id}_staged.png"
-            processed_path = os.path.join(OUTPUT_FOLDER, processed_filename)
-            shutil.copy2(example_room_path, processed_path)
-        else:
-            # 如果没有示例图片，则复制原图
-            img = Image.open(original_path)
-            processed_filename = f"{task_id}_staged.jpg"
-            processed_path = os.path.join(OUTPUT_FOLDER, processed_filename)
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            img.save(processed_path, 'JPEG', quality=95)
-        
-        # 2. 复制家具列表 JSON
-        example_selection_path = os.path.join('example', 'selection.json')
-        furniture_list = []
-        if os.path.exists(example_selection_path):
-            with open(example_selection_path, 'r', encoding='utf-8') as f:
-                furniture_list = json.load(f)
+        try:
+            # 1. 保存效果图
+            rendered_path = results["render"].file("image")
+            processed_filename = f"{task_id}_staged{os.path.splitext(rendered_path)[1]}"
+            processed_path = save_output(processed_filename, rendered_path)
             
-            # 复制 JSON 文件到输出目录
-            selection_filename = f"{task_id}_selection.json"
-            selection_path = os.path.join(OUTPUT_FOLDER, selection_filename)
-            shutil.copy2(example_selection_path, selection_path)
+            # 2. 保存家具列表 JSON
+            report_progress(task_id, "furniture_selection", 0.8)
+            furniture_list = results["select"].data.get("furniture_list", [])
+            if furniture_list:
+                # 复制 JSON 文件到产物存储（流式写入）
+                selection_filename = f"{task_id}_selection.json"
+                with open(results["select"].file("selection"), 'rb') as src, \
+                        storage.open_write(storage_key(OUTPUT_FOLDER, selection_filename)) as dest:
+                    shutil.copyfileobj(src, dest)
+        finally:
+            # 复制完成后才允许淘汰缓存中的产物
+            stage_pipeline.release(results)
         
         # 3. 复制家具图片
+        report_progress(task_id, "furniture_images", 0.85)
         furniture_images = []
         example_dir = 'example'
         if furniture_list:
@@ -237,8 +450,7 @@ def process_virtual_staging_task(task_data: dict) -> dict:
                     if os.path.exists(furniture_image_path):
                         # 复制家具图片到输出目录
                         furniture_filename = f"{task_id}_{model_id}.png"
-                        furniture_output_path = os.path.join(OUTPUT_FOLDER, furniture_filename)
-                        shutil.copy2(furniture_image_path, furniture_output_path)
+                        save_output(furniture_filename, furniture_image_path)
                         
                         furniture_images.append({
                             "model_id": model_id,
@@ -273,110 +485,325 @@ def process_virtual_staging_task(task_data: dict) -> dict:
         return task_data
 
 
-def process_task_from_queue(queue_name: str, timeout: int = 5):
+def record_service_time(task_type: str, seconds: float) -> None:
     """
-    从 Redis 队列中读取并处理任务
+    记录一次处理耗时（api_server 据此估算排队时间、做准入控制）
     
     Args:
-        queue_name: 队列名称（如 "task_queue:denoise"）
-        timeout: 阻塞超时时间（秒）
+        task_type: 任务类型
+        seconds: 处理耗时（秒）
     """
     try:
-        # 使用 BRPOP 阻塞式读取队列（从右侧弹出，即先进先出）
-        result = redis_client.brpop(queue_name, timeout=timeout)
+        pipe = redis_client.pipeline(transaction=False)
+        add_service_time_write(pipe, task_type, seconds)
+        with REDIS_LATENCY.time(op="service_time"):
+            pipe.execute()
+    except Exception as e:
+        print(f"✗ 记录处理耗时失败: {e}")
+
+
+def seconds_since(timestamp: str) -> float:
+    """计算 ISO 时间戳距今的秒数，无法解析返回 None"""
+    try:
+        return max((datetime.now() - datetime.fromisoformat(timestamp)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def handle_task(task_json: str) -> str:
+    """
+    处理一个出队的任务（在工作池中执行）
+    
+    Args:
+        task_json: 队列中的任务 JSON
+    
+    Returns:
+        str: 任务最终状态（completed / failed）
+    """
+    task_data = json.loads(task_json)
+    queued_snapshot = dict(task_data)
+    task_id = task_data.get("task_id")
+    task_type = task_data.get("task_type")
+    started = time.perf_counter()
+    
+    print(f"\n{'='*60}")
+    print(f"收到新任务: {task_id} (类型: {task_type})")
+    print(f"{'='*60}")
+    
+    # 根据任务类型处理
+    if task_type == "denoise":
+        updated_task_data = process_denoise_task(task_data)
+    elif task_type == "virtual":
+        updated_task_data = process_virtual_staging_task(task_data)
+    else:
+        print(f"✗ 未知的任务类型: {task_type}")
+        task_data["status"] = "failed"
+        task_data["error"] = f"未知的任务类型: {task_type}"
+        updated_task_data = task_data
+    
+    changes = changed_fields(queued_snapshot, updated_task_data)
+    status = updated_task_data.get("status")
+    attempts = 0
+    if status == "failed":
+        attempts = task_queue.record_failure(task_id)
+        if task_type in TASK_TYPES and attempts < TASK_MAX_ATTEMPTS:
+            schedule_retry(task_id, task_json, changes, attempts)
+            return "retrying"
+    
+    # 只把处理过程中变化的字段写回 Redis（供 api_server 查询），再通知订阅者，最后确认任务
+    update_task_info(task_id, changes)
+    save_cached_result(updated_task_data)
+    final_event = {"status": status}
+    if updated_task_data.get("error"):
+        final_event["error"] = updated_task_data["error"]
+    publish_task_event(task_id, "status", final_event)
+    
+    if status == "failed":
+        task_queue.dead_letter(task_id, task_json, updated_task_data.get("error", ""), attempts)
+        print(f"✗ 任务 {task_id} 失败 {attempts} 次，已放入死信队列")
+    else:
+        task_queue.ack(task_id, task_json)
+        record_service_time(task_type, time.perf_counter() - started)
+        print(f"✓ 任务 {task_id} 处理完成，结果已更新到 Redis")
+    print(f"{'='*60}\n")
+    return status
+
+
+def schedule_retry(task_id: str, task_json: str, changes: dict, attempts: int) -> None:
+    """
+    失败的任务按指数退避延迟重试，任务状态恢复为 queued
+    
+    Args:
+        task_id: 任务ID
+        task_json: 队列中的任务 JSON
+        changes: 本次处理中变化的字段
+        attempts: 累计失败次数
+    """
+    delay = retry_delay(attempts)
+    error = changes.pop("error", None)
+    changes.pop("failed_at", None)
+    changes.update({
+        "status": "queued",
+        "attempts": attempts,
+        "last_error": error,
+        "retry_at": datetime.fromtimestamp(time.time() + delay).isoformat(),
+    })
+    update_task_info(task_id, changes)
+    task_queue.retry(task_id, task_json, delay)
+    publish_task_event(task_id, "status", {"status": "queued", "attempts": attempts, "retry_in": round(delay, 1)})
+    print(f"⚠ 任务 {task_id} 第 {attempts} 次失败: {error}，{delay:.1f} 秒后重试")
+    print(f"{'='*60}\n")
+
+
+def handle_reaped_task(task_id: str, action: str, attempts: int) -> None:
+    """
+    更新租约过期被回收的任务的状态
+    
+    Args:
+        task_id: 任务ID
+        action: requeued（已重新入队）/ dead（已放入死信队列）
+        attempts: 累计失败次数
+    """
+    TASKS_REAPED.inc(action=action)
+    if action == "requeued":
+        print(f"⚠ 任务 {task_id} 处理超时（Worker 无响应），已重新入队（第 {attempts} 次失败）")
+        update_task_info(task_id, {"status": "queued", "attempts": attempts, "last_error": "处理超时，已重新入队"})
+        publish_task_event(task_id, "status", {"status": "queued", "attempts": attempts})
+    else:
+        error = f"任务处理超时 {attempts} 次，已放入死信队列"
+        print(f"✗ 任务 {task_id} {error}")
+        update_task_info(task_id, {"status": "failed", "attempts": attempts, "error": error})
+        publish_task_event(task_id, "status", {"status": "failed", "error": error})
+
+
+class TaskDispatcher:
+    """
+    从所有有空闲槽位的队列中取出任务（可靠队列，见 reliable_queue.py），交给工作池并发处理
+    
+    - 每种任务类型的并发数独立限制（WORKER_CONCURRENCY_DENOISE / WORKER_CONCURRENCY_VIRTUAL）
+    - 多个队列都有空闲槽位时按队列权重轮流取任务，队内按优先级与租户公平排序（见 scheduling.py）
+    - WORKER_POOL_KIND=thread（默认）或 process；进程模式下子进程内记录的 Redis 耗时不会出现在 /metrics 中，
+      每个子进程持有自己的 Redis 连接、models 与 diffusion 副本，模型常驻与跨任务批处理不生效（不支持 STAGE1_ENGINE=rcsd）
+    - 所有队列为空时阻塞等待入队通知，不轮询
+    - 后台线程定期为处理中的任务续租，并回收其他 Worker 租约过期的任务
+    - stop() 后不再读取新任务，drain() 等待已读取的任务处理完成
+    """
+    
+    def __init__(self, concurrency: Dict[str, int], kind: str = WORKER_POOL_KIND):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"不支持的工作池类型: {kind}（thread / process）")
+        self.concurrency = dict(concurrency)
+        self.kind = kind
+        self.inflight = {task_type: 0 for task_type in self.concurrency}
+        self.total_slots = sum(self.concurrency.values())
+        self.cond = threading.Condition()
+        self.stopping = threading.Event()
+        self.closed = threading.Event()
+        # 处理中的任务: Future -> task_id（用于续租）
+        self.futures: Dict[Future, str] = {}
+        # 只在 run() 所在线程中使用
+        self.scheduler = StrideScheduler(QUEUE_WEIGHTS)
+        if kind == "process":
+            self.executor = ProcessPoolExecutor(max_workers=self.total_slots)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.total_slots, thread_name_prefix="task-worker")
+        self._idle_since = time.perf_counter()
+    
+    def _account_idle(self) -> None:
+        """累计空闲槽位时间（调用方需持有 self.cond）"""
+        now = time.perf_counter()
+        free_slots = self.total_slots - sum(self.inflight.values())
+        WORKER_IDLE.inc((now - self._idle_since) * free_slots)
+        self._idle_since = now
+    
+    def available_queues(self) -> List[str]:
+        """有空闲槽位的任务类型对应的队列（调用方需持有 self.cond），按队列权重排列尝试顺序"""
+        task_types = [task_type for task_type, limit in self.concurrency.items()
+                      if self.inflight[task_type] < limit]
+        return [f"{REDIS_QUEUE_PREFIX}{task_type}" for task_type in self.scheduler.order(task_types)]
+    
+    def _dispatch(self, task_type: str, task_json: str) -> None:
+        """把任务提交到工作池"""
+        task_data = json.loads(task_json)
+        waited = seconds_since(task_data.get("queued_at"))
+        if waited is not None:
+            TASK_WAIT.observe(waited, task_type=task_type, priority=task_data.get("priority", "batch"),
+                              tier=task_data.get("tier", "free"))
         
-        if result:
-            queue, task_json = result
-            task_data = json.loads(task_json)
-            task_id = task_data.get("task_id")
-            task_type = task_data.get("task_type")
-            
-            print(f"\n{'='*60}")
-            print(f"收到新任务: {task_id} (类型: {task_type})")
-            print(f"{'='*60}")
-            
-            # 根据任务类型处理
-            if task_type == "denoise":
-                updated_task_data = process_denoise_task(task_data)
-            elif task_type == "virtual":
-                updated_task_data = process_virtual_staging_task(task_data)
-            else:
-                print(f"✗ 未知的任务类型: {task_type}")
-                task_data["status"] = "failed"
-                task_data["error"] = f"未知的任务类型: {task_type}"
-                updated_task_data = task_data
-            
-            # 更新任务信息到 Redis（供 api_server 查询）
-            update_task_info(task_id, updated_task_data)
-            
-            print(f"✓ 任务 {task_id} 处理完成，结果已更新到 Redis")
-            print(f"{'='*60}\n")
+        with self.cond:
+            self._account_idle()
+            self.inflight[task_type] += 1
+            WORKER_INFLIGHT.set(self.inflight[task_type], task_type=task_type)
+        started = time.perf_counter()
+        future = self.executor.submit(handle_task, task_json)
+        with self.cond:
+            self.futures[future] = task_data.get("task_id")
+        future.add_done_callback(lambda f: self._on_done(task_type, started, f))
+    
+    def _on_done(self, task_type: str, started: float, future: Future) -> None:
+        """任务结束：释放槽位并记录指标"""
+        elapsed = time.perf_counter() - started
+        try:
+            status = future.result()
+        except Exception as e:
+            print(f"✗ 处理队列任务失败: {e}")
+            status = "failed"
+        WORKER_BUSY.inc(elapsed)
+        TASK_PROCESSING.observe(elapsed, task_type=task_type)
+        TASKS_PROCESSED.inc(task_type=task_type, status=status)
+        with self.cond:
+            self._account_idle()
+            self.inflight[task_type] -= 1
+            WORKER_INFLIGHT.set(self.inflight[task_type], task_type=task_type)
+            self.futures.pop(future, None)
+            self.cond.notify_all()
+    
+    def run(self) -> None:
+        """主循环：等待空闲槽位 -> 按调度顺序从可接收任务的队列中取任务 -> 提交到工作池"""
+        while not self.stopping.is_set():
+            with self.cond:
+                queues = self.available_queues()
+                while not queues and not self.stopping.is_set():
+                    self.cond.wait(WORKER_POLL_TIMEOUT)
+                    queues = self.available_queues()
+            if self.stopping.is_set():
+                break
             
-            return True
-        else:
-            # 超时，没有任务
-            return False
+            try:
+                # 原子地把任务移入本 Worker 的处理中列表；所有队列为空时等待入队通知
+                result = task_queue.claim(queues)
+                if result is None:
+                    task_queue.wait(WORKER_POLL_TIMEOUT)
+                    continue
+            except redis.exceptions.ConnectionError:
+                print("✗ Redis 连接断开，5秒后重试...")
+                self.stopping.wait(5)
+                continue
+            except Exception as e:
+                print(f"✗ 读取队列失败: {e}")
+                self.stopping.wait(1)
+                continue
             
-    except redis.exceptions.ConnectionError:
-        print("✗ Redis 连接断开，尝试重连...")
-        return False
-    except Exception as e:
-        print(f"✗ 处理队列任务失败: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+            queue, task_json, aged = result
+            task_type = queue[len(REDIS_QUEUE_PREFIX):]
+            self.scheduler.charge(task_type)
+            TASKS_CLAIMED.inc(task_type=task_type, reason="aged" if aged else "weighted")
+            self._dispatch(task_type, task_json)
+    
+    def maintain(self) -> None:
+        """后台线程：为处理中的任务续租，回收租约过期的任务，把到期的重试任务放回队列"""
+        while not self.closed.wait(WORKER_MAINTENANCE_INTERVAL):
+            try:
+                with self.cond:
+                    task_ids = [task_id for task_id in self.futures.values() if task_id]
+                task_queue.heartbeat(task_ids)
+                for task_id, action, attempts in task_queue.reap():
+                    handle_reaped_task(task_id, action, attempts)
+            except Exception as e:
+                print(f"✗ 续租 / 回收任务失败: {e}")
+    
+    def prune_storage_cache(self) -> None:
+        """后台线程：对象存储模式下按 STORAGE_CACHE_MAX_MB 淘汰本地缓存的原图与结果（Worker 节点没有产物清理）"""
+        while not self.closed.wait(STORAGE_CACHE_PRUNE_INTERVAL):
+            try:
+                removed = storage.prune_cache()
+                if removed:
+                    print(f"✓ 已清理 {removed} 个本地缓存的产物文件")
+            except Exception as e:
+                print(f"✗ 清理本地产物缓存失败: {e}")
+    
+    def stop(self) -> None:
+        """停止读取新任务"""
+        self.stopping.set()
+        with self.cond:
+            self.cond.notify_all()
+    
+    def drain(self, timeout: float = WORKER_DRAIN_TIMEOUT) -> bool:
+        """
+        等待已读取的任务处理完成并关闭工作池
+        
+        Returns:
+            bool: 是否在超时前全部完成
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.futures and time.monotonic() < deadline:
+                self.cond.wait(min(1.0, max(deadline - time.monotonic(), 0)))
+            drained = not self.futures
+        self.executor.shutdown(wait=drained)
+        self.closed.set()
+        return drained
 
 
-def worker_loop():
+def worker_loop(dispatcher: "TaskDispatcher"):
     """
-    Worker 主循环：持续从队列中读取任务并处理
+    Worker 主循环：持续从队列中读取任务并交给工作池处理
     """
     print("\n" + "="*60)
     print("Worker Server 启动 - 开始监听 Redis 队列")
     print("="*60)
-    print(f"监听队列:")
-    print(f"  - {REDIS_QUEUE_PREFIX}denoise (AI高清放大与去杂)")
-    print(f"  - {REDIS_QUEUE_PREFIX}virtual (虚拟布置)")
+    print(f"监听队列（工作池: {dispatcher.kind}）:")
+    print(f"  - {REDIS_QUEUE_PREFIX}denoise (AI高清放大与去杂，并发 {dispatcher.concurrency['denoise']})")
+    print(f"  - {REDIS_QUEUE_PREFIX}virtual (虚拟布置，并发 {dispatcher.concurrency['virtual']})")
+    print(f"队列权重: {QUEUE_WEIGHTS}，队首排队超过 {QUEUE_AGING_LIMIT:.0f} 秒优先处理")
+    print(f"Worker ID: {WORKER_ID}")
     print("="*60 + "\n")
     
-    queue_names = [
-        f"{REDIS_QUEUE_PREFIX}denoise",
-        f"{REDIS_QUEUE_PREFIX}virtual"
-    ]
+    migrated = task_queue.migrate_legacy_queues(f"{REDIS_QUEUE_PREFIX}{task_type}" for task_type in TASK_TYPES)
+    if migrated:
+        print(f"✓ 已把旧版 List 队列中的 {migrated} 个任务转换为优先级队列")
+    if models.budget_bytes:
+        print(f"模型内存预算: {models.budget_bytes // (1024 * 1024)} MB")
+    models.preload()
     
-    while True:
-        try:
-            # 检查 Redis 连接
-            redis_client.ping()
-            
-            # 轮询所有队列
-            task_processed = False
-            for queue_name in queue_names:
-                if process_task_from_queue(queue_name, timeout=1):
-                    task_processed = True
-                    break  # 处理完一个任务后，重新开始轮询
-            
-            # 如果没有任务，短暂休眠避免 CPU 占用过高
-            if not task_processed:
-                time.sleep(0.5)
-                
-        except redis.exceptions.ConnectionError:
-            print("✗ Redis 连接断开，5秒后重试...")
-            time.sleep(5)
-            # 尝试重连
-            try:
-                redis_client.ping()
-                print("✓ Redis 重连成功")
-            except:
-                pass
-        except KeyboardInterrupt:
-            print("\n\n收到中断信号，Worker Server 正在关闭...")
-            break
-        except Exception as e:
-            print(f"✗ Worker 循环错误: {e}")
-            import traceback
-            traceback.print_exc()
-            time.sleep(1)
+    recovered = task_queue.recover()
+    if recovered:
+        print(f"⚠ 发现 {recovered} 个上次未完成的任务，将重新入队")
+    threading.Thread(target=dispatcher.maintain, daemon=True).start()
+    if storage.remote:
+        threading.Thread(target=dispatcher.prune_storage_cache, daemon=True).start()
+    dispatcher.run()
+    print("Worker 已停止读取新任务")
 
 
 @app.get("/")
@@ -397,10 +824,19 @@ async def root():
         "queues": [
             f"{REDIS_QUEUE_PREFIX}denoise",
             f"{REDIS_QUEUE_PREFIX}virtual"
-        ]
+        ],
+        "pool": WORKER_POOL_KIND,
+        "concurrency": WORKER_CONCURRENCY,
+        "queue_weights": QUEUE_WEIGHTS
     }
 
 
+@app.get("/models")
+async def model_stats():
+    """常驻模型、加载耗时与命中率"""
+    return models.stats()
+
+
 @app.get("/health")
 async def health_check():
     """健康检查"""
@@ -417,9 +853,23 @@ async def health_check():
     }
 
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 指标（队列长度在抓取时通过一次管道读取）"""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for task_type in TASK_TYPES:
+            pipe.zcard(f"{REDIS_QUEUE_PREFIX}{task_type}")
+        with REDIS_LATENCY.time(op="queue_depth"):
+            depths = pipe.execute()
+        for task_type, depth in zip(TASK_TYPES, depths):
+            QUEUE_DEPTH.set(depth, queue=f"{REDIS_QUEUE_PREFIX}{task_type}")
+    except Exception as e:
+        print(f"✗ 读取队列长度失败: {e}")
+    return PlainTextResponse(REGISTRY.render(), media_type=CONTENT_TYPE_LATEST)
+
+
 if __name__ == "__main__":
-    import threading
-    
     # 默认端口，可通过环境变量覆盖
     PORT = int(os.getenv("WORKER_PORT", 5002))
     
@@ -428,13 +878,33 @@ if __name__ == "__main__":
     print("=" * 60)
     print(f"Worker API: http://localhost:{PORT}/")
     print(f"健康检查: http://localhost:{PORT}/health")
+    print(f"监控指标: http://localhost:{PORT}/metrics")
     print(f"Redis 配置: {REDIS_HOST}:{REDIS_PORT}")
     print("=" * 60)
     
+    if WORKER_POOL_KIND == "process" and STAGE1_ENGINE == "rcsd":
+        # 子进程各自持有 models / diffusion 的副本：每个进程都会加载一份模型，跨任务的批处理也不会发生
+        raise SystemExit("✗ WORKER_POOL_KIND=process 不支持 STAGE1_ENGINE=rcsd（模型常驻与批处理只在线程模式下生效）")
+    
+    dispatcher = TaskDispatcher(WORKER_CONCURRENCY)
+    
+    # uvicorn 会接管 SIGTERM / SIGINT，收到信号后触发 shutdown 事件：停止读取新任务，退出后再等待进行中的任务完成
+    app.add_event_handler("shutdown", dispatcher.stop)
+    
     # 在后台线程中启动 Worker 循环
-    worker_thread = threading.Thread(target=worker_loop, daemon=True)
+    worker_thread = threading.Thread(target=worker_loop, args=(dispatcher,), daemon=True)
     worker_thread.start()
     
     # 启动 FastAPI 服务器（用于健康检查和状态查询）
-    uvicorn.run(app, host="0.0.0.0", port=PORT, log_level="info")
+    try:
+        uvicorn.run(app, host="0.0.0.0", port=PORT, log_level="info")
+    finally:
+        dispatcher.stop()
+        worker_thread.join(WORKER_POLL_TIMEOUT + 1)
+        print(f"等待 {len(dispatcher.futures)} 个进行中的任务完成...")
+        if dispatcher.drain():
+            diffusion.close()
+            print("✓ Worker Server 已关闭")
+        else:
+            print("⚠ 等待超时，仍有任务未完成")
 
@@ -0,0 +1,162 @@
+"""
+分割性能对比（rcsd.py）
+
+1. 两种分割放大方式的耗时、显存与 mask 一致性（默认）:
+
+- logits: 150 类 logits 双线性插值到原图尺寸后 argmax（原实现，作为参照）
+- nearest: 模型分辨率上 argmax，类别图最近邻放大到原图尺寸
+
+一致性指标:
+- label_agree: 类别图逐像素一致的比例
+- clutter_iou: 杂物区域（clutter_regions）的 IoU
+- repair_iou: 实际送入 Inpainting 的修复 mask（扩展后）的 IoU
+
+    python benchmark_segmentation.py input/ [--device cuda] [--repeat 3]
+
+2. CPU 推理后端与 fp32 PyTorch（CPU）的延迟与 mIoU 差异（--backends）:
+
+    python benchmark_segmentation.py input/ --backends int8,onnx,onnx-int8 [--threads 8] [--repeat 3]
+
+mIoU 在两者出现过的类别上计算；clutter_iou 为杂物区域的 IoU。
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from rcsd import SEG_BACKENDS, EmptyRoomEngine, list_images
+
+
+def iou(a: np.ndarray, b: np.ndarray) -> float:
+    a, b = a > 0, b > 0
+    union = np.count_nonzero(a | b)
+    return 1.0 if union == 0 else np.count_nonzero(a & b) / union
+
+
+def miou(ref: np.ndarray, seg: np.ndarray) -> float:
+    classes = np.union1d(np.unique(ref), np.unique(seg))
+    return float(np.mean([iou(ref == c, seg == c) for c in classes]))
+
+
+def run_segment(engine: EmptyRoomEngine, image: Image.Image, mode: str, repeat: int):
+    """返回 (类别图, 平均耗时秒, 峰值显存 MB 或 None)"""
+    engine.seg_upsample = mode
+    cuda = engine.device.startswith("cuda")
+    engine.segment(image)  # 预热
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        seg = engine.segment(image)
+    if cuda:
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - started) / repeat
+    peak = torch.cuda.max_memory_allocated() / 1024 / 1024 if cuda else None
+    return seg, elapsed, peak
+
+
+def time_segment(engine: EmptyRoomEngine, image: Image.Image, repeat: int):
+    """返回 (类别图, 平均耗时秒)，不含预热"""
+    engine.segment(image)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        seg = engine.segment(image)
+    return seg, (time.perf_counter() - started) / repeat
+
+
+def benchmark_backends(paths, backends, threads: int, repeat: int) -> None:
+    """CPU 推理后端与 fp32 PyTorch（CPU）对比"""
+    if threads > 0:
+        torch.set_num_threads(threads)
+    reference = EmptyRoomEngine(device="cpu")
+    reference.model.to("cpu")
+    engines = {}
+    for backend in backends:
+        started = time.perf_counter()
+        engines[backend] = EmptyRoomEngine(device="cpu", seg_backend=backend, seg_threads=threads,
+                                           processor=reference.processor, model=reference.model)
+        print(f"{backend}: 准备与预热 {time.perf_counter() - started:.1f} s")
+
+    stats = {backend: {"time": [], "miou": [], "clutter_iou": []} for backend in backends}
+    ref_times = []
+    for path in paths:
+        image = Image.open(path).convert("RGB")
+        ref, ref_time = time_segment(reference, image, repeat)
+        ref_times.append(ref_time)
+        line = [f"{path}: fp32 {ref_time*1000:.0f} ms"]
+        for backend, engine in engines.items():
+            seg, seg_time = time_segment(engine, image, repeat)
+            stats[backend]["time"].append(seg_time)
+            stats[backend]["miou"].append(miou(ref, seg))
+            stats[backend]["clutter_iou"].append(iou(reference.clutter_regions(ref), engine.clutter_regions(seg)))
+            line.append(f"{backend} {seg_time*1000:.0f} ms (mIoU {stats[backend]['miou'][-1]:.4f})")
+        print("  ".join(line))
+
+    if paths:
+        print(f"\n{len(paths)} 张图片平均（线程数 {torch.get_num_threads()}）: fp32 {np.mean(ref_times)*1000:.0f} ms")
+        for backend, values in stats.items():
+            print(f"  {backend}: {np.mean(values['time'])*1000:.0f} ms  "
+                  f"加速 {np.mean(ref_times) / np.mean(values['time']):.2f}x  "
+                  f"mIoU 漂移 {1 - np.mean(values['miou']):.4f}（最差 {1 - min(values['miou']):.4f}）  "
+                  f"clutter_iou {np.mean(values['clutter_iou']):.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分割性能对比")
+    parser.add_argument("input", nargs="?", default="input", help="图片文件或目录（默认 input/）")
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--repeat", type=int, default=3, help="每种方式重复次数")
+    parser.add_argument("--backends", help="对比 CPU 推理后端，逗号分隔，例如 int8,onnx,onnx-int8")
+    parser.add_argument("--threads", type=int, default=0, help="CPU 推理线程数（0 = 默认）")
+    args = parser.parse_args()
+
+    paths = list_images(args.input)
+    if args.backends:
+        backends = [backend.strip() for backend in args.backends.split(",") if backend.strip()]
+        unknown = [backend for backend in backends if backend not in SEG_BACKENDS or backend == "torch"]
+        if unknown:
+            parser.error(f"未知的后端: {unknown}")
+        benchmark_backends(paths, backends, args.threads, args.repeat)
+        return
+
+    engine = EmptyRoomEngine(device=args.device)
+    engine.model.to(args.device)
+
+    rows = []
+    for path in paths:
+        image = Image.open(path).convert("RGB")
+        ref, ref_time, ref_peak = run_segment(engine, image, "logits", args.repeat)
+        seg, seg_time, seg_peak = run_segment(engine, image, "nearest", args.repeat)
+        ref_regions, seg_regions = engine.clutter_regions(ref), engine.clutter_regions(seg)
+        row = {
+            "image": path,
+            "size": f"{image.size[0]}x{image.size[1]}",
+            "logits_s": ref_time,
+            "nearest_s": seg_time,
+            "logits_mb": ref_peak,
+            "nearest_mb": seg_peak,
+            "label_agree": float(np.mean(ref == seg)),
+            "clutter_iou": iou(ref_regions, seg_regions),
+            "repair_iou": iou(engine.expand_mask(ref_regions), engine.expand_mask(seg_regions)),
+        }
+        rows.append(row)
+        peak = "" if ref_peak is None else f"  显存 {ref_peak:.0f} → {seg_peak:.0f} MB"
+        print(f"{path} ({row['size']}): 耗时 {ref_time*1000:.0f} → {seg_time*1000:.0f} ms{peak}  "
+              f"label_agree {row['label_agree']:.4f}  clutter_iou {row['clutter_iou']:.4f}  "
+              f"repair_iou {row['repair_iou']:.4f}")
+
+    if rows:
+        print(f"\n{len(rows)} 张图片平均: "
+              f"耗时 {np.mean([r['logits_s'] for r in rows])*1000:.0f} → "
+              f"{np.mean([r['nearest_s'] for r in rows])*1000:.0f} ms  "
+              f"label_agree {np.mean([r['label_agree'] for r in rows]):.4f}  "
+              f"clutter_iou {np.mean([r['clutter_iou'] for r in rows]):.4f}  "
+              f"最差 repair_iou {min(r['repair_iou'] for r in rows):.4f}")
+
+
+if __name__ == "__main__":
+    main()
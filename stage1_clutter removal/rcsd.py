@@ -1,97 +1,597 @@
+"""
+阶段1：去除房间杂物，生成空房间图片
+
+SegFormer 语义分割找出非结构类（家具、杂物），Stable Diffusion Inpainting 迭代修复，直到满足收敛条件:
+- 去掉小于 MIN_COMPONENT_AREA 的零散误分类像素后，剩余杂物面积不超过 MIN_RESIDUAL_AREA
+- 或与上一轮相比新检测到的杂物面积不超过 MAX_MASK_DELTA（继续迭代也只是重复修复同一区域）
+第一轮修复整个杂物 mask，之后每轮只修复新检测到的区域。
+
+分割在模型分辨率（输入 512 时为 128x128）上取 argmax，只把类别图按最近邻放大到原图尺寸，
+不再把 150 类的 logits 整体双线性插值到原图（4000x3000 的照片约 7 GB）。
+修复 mask 还要向外扩展 OTHER_EXPAND 像素，边界处的像素级差异不影响修复结果（对比见 benchmark_segmentation.py）。
+
+分割可以在 CPU 上运行（seg_backend / --seg-backend），GPU 只留给扩散模型:
+- torch: PyTorch fp32（模型所在设备）
+- int8: PyTorch 动态量化（Linear 层 int8），CPU
+- onnx / onnx-int8: ONNX Runtime CPU（首次使用时导出到 SEG_ONNX_PATH，需要 pip install onnx onnxruntime）
+与 fp32 的延迟与 mIoU 差异见 benchmark_segmentation.py --backends。
+
+区域修复模式（region_inpaint / --region-inpaint）: 按 mask 的连通域裁剪出带上下文的区域（重叠的区域合并），
+每个区域缩放到模型原生的 512 像素修复后羽化贴回原图。耗时取决于杂物面积而不是照片分辨率，
+未被 mask 覆盖的像素保持原样（整图修复会经过 VAE 编解码并缩放到 512 再放大回原尺寸）。
+
+作为模块使用（模型只加载一次）:
+
+    engine = EmptyRoomEngine()
+    result = engine.remove_clutter(Image.open("room.jpeg"))
+    result.image.save("empty_room.png")
+
+    results = engine.remove_clutter_batch([img1, img2, img3])
+
+命令行（一个进程内处理整个目录）:
+
+    python rcsd.py input/ output/ [--debug]
+"""
+
+import argparse
+import copy
+import os
+from contextlib import nullcontext
+from typing import Callable, List, Optional, Sequence
+
 import torch
 from diffusers import StableDiffusionInpaintPipeline
 from transformers import AutoImageProcessor, AutoModelForSemanticSegmentation
 from PIL import Image
 import numpy as np
 import cv2
-import os
 
 # ================= 参数 =================
-INPUT_IMAGE = "input/room.jpeg"          # LaMa 修复后的图片
-OUTPUT_DIR = "output"
 MAX_ITER = 10                            # 最大迭代次数
 STRUCTURE_CLASSES = [0,3,5,8,14,18]    # 保留的结构类（墙/地板/天花板/窗户/门/窗帘）
 OTHER_EXPAND = 30
 OTHER_EXPAND_DOWN = 50
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# 收敛条件（面积均为占整张图片的比例）
+MIN_COMPONENT_AREA = 0.001     # 小于该面积的连通域视为零散误分类，忽略
+MIN_RESIDUAL_AREA = 0.005      # 剩余杂物面积不超过该值时停止
+MAX_MASK_DELTA = 0.002         # 新检测到的杂物面积不超过该值时停止
+
+# 分割结果放大到原图的方式: nearest（模型分辨率 argmax 后最近邻放大类别图）/ logits（logits 插值到原图后 argmax）
+SEG_UPSAMPLE = "nearest"
 
-# ================= Step 1: 加载 SegFormer 模型 =================
-MODEL_NAME = "nvidia/segformer-b3-finetuned-ade-512-512"
-processor = AutoImageProcessor.from_pretrained(MODEL_NAME)
-model = AutoModelForSemanticSegmentation.from_pretrained(MODEL_NAME)
-model.eval()
+# 分割推理后端: torch / int8 / onnx / onnx-int8
+SEG_BACKEND = "torch"
+SEG_BACKENDS = ("torch", "int8", "onnx", "onnx-int8")
+SEG_THREADS = 0                          # CPU 推理线程数（0 = 默认）
+SEG_ONNX_PATH = "segformer-b3-ade.onnx"  # ONNX 模型路径（int8 版本为 *.int8.onnx）
+SEG_INPUT_SIZE = 512                     # processor 输出的分辨率（预热用）
 
-# ================= Step 2: 加载 Stable Diffusion Inpainting =================
-pipe = StableDiffusionInpaintPipeline.from_pretrained(
-    "runwayml/stable-diffusion-inpainting",
-    torch_dtype=torch.float16,
+# 区域修复
+REGION_SIZE = 512              # 模型原生分辨率：区域缩放到长边为该值
+REGION_PAD = 64                # 区域四周保留的上下文像素
+REGION_FEATHER = 16            # 贴回原图时的羽化半径（像素）
+REGION_MAX_COVERAGE = 0.6      # 区域总面积超过图片的该比例时改为整图修复
+
+SEGFORMER_MODEL = "nvidia/segformer-b3-finetuned-ade-512-512"
+INPAINT_MODEL = "runwayml/stable-diffusion-inpainting"
+
+PROMPT = (
+    "empty modern room, completely bare walls, clean floor, clean ceiling, "
+    "no furniture, no bed, no sofa, no chairs, realistic interior, soft natural light"
 )
-pipe = pipe.to("cuda")
+NEGATIVE_PROMPT = "clutter, messy, furniture, bed, chair, sofa, fan"
+NUM_INFERENCE_STEPS = 50
+GUIDANCE_SCALE = 7.5
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+class EmptyRoomResult:
+    """
+    去杂物结果
+
+    Attributes:
+        image: 最终的空房间图片
+        masks: 每次迭代使用的修复 mask（uint8，255 = 重绘）
+        iterations: 实际执行的修复次数
+        converged: 是否在 max_iter 内满足收敛条件
+        stop_reason: 'clean'（剩余杂物足够少）/ 'stable'（没有新检测到的杂物）/ 'max_iter'
+    """
+
+    def __init__(self, image: Image.Image, masks: List[np.ndarray], iterations: int, stop_reason: str):
+        self.image = image
+        self.masks = masks
+        self.iterations = iterations
+        self.stop_reason = stop_reason
+        self.converged = stop_reason != "max_iter"
+
+
+class _LogitsOnly(torch.nn.Module):
+    """导出 ONNX 用：只输出 logits"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).logits
+
+
+class SegFormerCPU:
+    """
+    SegFormer 的 CPU 推理后端
+
+    Args:
+        model: 已加载的 fp32 SegFormer（不会被修改）
+        backend: int8 / onnx / onnx-int8
+        threads: 推理线程数（0 = 默认）；int8 通过 torch.set_num_threads 设置，对整个进程生效
+        onnx_path: ONNX 模型路径，不存在时从 model 导出
+    """
+
+    def __init__(self, model, backend: str = "int8", threads: int = SEG_THREADS, onnx_path: str = SEG_ONNX_PATH):
+        if backend not in ("int8", "onnx", "onnx-int8"):
+            raise ValueError(f"未知的 CPU 分割后端: {backend}")
+        self.backend = backend
+        self.session = None
+        self.model = None
+
+        if backend == "int8":
+            if threads > 0:
+                torch.set_num_threads(threads)
+            model = copy.deepcopy(model).cpu().eval()
+            self.model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            return
+
+        import onnxruntime as ort
+
+        if not os.path.exists(onnx_path):
+            self.export_onnx(model, onnx_path)
+        if backend == "onnx-int8":
+            onnx_path = self.quantize_onnx(onnx_path)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+
+    @staticmethod
+    def export_onnx(model, onnx_path: str) -> str:
+        """把 SegFormer 导出为 ONNX（batch 与分辨率为动态维度）"""
+        model = copy.deepcopy(model).cpu().eval()
+        dummy = torch.zeros(1, 3, SEG_INPUT_SIZE, SEG_INPUT_SIZE)
+        tmp_path = f"{onnx_path}.tmp"
+        with torch.no_grad():
+            torch.onnx.export(
+                _LogitsOnly(model), (dummy,), tmp_path,
+                input_names=["pixel_values"], output_names=["logits"],
+                dynamic_axes={"pixel_values": {0: "batch", 2: "height", 3: "width"},
+                              "logits": {0: "batch", 2: "height", 3: "width"}},
+                opset_version=14,
+            )
+        os.replace(tmp_path, onnx_path)
+        print(f"✓ SegFormer 已导出: {onnx_path}")
+        return onnx_path
+
+    @staticmethod
+    def quantize_onnx(onnx_path: str) -> str:
+        """ONNX 模型权重动态量化为 int8，返回量化后的路径（已存在时直接使用）"""
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        int8_path = f"{os.path.splitext(onnx_path)[0]}.int8.onnx"
+        if not os.path.exists(int8_path):
+            tmp_path = f"{int8_path}.tmp"
+            quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, int8_path)
+            print(f"✓ SegFormer 已量化: {int8_path}")
+        return int8_path
+
+    def __call__(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """返回 logits（模型分辨率）"""
+        pixel_values = pixel_values.cpu()
+        if self.session is not None:
+            logits = self.session.run(["logits"], {"pixel_values": pixel_values.numpy()})[0]
+            return torch.from_numpy(logits)
+        with torch.no_grad():
+            return self.model(pixel_values=pixel_values).logits
+
+    def warmup(self, runs: int = 2) -> None:
+        """预热（ONNX Runtime 的首次执行与量化权重的打包不计入第一张图片）"""
+        dummy = torch.zeros(1, 3, SEG_INPUT_SIZE, SEG_INPUT_SIZE)
+        for _ in range(runs):
+            self(dummy)
+
+
+class EmptyRoomEngine:
+    """
+    去杂物引擎：构造时加载模型（或使用传入的已加载模型），之后可反复调用
+
+    Args:
+        device: 推理设备
+        max_iter: 最大迭代次数
+        min_component_area / min_residual_area / max_mask_delta: 收敛条件（占图片面积的比例，设为 0 关闭）
+        delta_inpaint: 第二轮起是否只修复新检测到的区域
+        region_inpaint: 是否只裁剪 mask 所在区域修复（见模块说明）
+        seg_upsample: 分割结果放大方式（nearest / logits）
+        seg_backend / seg_threads: 分割推理后端与 CPU 线程数（见模块说明）
+        segmenter: 已创建并预热的 SegFormerCPU（可选，传入时忽略 seg_backend）
+        processor / model: 已加载的 SegFormer（可选，例如来自 Worker 的模型管理器）
+        pipe: 已加载的 Stable Diffusion Inpainting pipeline（可选，未传入时在第一次修复前加载）
+        pipe_call: 代替直接调用 pipe 的函数（可选）: pipe_call([每张图片的 pipeline 参数, ...]) -> [图片, ...]，
+                   例如 Worker 中与其他任务的请求合并批处理的 DiffusionBatcher.generate_many
+    """
+
+    def __init__(self, device: str = "cuda", max_iter: int = MAX_ITER,
+                 min_component_area: float = MIN_COMPONENT_AREA, min_residual_area: float = MIN_RESIDUAL_AREA,
+                 max_mask_delta: float = MAX_MASK_DELTA, delta_inpaint: bool = True,
+                 region_inpaint: bool = False, seg_upsample: str = SEG_UPSAMPLE,
+                 seg_backend: str = SEG_BACKEND, seg_threads: int = SEG_THREADS,
+                 processor=None, model=None, pipe=None, segmenter: Optional[SegFormerCPU] = None,
+                 pipe_call: Optional[Callable[[List[dict]], List[Image.Image]]] = None):
+        if seg_upsample not in ("nearest", "logits"):
+            raise ValueError(f"未知的 seg_upsample: {seg_upsample}")
+        if seg_backend not in SEG_BACKENDS:
+            raise ValueError(f"未知的 seg_backend: {seg_backend}")
+        self.device = device
+        self.max_iter = max_iter
+        self.min_component_area = min_component_area
+        self.min_residual_area = min_residual_area
+        self.max_mask_delta = max_mask_delta
+        self.delta_inpaint = delta_inpaint
+        self.region_inpaint = region_inpaint
+        self.seg_upsample = seg_upsample
+
+        # ================= 加载 SegFormer 模型 =================
+        if processor is None or (model is None and segmenter is None):
+            processor = AutoImageProcessor.from_pretrained(SEGFORMER_MODEL)
+            model = AutoModelForSemanticSegmentation.from_pretrained(SEGFORMER_MODEL)
+            model.eval()
+        self.processor = processor
+        self.model = model
+        if segmenter is None and seg_backend != "torch":
+            segmenter = SegFormerCPU(model, seg_backend, seg_threads)
+            segmenter.warmup()
+        self.segmenter = segmenter
+
+        self._pipe = pipe
+        self.pipe_call = pipe_call
 
-# ================= Step 3: 迭代修复 =================
-image = Image.open(INPUT_IMAGE).convert("RGB")
+    @property
+    def pipe(self):
+        """Stable Diffusion Inpainting（只做分割时不加载）"""
+        if self._pipe is None:
+            pipe = StableDiffusionInpaintPipeline.from_pretrained(INPAINT_MODEL, torch_dtype=torch.float16)
+            self._pipe = pipe.to(self.device)
+        return self._pipe
 
-for iteration in range(MAX_ITER):
-    print(f"=== 第 {iteration+1} 次检测与修复 ===")
-    
     # ---------------- 分割 ----------------
-    inputs = processor(images=image, return_tensors="pt")
-    with torch.no_grad():
-        outputs = model(**inputs)
-    logits = outputs.logits
-    upsampled_logits = torch.nn.functional.interpolate(
-        logits, size=image.size[::-1], mode="bilinear", align_corners=False
-    )
-    pred_seg = upsampled_logits.argmax(dim=1)[0].cpu().numpy()
-    
-    # ---------------- 检查非结构类 ----------------
-    all_classes = np.unique(pred_seg)
-    non_structure_classes = [c for c in all_classes if c not in STRUCTURE_CLASSES]
-    if not non_structure_classes:
-        print("没有检测到非结构类，修复完成。")
-        break
-    
-    print(f"检测到非结构类: {non_structure_classes}, 生成 mask 并 inpainting 修复...")
-    
+    def segment_batch(self, images: Sequence[Image.Image]) -> List[np.ndarray]:
+        """对多张图片做一次批量分割，返回每张图片原尺寸的类别图"""
+        inputs = self.processor(images=list(images), return_tensors="pt")
+        if self.segmenter is not None:
+            logits = self.segmenter(inputs["pixel_values"])
+        else:
+            inputs = {name: tensor.to(self.model.device) for name, tensor in inputs.items()}
+            with torch.no_grad():
+                logits = self.model(**inputs).logits
+        if self.seg_upsample == "nearest":
+            labels = logits.argmax(dim=1).to(torch.uint8).cpu().numpy()
+            return [cv2.resize(label, image.size, interpolation=cv2.INTER_NEAREST)
+                    for label, image in zip(labels, images)]
+
+        segs = []
+        for i, image in enumerate(images):
+            upsampled_logits = torch.nn.functional.interpolate(
+                logits[i:i + 1], size=image.size[::-1], mode="bilinear", align_corners=False
+            )
+            segs.append(upsampled_logits.argmax(dim=1)[0].cpu().numpy())
+        return segs
+
+    def segment(self, image: Image.Image) -> np.ndarray:
+        return self.segment_batch([image])[0]
+
     # ---------------- 生成 mask ----------------
-    mask = np.isin(pred_seg, non_structure_classes).astype(np.uint8) * 255
-    structure_mask = np.isin(pred_seg, STRUCTURE_CLASSES).astype(np.uint8) * 255
-    mask_final = cv2.bitwise_and(mask, cv2.bitwise_not(structure_mask))
-    
-    # 扩展 mask
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (OTHER_EXPAND*2+1, OTHER_EXPAND*2+1))
-    mask_final = cv2.dilate(mask_final, kernel, iterations=1)
-    
-    mask_path = os.path.join(OUTPUT_DIR, f"mask_iter_{iteration+1}.png")
-    cv2.imwrite(mask_path, mask_final)
-    
-    # 转 PIL
-    mask_pil = Image.fromarray(mask_final)
-    
+    def clutter_regions(self, pred_seg: np.ndarray) -> np.ndarray:
+        """非结构类区域（未扩展，已去掉小于 min_component_area 的连通域），uint8，255 = 杂物"""
+        mask = (~np.isin(pred_seg, STRUCTURE_CLASSES)).astype(np.uint8) * 255
+        min_pixels = self.min_component_area * mask.size
+        if min_pixels <= 1 or not mask.any():
+            return mask
+
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        keep = np.zeros(num_labels, dtype=bool)
+        keep[1:] = stats[1:, cv2.CC_STAT_AREA] >= min_pixels
+        return keep[labels].astype(np.uint8) * 255
+
+    @staticmethod
+    def expand_mask(mask: np.ndarray) -> np.ndarray:
+        """扩展 mask，覆盖杂物边缘"""
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (OTHER_EXPAND*2+1, OTHER_EXPAND*2+1))
+        return cv2.dilate(mask, kernel, iterations=1)
+
+    def next_mask(self, pred_seg: np.ndarray, previous: Optional[np.ndarray]):
+        """
+        判断是否收敛，未收敛时生成本轮的修复 mask
+
+        Args:
+            pred_seg: 本轮分割结果
+            previous: 上一轮检测到的杂物区域（第一轮为 None）
+
+        Returns:
+            tuple: (停止原因或 None, 本轮杂物区域, 本轮修复 mask 或 None)
+        """
+        regions = self.clutter_regions(pred_seg)
+        total = regions.size
+        residual = np.count_nonzero(regions) / total
+        if residual == 0 or residual <= self.min_residual_area:
+            return "clean", regions, None
+
+        target = regions
+        if previous is not None:
+            # 上一轮已修复过、本轮仍被检测到的区域多为顽固误分类，不再重复修复
+            new_regions = cv2.bitwise_and(regions, cv2.bitwise_not(previous))
+            if np.count_nonzero(new_regions) / total <= self.max_mask_delta:
+                return "stable", regions, None
+            if self.delta_inpaint:
+                target = new_regions
+        return None, regions, self.expand_mask(target)
+
     # ---------------- Stable Diffusion Inpainting ----------------
-    prompt = (
-        "empty modern room, completely bare walls, clean floor, clean ceiling, "
-        "no furniture, no bed, no sofa, no chairs, realistic interior, soft natural light"
+    def _run_pipe(self, images: Sequence[Image.Image], masks: Sequence[np.ndarray],
+                  native_size: bool = False) -> List[Image.Image]:
+        """
+        相同尺寸的图片合并为一次 pipeline 调用
+
+        Args:
+            native_size: 按输入尺寸生成（尺寸需为 8 的倍数）；否则使用 pipeline 默认的 512x512
+
+        Returns:
+            list: pipeline 的原始输出
+        """
+        if self.pipe_call is not None:
+            return list(self.pipe_call([
+                dict(
+                    prompt=PROMPT,
+                    negative_prompt=NEGATIVE_PROMPT,
+                    image=image,
+                    mask_image=Image.fromarray(mask),
+                    num_inference_steps=NUM_INFERENCE_STEPS,
+                    guidance_scale=GUIDANCE_SCALE,
+                    **({"width": image.size[0], "height": image.size[1]} if native_size else {}),
+                )
+                for image, mask in zip(images, masks)
+            ]))
+
+        results: List[Optional[Image.Image]] = [None] * len(images)
+        groups = {}
+        for i, image in enumerate(images):
+            groups.setdefault(image.size, []).append(i)
+
+        for (width, height), indices in groups.items():
+            size_kwargs = {"width": width, "height": height} if native_size else {}
+            with torch.autocast("cuda") if self.device.startswith("cuda") else nullcontext():
+                outputs = self.pipe(
+                    prompt=[PROMPT] * len(indices),
+                    negative_prompt=[NEGATIVE_PROMPT] * len(indices),
+                    image=[images[i] for i in indices],
+                    mask_image=[Image.fromarray(masks[i]) for i in indices],
+                    num_inference_steps=NUM_INFERENCE_STEPS,
+                    guidance_scale=GUIDANCE_SCALE,
+                    **size_kwargs,
+                ).images
+            for i, output in zip(indices, outputs):
+                results[i] = output
+        return results
+
+    def inpaint_batch(self, images: Sequence[Image.Image], masks: Sequence[np.ndarray]) -> List[Image.Image]:
+        """整图批量修复"""
+        outputs = self._run_pipe(images, masks)
+        # pipeline 默认输出 512x512，恢复到输入尺寸，保持各轮 mask 与最终结果的分辨率一致
+        return [output if output.size == image.size else output.resize(image.size, Image.LANCZOS)
+                for image, output in zip(images, outputs)]
+
+    @staticmethod
+    def _fit_box(box, width: int, height: int):
+        """加上上下文边距并扩成正方形（边长至少 REGION_SIZE），限制在图片范围内"""
+        x0, y0, x1, y1 = box
+        x0, y0, x1, y1 = x0 - REGION_PAD, y0 - REGION_PAD, x1 + REGION_PAD, y1 + REGION_PAD
+        side = max(x1 - x0, y1 - y0, REGION_SIZE)
+        fitted = []
+        for lo, hi, limit in ((x0, x1, width), (y0, y1, height)):
+            length = min(side, limit)
+            start = min(max((lo + hi - length) // 2, 0), limit - length)
+            fitted.extend([start, start + length])
+        return fitted[0], fitted[2], fitted[1], fitted[3]
+
+    def mask_boxes(self, mask: np.ndarray) -> List[tuple]:
+        """
+        mask 连通域的修复区域 (x0, y0, x1, y1)，重叠的区域合并
+
+        Returns:
+            list: 修复区域；mask 为空时返回空列表
+        """
+        height, width = mask.shape[:2]
+        num_labels, _, stats, _ = cv2.connectedComponentsWithStats((mask > 0).astype(np.uint8), connectivity=8)
+        boxes = [
+            self._fit_box((x, y, x + w, y + h), width, height)
+            for x, y, w, h in stats[1:, :4].tolist()
+        ]
+
+        merged = True
+        while merged:
+            merged = False
+            result = []
+            for box in boxes:
+                for j, other in enumerate(result):
+                    if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                        union = (min(box[0], other[0]), min(box[1], other[1]),
+                                 max(box[2], other[2]), max(box[3], other[3]))
+                        result[j] = self._fit_box(union, width, height)
+                        merged = True
+                        break
+                else:
+                    result.append(box)
+            boxes = result
+        return boxes
+
+    def inpaint_regions_batch(self, images: Sequence[Image.Image], masks: Sequence[np.ndarray]) -> List[Image.Image]:
+        """
+        区域批量修复：所有图片的修复区域缩放到模型原生分辨率后一起修复，再羽化贴回原图
+
+        区域总面积超过 REGION_MAX_COVERAGE 的图片改为整图修复。
+        """
+        results: List[Optional[Image.Image]] = [None] * len(images)
+        full = []
+        regions = []  # (图片序号, 区域)
+        for i, (image, mask) in enumerate(zip(images, masks)):
+            boxes = self.mask_boxes(mask)
+            covered = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in boxes)
+            if covered > REGION_MAX_COVERAGE * image.size[0] * image.size[1]:
+                full.append(i)
+            elif not boxes:
+                results[i] = image
+            else:
+                regions.extend((i, box) for box in boxes)
+
+        for i, output in zip(full, self.inpaint_batch([images[i] for i in full], [masks[i] for i in full])):
+            results[i] = output
+
+        crops, crop_masks = [], []
+        for i, (x0, y0, x1, y1) in regions:
+            w, h = x1 - x0, y1 - y0
+            scale = REGION_SIZE / max(w, h)
+            size = (max(8, round(w * scale / 8) * 8), max(8, round(h * scale / 8) * 8))
+            crops.append(images[i].crop((x0, y0, x1, y1)).resize(size, Image.LANCZOS))
+            crop_masks.append(cv2.resize(masks[i][y0:y1, x0:x1], size, interpolation=cv2.INTER_NEAREST))
+        outputs = self._run_pipe(crops, crop_masks, native_size=True)
+
+        canvases = {}
+        for (i, (x0, y0, x1, y1)), output in zip(regions, outputs):
+            canvas = canvases.setdefault(i, np.asarray(images[i], dtype=np.float32).copy())
+            patch = np.asarray(output.resize((x1 - x0, y1 - y0), Image.LANCZOS), dtype=np.float32)
+            # 羽化：mask 边缘处逐渐过渡到原图（REGION_PAD 大于羽化范围，区域边框处保持原图）
+            alpha = cv2.GaussianBlur(masks[i][y0:y1, x0:x1].astype(np.float32) / 255,
+                                     (0, 0), sigmaX=REGION_FEATHER / 2)[..., None]
+            canvas[y0:y1, x0:x1] = patch * alpha + canvas[y0:y1, x0:x1] * (1 - alpha)
+        for i, canvas in canvases.items():
+            results[i] = Image.fromarray(np.clip(canvas + 0.5, 0, 255).astype(np.uint8))
+        return results
+
+    # ---------------- 迭代修复 ----------------
+    def remove_clutter(self, image: Image.Image, debug_dir: Optional[str] = None) -> EmptyRoomResult:
+        """
+        去除单张图片中的杂物
+
+        Args:
+            image: 输入图片
+            debug_dir: 调试输出目录（可选），写入每次迭代的 mask 与修复结果
+
+        Returns:
+            EmptyRoomResult: 空房间图片与每次迭代的 mask
+        """
+        return self.remove_clutter_batch([image], [debug_dir] if debug_dir else None)[0]
+
+    def remove_clutter_batch(self, images: Sequence[Image.Image],
+                             debug_dirs: Optional[Sequence[Optional[str]]] = None) -> List[EmptyRoomResult]:
+        """
+        批量去除杂物：每轮迭代对所有未完成的图片做一次批量分割与批量修复
+
+        Args:
+            images: 输入图片
+            debug_dirs: 每张图片的调试输出目录（可选）
+
+        Returns:
+            list: 与 images 一一对应的 EmptyRoomResult
+        """
+        current = [image.convert("RGB") for image in images]
+        masks: List[List[np.ndarray]] = [[] for _ in images]
+        previous: List[Optional[np.ndarray]] = [None] * len(images)
+        stop_reasons = ["max_iter"] * len(images)
+        active = list(range(len(images)))
+
+        for iteration in range(self.max_iter):
+            if not active:
+                break
+            print(f"=== 第 {iteration+1} 次检测与修复（{len(active)} 张图片）===")
+
+            todo = []
+            for i, pred_seg in zip(active, self.segment_batch([current[i] for i in active])):
+                stop_reason, previous[i], mask = self.next_mask(pred_seg, previous[i])
+                if stop_reason is not None:
+                    stop_reasons[i] = stop_reason
+                    continue
+                masks[i].append(mask)
+                todo.append(i)
+                if debug_dirs and debug_dirs[i]:
+                    os.makedirs(debug_dirs[i], exist_ok=True)
+                    cv2.imwrite(os.path.join(debug_dirs[i], f"mask_iter_{iteration+1}.png"), mask)
+
+            inpaint = self.inpaint_regions_batch if self.region_inpaint else self.inpaint_batch
+            for i, result in zip(todo, inpaint([current[i] for i in todo], [masks[i][-1] for i in todo])):
+                current[i] = result  # 下一轮迭代使用修复结果
+                if debug_dirs and debug_dirs[i]:
+                    result.save(os.path.join(debug_dirs[i], f"image_iter_{iteration+1}.png"))
+            active = todo
+
+        return [EmptyRoomResult(current[i], masks[i], len(masks[i]), stop_reasons[i]) for i in range(len(images))]
+
+
+def list_images(path: str) -> List[str]:
+    """输入为文件时返回该文件，为目录时返回目录下的所有图片"""
+    if os.path.isfile(path):
+        return [path]
+    return sorted(
+        os.path.join(path, name) for name in os.listdir(path)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
     )
-    negative_prompt = "clutter, messy, furniture, bed, chair, sofa, fan"
-    
-    with torch.autocast("cuda"):
-        result = pipe(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            image=image,
-            mask_image=mask_pil,
-            num_inference_steps=50,
-            guidance_scale=7.5,
-        ).images[0]
-    
-    image = result  # 下一轮迭代使用修复结果
-    result_path = os.path.join(OUTPUT_DIR, f"image_iter_{iteration+1}.png")
-    image.save(result_path)
-    print(f"迭代 {iteration+1} 修复结果已保存: {result_path}")
-
-# ================= 保存最终结果 =================
-final_image_path = os.path.join(OUTPUT_DIR, "final_empty_room.png")
-image.save(final_image_path)
-print(f"最终空房间图片已保存: {final_image_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="去除房间杂物，生成空房间图片")
+    parser.add_argument("input", nargs="?", default="input", help="图片文件或目录（默认 input/）")
+    parser.add_argument("output", nargs="?", default="output", help="输出目录（默认 output/）")
+    parser.add_argument("--batch-size", type=int, default=4, help="每批处理的图片数")
+    parser.add_argument("--max-iter", type=int, default=MAX_ITER, help="最大迭代次数")
+    parser.add_argument("--min-component-area", type=float, default=MIN_COMPONENT_AREA,
+                        help="忽略的零散区域面积（占图片比例）")
+    parser.add_argument("--min-residual-area", type=float, default=MIN_RESIDUAL_AREA,
+                        help="剩余杂物面积不超过该比例时停止")
+    parser.add_argument("--max-mask-delta", type=float, default=MAX_MASK_DELTA,
+                        help="新检测到的杂物面积不超过该比例时停止")
+    parser.add_argument("--full-mask", action="store_true", help="每轮都修复完整的杂物 mask（不只修复新区域）")
+    parser.add_argument("--region-inpaint", action="store_true",
+                        help="只裁剪杂物所在区域修复（适合高分辨率照片）")
+    parser.add_argument("--seg-backend", choices=SEG_BACKENDS, default=SEG_BACKEND,
+                        help="分割推理后端（int8 / onnx / onnx-int8 在 CPU 上运行）")
+    parser.add_argument("--seg-threads", type=int, default=SEG_THREADS, help="CPU 分割的线程数（0 = 默认）")
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--debug", action="store_true", help="保存每次迭代的 mask 与修复结果")
+    args = parser.parse_args()
+
+    paths = list_images(args.input)
+    if not paths:
+        print(f"没有找到图片: {args.input}")
+        return
+    os.makedirs(args.output, exist_ok=True)
+
+    engine = EmptyRoomEngine(device=args.device, max_iter=args.max_iter,
+                             min_component_area=args.min_component_area,
+                             min_residual_area=args.min_residual_area,
+                             max_mask_delta=args.max_mask_delta,
+                             delta_inpaint=not args.full_mask,
+                             region_inpaint=args.region_inpaint,
+                             seg_backend=args.seg_backend, seg_threads=args.seg_threads)
+    for start in range(0, len(paths), args.batch_size):
+        batch = paths[start:start + args.batch_size]
+        names = [os.path.splitext(os.path.basename(path))[0] for path in batch]
+        images = [Image.open(path).convert("RGB") for path in batch]
+        debug_dirs = [os.path.join(args.output, f"{name}_debug") for name in names] if args.debug else None
+        for name, result in zip(names, engine.remove_clutter_batch(images, debug_dirs)):
+            final_image_path = os.path.join(args.output, f"{name}_empty_room.png")
+            result.image.save(final_image_path)
+            status = {"clean": "修复完成", "stable": "没有新检测到的杂物", "max_iter": "已达最大迭代次数"}[result.stop_reason]
+            print(f"最终空房间图片已保存: {final_image_path}（{result.iterations} 次修复，{status}）")
+
+
+if __name__ == "__main__":
+    main()